@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Startup and hot-path benchmarks for userdocker.
+
+Installs fake docker, nvidia-docker, dockerd and nvidia-smi executables (see
+fakes.py) into a temp dir, points userdocker's EXECUTORS, DOCKER_SOCKET and
+NVIDIA_SMI at them and times parse_args + prepare_and_exec_cmd end-to-end for
+several commands over a grid of simulated host states (running containers,
+GPUs, config files) and ways to query docker (engine API or cli).
+
+The simulated config files (and no others, i.e., not the host's
+/etc/userdocker/) are loaded on import of userdocker.config, so they feed the
+policy being timed. Their compiled config cache and the groups cache are
+kept in the temp dir, too.
+
+Each measurement runs in a fresh interpreter (so imports and config loading
+are included, like for a real invocation) and reports per-phase timings:
+
+- import: importing userdocker (incl. loading the config files)
+- parse: building the parser and parsing the args
+- exec: the subcommand specific part (policy checks, probes, ...)
+- total: import + parse + exec
+- config: loading (compiling / exec-ing) the simulated config files, part of
+  import (with the compiled config cache, so only the first repetition is
+  cold)
+- one entry per external command (e.g., "docker inspect", "nvidia-smi")
+- docker API: time spent in docker engine API requests
+
+Example:
+
+    python3 benchmarks/bench.py --containers 10 1000 10000 --gpus 1 8 16 \\
+        --config-files 0 100 --repeat 5 --output results.json
+
+The JSON output can be compared across releases.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from itertools import product
+from statistics import median
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+sys.path.insert(0, REPO)
+
+from fakes import install_fakes  # noqa: E402
+
+
+# name: userdocker args (the attach target is owned by the benchmarking user)
+COMMANDS = {
+    'run-dry': ['-n', 'run', 'debian'],
+    'run-nvidia': ['--executor', 'nvidia-docker', 'run', 'debian'],
+    'ps-gpu-used': ['ps', '--gpu-used'],
+    'ps-gpu-free': ['ps', '--gpu-free'],
+    'attach': ['attach', '%064x' % 0],
+}
+
+
+def _driver(spec):
+    """Runs a single userdocker invocation and writes timings to a file."""
+    phases = {}
+
+    def record(phase, duration):
+        phases[phase] = phases.get(phase, 0.) + duration
+
+    def instrument(module, name, phase_of):
+        orig = getattr(module, name)
+
+        def wrapper(cmd, *args, **kwds):
+            t = time.perf_counter()
+            try:
+                return orig(cmd, *args, **kwds)
+            finally:
+                record(phase_of(cmd), time.perf_counter() - t)
+        setattr(module, name, wrapper)
+
+    def cmd_phase(cmd):
+        phase = os.path.basename(cmd[0])
+        if len(cmd) > 1 and not cmd[1].startswith('-'):
+            phase += ' ' + cmd[1]
+        return phase
+
+    instrument(subprocess, 'check_call', cmd_phase)
+    instrument(subprocess, 'check_output', cmd_phase)
+
+    t_start = time.perf_counter()
+    # userdocker.config loads its config files on import, so the config file
+    # loading needs to be redirected before: pre-load the cache module the
+    # config package takes it from (it has no package relative imports)
+    import importlib.util
+    import userdocker
+    cache_spec = importlib.util.spec_from_file_location(
+        'userdocker.config.cache',
+        os.path.join(userdocker.__path__[0], 'config', 'cache.py'))
+    cache = importlib.util.module_from_spec(cache_spec)
+    cache_spec.loader.exec_module(cache)
+    sys.modules[cache_spec.name] = cache
+    load_compiled_configs = cache.load_compiled_configs
+    user_groups = cache.user_groups
+    config_dir = spec['config_dir'] or os.path.join(
+        spec['config_cache_dir'], 'no_config') + os.sep
+
+    def load_simulated_configs(cd, uid, user_name, gids, group_names):
+        t = time.perf_counter()
+        # the config package execs each one before asking for the next
+        for cfn, code in load_compiled_configs(
+                config_dir, uid, user_name, gids,
+                group_names + (spec['config_groups'] or []),
+                cache_dir=spec['config_cache_dir']):
+            yield cfn, code
+        record('config', time.perf_counter() - t)
+
+    cache.load_compiled_configs = load_simulated_configs
+    cache.user_groups = lambda *args: user_groups(
+        *args, cache_dir=spec['config_cache_dir'])
+    from userdocker import config
+    config.EXECUTORS = {
+        'docker': spec['fakes']['docker'],
+        'nvidia-docker': spec['fakes']['nvidia-docker'],
+    }
+    config.NVIDIA_SMI = spec['fakes']['nvidia-smi']
+    # a real NVML (if installed) would otherwise be preferred over the fake
+    config.NV_GPU_BACKEND = 'nvidia-smi'
+    config.DOCKER_SOCKET = spec['docker_socket']
+    config.CONTAINER_ENV_FALLBACK = spec['env_fallback']
+    config.STATE_DIR = spec['state_dir']
+    config.NV_GPU_STATE_CACHE_TTL = spec['gpu_state_ttl']
+    from userdocker.helpers.docker_api import DockerAPI
+    instrument(DockerAPI, 'request', lambda _: 'docker API')
+    # the final command would otherwise replace this process
+    config.EXEC_IN_PLACE = False
+    from userdocker import userdocker
+    from userdocker.helpers.exceptions import UserDockerException
+    from userdocker.helpers.logger import logger_setup
+    from userdocker.parser import parse_args
+    t_import = time.perf_counter()
+    record('import', t_import - t_start)
+
+    error = None
+    try:
+        args = parse_args(spec['argv'])
+        t_parse = time.perf_counter()
+        record('parse', t_parse - t_import)
+        logger_setup(args)
+        userdocker.prepare_and_exec_cmd(args)
+    except SystemExit as e:
+        if e.code:
+            error = 'exit code %s' % e.code
+    except UserDockerException as e:
+        error = str(e)
+    t_end = time.perf_counter()
+    if 'parse' in phases:
+        record('exec', t_end - t_parse)
+    record('total', t_end - t_start)
+
+    with open(spec['result_file'], 'w') as f:
+        json.dump({'phases': phases, 'error': error}, f)
+
+
+def _write_config_files(config_dir, n):
+    """Writes a config.py and n - 1 group config files, returns group names."""
+    os.makedirs(os.path.join(config_dir, 'group'))
+    groups = []
+    for i in range(n):
+        if i == 0:
+            fn = os.path.join(config_dir, 'config.py')
+        else:
+            groups.append('group%d' % i)
+            fn = os.path.join(
+                config_dir, 'group', 'config_%02d_group%d.py' % (i % 100, i))
+        with open(fn, 'w') as f:
+            f.write(
+                'VOLUME_MOUNTS_AVAILABLE = VOLUME_MOUNTS_AVAILABLE + [\n'
+                '%s]\n' % ''.join(
+                    "    '/data/project%d_%d:/data/project%d_%d',\n"
+                    % (i, j, i, j) for j in range(20))
+                if i else 'VOLUME_MOUNTS_AVAILABLE = []\n'
+            )
+    return groups
+
+
+def _run_once(tmp_dir, env, spec):
+    spec = dict(spec, result_file=os.path.join(tmp_dir, 'result.json'))
+    subprocess.check_call(
+        [sys.executable, os.path.abspath(__file__), '--driver',
+         json.dumps(spec)],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    with open(spec['result_file']) as f:
+        return json.load(f)
+
+
+def _start_dockerd(dockerd, socket_path, env):
+    proc = subprocess.Popen([dockerd, socket_path], env=env)
+    deadline = time.time() + 10
+    while not os.path.exists(socket_path):
+        if time.time() > deadline or proc.poll() is not None:
+            proc.kill()
+            raise RuntimeError('fake dockerd did not start')
+        time.sleep(0.01)
+    return proc
+
+
+def _summarize(runs):
+    phases = sorted(set(p for r in runs for p in r['phases']))
+    res = {}
+    for p in phases:
+        vals = [r['phases'].get(p, 0.) * 1000 for r in runs]
+        res[p] = {
+            'median_ms': median(vals),
+            'min_ms': min(vals),
+            'max_ms': max(vals),
+        }
+    return res
+
+
+def run_benchmarks(opts):
+    from userdocker import __version__
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix='userdocker_bench_') as tmp_dir:
+        fakes = install_fakes(tmp_dir)
+        for n_containers, n_gpus, n_configs in product(
+                opts.containers, opts.gpus, opts.config_files):
+            config_dir = config_groups = None
+            cache_dir = os.path.join(tmp_dir, 'cache_%d' % n_configs)
+            if n_configs:
+                config_dir = os.path.join(
+                    tmp_dir, 'config_%d' % n_configs) + os.sep
+                if not os.path.exists(config_dir):
+                    config_groups = _write_config_files(config_dir, n_configs)
+                else:
+                    config_groups = [
+                        'group%d' % i for i in range(1, n_configs)]
+            env = dict(os.environ)
+            env.pop('NV_GPU', None)
+            env.update({
+                'USERDOCKER_BENCH_CONTAINERS': str(n_containers),
+                'USERDOCKER_BENCH_GPUS': str(n_gpus),
+                'USERDOCKER_BENCH_UID': str(os.getuid()),
+                'USERDOCKER_BENCH_LATENCY_MS': str(opts.latency_ms),
+                'PYTHONPATH': REPO,
+                'USERDOCKER_BENCH_LEGACY': '1' if opts.legacy else '0',
+            })
+            for docker_query in opts.docker_query:
+                dockerd = docker_socket = None
+                if docker_query == 'api':
+                    docker_socket = os.path.join(tmp_dir, 'docker.sock')
+                    dockerd = _start_dockerd(
+                        fakes['dockerd'], docker_socket, env)
+                spec = {
+                    'fakes': fakes,
+                    'docker_socket': docker_socket,
+                    'config_dir': config_dir,
+                    'config_groups': config_groups,
+                    'config_cache_dir': cache_dir,
+                    'env_fallback': not opts.no_env_fallback,
+                    'state_dir': os.path.join(
+                        tmp_dir, 'state_%d_%d_%d_%s' % (
+                            n_containers, n_gpus, n_configs, docker_query)),
+                    'gpu_state_ttl': opts.gpu_state_ttl,
+                }
+                try:
+                    for name in opts.commands:
+                        runs = [
+                            _run_once(
+                                tmp_dir, env, dict(spec, argv=COMMANDS[name]))
+                            for _ in range(opts.repeat)
+                        ]
+                        res = {
+                            'command': name,
+                            'containers': n_containers,
+                            'gpus': n_gpus,
+                            'config_files': n_configs,
+                            'docker_query': docker_query,
+                            'gpu_state_ttl': opts.gpu_state_ttl,
+                            'repeat': opts.repeat,
+                            'errors': sorted(set(
+                                r['error'] for r in runs if r['error'])),
+                            'phases': _summarize(runs),
+                        }
+                        results.append(res)
+                        print(
+                            '%-12s containers=%-6d gpus=%-3d configs=%-4d '
+                            'query=%-4s total=%8.1f ms%s' % (
+                                name, n_containers, n_gpus, n_configs,
+                                docker_query,
+                                res['phases']['total']['median_ms'],
+                                '  (errors: %s)' % '; '.join(res['errors'])
+                                if res['errors'] else ''),
+                            file=sys.stderr,
+                        )
+                finally:
+                    if dockerd:
+                        dockerd.terminate()
+                        dockerd.wait()
+                        os.unlink(docker_socket)
+
+    return {
+        'userdocker_version': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'latency_ms': opts.latency_ms,
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        '--containers', type=int, nargs='+', default=[10, 100, 1000, 10000],
+        help='numbers of simulated running containers')
+    parser.add_argument(
+        '--gpus', type=int, nargs='+', default=[1, 8, 16],
+        help='numbers of simulated GPUs')
+    parser.add_argument(
+        '--config-files', type=int, nargs='+', default=[0, 10, 100],
+        help='numbers of simulated config files')
+    parser.add_argument(
+        '--commands', nargs='+', default=sorted(COMMANDS),
+        choices=sorted(COMMANDS), help='commands to benchmark')
+    parser.add_argument(
+        '--docker-query', nargs='+', default=['api', 'cli'],
+        choices=['api', 'cli'],
+        help='query docker via the (fake) engine API socket or the docker cli')
+    parser.add_argument(
+        '--legacy', action='store_true',
+        help='simulate containers of old userdocker versions (no labels)')
+    parser.add_argument(
+        '--no-env-fallback', action='store_true',
+        help='set CONTAINER_ENV_FALLBACK = False')
+    parser.add_argument(
+        '--gpu-state-ttl', type=float, default=0.,
+        help='NV_GPU_STATE_CACHE_TTL for the runs (0 disables the cache, so '
+             'each repetition probes)')
+    parser.add_argument(
+        '--repeat', type=int, default=5,
+        help='repetitions per command and scenario')
+    parser.add_argument(
+        '--latency-ms', type=float, default=0.,
+        help='simulated startup latency of each fake executable invocation')
+    parser.add_argument(
+        '-o', '--output', help='write JSON results to this file (- for stdout)')
+    parser.add_argument('--driver', help=argparse.SUPPRESS)
+    opts = parser.parse_args()
+
+    if opts.driver:
+        _driver(json.loads(opts.driver))
+        return
+
+    results = run_benchmarks(opts)
+    if opts.output == '-':
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    elif opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
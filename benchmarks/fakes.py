@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+
+"""Stand-in docker, dockerd and nvidia-smi executables for benchmarking.
+
+The fakes are small python scripts that answer the commands userdocker issues
+from a simulated host state. The state is configured via env vars, so the
+same scripts can serve all benchmark scenarios. The fake dockerd serves the
+docker engine API on a UNIX socket (given as its only argument):
+
+- USERDOCKER_BENCH_CONTAINERS: number of running containers
+- USERDOCKER_BENCH_GPUS: number of GPUs
+- USERDOCKER_BENCH_GPUS_USED: number of GPUs reserved by userdocker containers
+- USERDOCKER_BENCH_UID: uid owning the first userdocker container
+- USERDOCKER_BENCH_MIG_GPUS: number of (trailing) GPUs in MIG mode
+- USERDOCKER_BENCH_LATENCY_MS: simulated startup latency of each invocation
+- USERDOCKER_BENCH_LEGACY: if set to 1, simulates userdocker containers
+  without labels (started by old versions)
+"""
+
+import os
+import stat
+import sys
+
+
+FAKE_DOCKER = r'''
+import json
+import re
+import sys
+
+from fakes_state import container_by_ref, containers, sleep_latency
+
+sleep_latency()
+args = sys.argv[1:]
+scmd = args[0] if args else ''
+
+
+def render(fmt, container):
+    def lookup(path):
+        val = container
+        for p in path.split('.'):
+            val = val.get(p) if isinstance(val, dict) else None
+        return val
+
+    fmt = re.sub(
+        r'\{\{json \.([\w.]+)\}\}',
+        lambda m: json.dumps(lookup(m.group(1))), fmt)
+    fmt = re.sub(
+        r'\{\{\.Label "([^"]+)"\}\}',
+        lambda m: (container['Config']['Labels'] or {}).get(m.group(1), ''),
+        fmt)
+    fmt = re.sub(
+        r'\{\{\.([\w.]+)\}\}', lambda m: str(lookup(m.group(1)) or ''), fmt)
+    return fmt.replace('\\t', '\t')
+
+
+if scmd == 'ps':
+    fmt = None
+    if '--format' in args:
+        fmt = args[args.index('--format') + 1]
+    filters = [
+        args[i + 1] for i, a in enumerate(args[:-1]) if a == '--filter']
+    for c in containers(filters):
+        print(render(fmt, c) if fmt else c['Id'])
+elif scmd == 'inspect':
+    fmt = args[args.index('--format') + 1]
+    ret = 0
+    for ref in args[args.index('--format') + 2:]:
+        c = container_by_ref(ref)
+        if c:
+            print(render(fmt, c))
+        else:
+            print('Error: No such object: %s' % ref, file=sys.stderr)
+            ret = 1
+    sys.exit(ret)
+elif scmd == 'images':
+    print('0123456789ab')
+# everything else (run, pull, version, ...) just succeeds
+'''
+
+FAKE_DOCKERD = r'''
+import json
+import os
+import socketserver
+import sys
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+from urllib.parse import unquote
+from urllib.parse import urlparse
+
+from fakes_state import container_by_ref
+from fakes_state import containers
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = [unquote(p) for p in url.path.split('/') if p]
+        if parts and parts[0].startswith('v1.'):
+            parts = parts[1:]
+        query = parse_qs(url.query)
+        if parts == ['containers', 'json']:
+            filters = json.loads(query.get('filters', ['{}'])[0])
+            filters = [
+                '%s=%s' % (k, v) for k, vs in filters.items() for v in vs]
+            self.reply(200, [
+                {
+                    'Id': c['Id'],
+                    'Names': [c['Name']],
+                    'Labels': c['Config']['Labels'],
+                    'State': 'running',
+                }
+                for c in containers(filters)
+            ])
+        elif len(parts) == 3 and parts[0] == 'containers' and \
+                parts[2] == 'json':
+            c = container_by_ref(parts[1])
+            if c:
+                self.reply(200, c)
+            else:
+                self.reply(404, {'message': 'No such container'})
+        elif len(parts) >= 3 and parts[0] == 'images' and parts[-1] == 'json':
+            self.reply(200, {'Id': 'sha256:0123456789ab'})
+        else:
+            self.reply(404, {'message': 'page not found'})
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+if os.path.exists(sys.argv[1]):
+    os.unlink(sys.argv[1])
+Server(sys.argv[1], Handler).serve_forever()
+'''
+
+FAKE_NVIDIA_SMI = r'''
+import sys
+
+from fakes_state import gpu_link, gpus, mig_devices, sleep_latency
+
+sleep_latency()
+args = sys.argv[1:]
+if args == ['-L']:
+    for gpu in gpus():
+        print('GPU %d: Tesla V100 (UUID: %s)' % (gpu['index'], gpu['uuid']))
+        for j, (uuid, profile) in enumerate(mig_devices(gpu['index'])):
+            print('  MIG %s Device %d: (UUID: %s)' % (profile, j, uuid))
+    sys.exit(0)
+if args[:2] == ['topo', '-m']:
+    n = len(gpus())
+    print('\t' + '\t'.join('GPU%d' % i for i in range(n))
+          + '\tCPU Affinity\tNUMA Affinity')
+    for i in range(n):
+        print('GPU%d\t' % i + '\t'.join(
+            gpu_link(i, j) for j in range(n)) + '\t\t%d' % (i * 2 // n))
+    sys.exit(0)
+apps_query = [a for a in args if a.startswith('--query-compute-apps=')]
+if apps_query:
+    fields = apps_query[0].split('=', 1)[1].split(',')
+    for gpu in gpus():
+        for pid in gpu['pids']:
+            app = {
+                'gpu_uuid': gpu['uuid'],
+                'pid': pid,
+                'used_memory': gpu['memory.used'] // len(gpu['pids']),
+            }
+            print(', '.join(str(app[f]) for f in fields))
+    sys.exit(0)
+query = [a for a in args if a.startswith('--query-gpu=')]
+if not query:
+    sys.exit(0)
+fields = query[0].split('=', 1)[1].split(',')
+fmt = [a for a in args if a.startswith('--format=')]
+fmt = fmt[0].split('=', 1)[1].split(',') if fmt else ['csv']
+units = {'memory.used': ' MiB', 'memory.total': ' MiB', 'utilization.gpu': ' %'}
+if 'noheader' not in fmt:
+    print(', '.join(
+        f + (' [%s]' % units[f].strip() if f in units else '')
+        for f in fields))
+for gpu in gpus():
+    print(', '.join(
+        str(gpu[f]) + ('' if 'nounits' in fmt else units.get(f, ''))
+        for f in fields))
+'''
+
+FAKES_STATE = r'''
+import os
+import time
+
+N_CONTAINERS = int(os.getenv('USERDOCKER_BENCH_CONTAINERS', '10'))
+N_GPUS = int(os.getenv('USERDOCKER_BENCH_GPUS', '8'))
+N_GPUS_USED = int(os.getenv('USERDOCKER_BENCH_GPUS_USED', N_GPUS // 2))
+N_MIG_GPUS = int(os.getenv('USERDOCKER_BENCH_MIG_GPUS', '0'))
+UID = int(os.getenv('USERDOCKER_BENCH_UID', '1000'))
+LATENCY = float(os.getenv('USERDOCKER_BENCH_LATENCY_MS', '0')) / 1000
+LEGACY = os.getenv('USERDOCKER_BENCH_LEGACY') == '1'
+
+
+def sleep_latency():
+    if LATENCY > 0:
+        time.sleep(LATENCY)
+
+
+def _container(i):
+    """Every second container is a userdocker one, the first N_GPUS_USED
+    userdocker containers each reserve one GPU."""
+    cid = '%064x' % i
+    env = ['PATH=/usr/bin:/bin', 'HOME=/home/user%d' % i]
+    labels = {}
+    if i % 2 == 0:
+        uid = UID if i == 0 else UID + i
+        env += [
+            'USERDOCKER=bench',
+            'USERDOCKER_USER=user%d' % uid,
+            'USERDOCKER_UID=%d' % uid,
+        ]
+        if not LEGACY:
+            labels = {
+                'userdocker.version': 'bench',
+                'userdocker.user': 'user%d' % uid,
+                'userdocker.uid': str(uid),
+                'userdocker.limit.cpus': '8',
+                'userdocker.limit.memory': '32g',
+            }
+        if i // 2 < N_GPUS_USED:
+            env += ['USERDOCKER_NV_GPU=%d' % (i // 2)]
+            if not LEGACY:
+                labels['userdocker.nv_gpu'] = str(i // 2)
+                labels['userdocker.nv_gpu_reservation'] = 'bench%d' % i
+    return {
+        'Id': cid,
+        'ID': cid,
+        'Name': '/bench_%d' % i,
+        'Names': 'bench_%d' % i,
+        'Config': {'Env': env, 'Labels': labels},
+    }
+
+
+def container_by_ref(ref):
+    """Finds a container by its (full) id or name."""
+    try:
+        if ref.startswith('bench_'):
+            i = int(ref[len('bench_'):])
+        elif len(ref) == 64:
+            i = int(ref, 16)
+        else:
+            return None
+    except ValueError:
+        return None
+    return _container(i) if 0 <= i < N_CONTAINERS else None
+
+
+def containers(filters=()):
+    res = []
+    for i in range(N_CONTAINERS):
+        c = _container(i)
+        labels = c['Config']['Labels']
+        ok = True
+        for f in filters:
+            key, _, val = f.partition('=')
+            if key != 'label':
+                continue
+            lk, eq, lv = val.partition('=')
+            if lk not in labels or (eq and labels[lk] != lv):
+                ok = False
+        if ok:
+            res.append(c)
+    return res
+
+
+def gpu_link(i, j):
+    """GPU pairs are NVLinked, each half of the GPUs is on one NUMA node."""
+    if i == j:
+        return ' X '
+    if i // 2 == j // 2:
+        return 'NV2'
+    if i * 2 // N_GPUS == j * 2 // N_GPUS:
+        return 'NODE'
+    return 'SYS'
+
+
+def mig_devices(i):
+    """[(uuid, profile)] of GPU i, the last N_MIG_GPUS GPUs are in MIG mode."""
+    if i < N_GPUS - N_MIG_GPUS:
+        return []
+    return [
+        ('MIG-%08d-0000-0000-0000-%012d' % (i, j), profile)
+        for j, profile in enumerate(['3g.20gb', '2g.10gb', '1g.5gb', '1g.5gb'])
+    ]
+
+
+def gpus():
+    res = []
+    for i in range(N_GPUS):
+        used = i < N_GPUS_USED
+        res.append({
+            'index': i,
+            'uuid': 'GPU-00000000-0000-0000-0000-%012d' % i,
+            'pci.bus_id': '00000000:%02X:00.0' % (0x1a + i * 0x10),
+            'memory.used': 10240 if used else 0,
+            'memory.total': 16280,
+            'utilization.gpu': 90 if used else 0,
+            'pids': [10000 + i] if used else [],
+            'clocks_throttle_reasons.active': '0x%016x' % (
+                0x40 if i == N_GPUS - 3 else 0x1),
+            'ecc.errors.uncorrected.volatile.total': 0,
+            'retired_pages.pending': 'No',
+            'retired_pages.double_bit.count': 0,
+            'persistence_mode': 'Enabled',
+            'pcie.link.gen.current': 1 if used else 3,
+            'pcie.link.gen.max': 3,
+            'pcie.link.width.current': 8 if i == N_GPUS - 2 else 16,
+            'pcie.link.width.max': 16,
+        })
+    return res
+'''
+
+
+def _write_script(path, source, python=sys.executable):
+    with open(path, 'w') as f:
+        f.write('#!%s\n' % python)
+        f.write(source)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP)
+    return path
+
+
+def install_fakes(target_dir):
+    """Installs fake docker, nvidia-docker, dockerd, nvidia-smi in target_dir.
+
+    Returns a dict of name: path.
+    """
+    with open(os.path.join(target_dir, 'fakes_state.py'), 'w') as f:
+        f.write(FAKES_STATE)
+    return {
+        name: _write_script(os.path.join(target_dir, name), source)
+        for name, source in (
+            ('docker', FAKE_DOCKER),
+            ('nvidia-docker', FAKE_DOCKER),
+            ('dockerd', FAKE_DOCKERD),
+            ('nvidia-smi', FAKE_NVIDIA_SMI),
+        )
+    }
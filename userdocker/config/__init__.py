@@ -1,10 +1,11 @@
 # -*- coding: utf-8 -*-
 
-from glob import glob
 import grp
 import os
 import pwd
 
+from .cache import load_compiled_configs as _load_compiled_configs
+from .cache import user_groups as _user_groups
 
 uid = os.getuid()
 uid = int(os.getenv('SUDO_UID', uid))
@@ -14,41 +15,29 @@ user_pwd = pwd.getpwuid(uid)
 user_name = user_pwd.pw_name
 user_home = user_pwd.pw_dir
 group_name = grp.getgrgid(gid).gr_name
-group_names = []
-gids = []
-for _g in grp.getgrall():
-    if user_name in _g.gr_mem:
-        group_names.append(_g.gr_name)
-        gids.append(_g.gr_gid)
 del user_pwd
+# the groups select the config files to load, so only the package default of
+# GROUPS_CACHE_TTL applies here
+from .default import GROUPS_CACHE_TTL as _GROUPS_CACHE_TTL
+group_names, gids = _user_groups(uid, user_name, gid, _GROUPS_CACHE_TTL)
 
 
 # see default.py for explanation on config load order
 from .default import *
 configs_loaded = ['default']
 _cd = '/etc/userdocker/'
-_cfns = (
-    glob(_cd + 'config.py')
-    + sorted([
-        _cfn for _gn in group_names
-             for _cfn in glob(_cd + 'group/config_[0-9][0-9]_%s.py' % _gn)])
-    + sorted([
-        _cfn for _gid in gids
-             for _cfn in glob(_cd + 'gid/config_[0-9][0-9]_%d.py' % _gid)])
-    + glob(_cd + 'user/config_%s.py' % user_name)
-    + glob(_cd + 'uid/config_%d.py' % uid)
-)
-for _cfn in _cfns:
-    with open(_cfn) as _cf:
-        exec(_cf.read())
-        configs_loaded.append(_cfn)
+# compiled config code is cached and only rebuilt on config file changes
+for _cfn, _code in _load_compiled_configs(
+        _cd, uid, user_name, gids, group_names):
+    exec(_code)
+    configs_loaded.append(_cfn)
 
 
 # helpers to show final config
 def items():
     masked = (
         # imports:
-        'default', 'glob', 'grp', 'os', 'pwd',
+        'cache', 'default', 'glob', 'grp', 'os', 'pwd',
         # methods:
         'items', 'path',
     )
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+"""Caches speeding up the config loading on each invocation.
+
+Compiled snapshots of the admin config files: instead of globbing
+/etc/userdocker/ and compiling each config file from source on every
+invocation, the resulting list of code objects is marshalled into a snapshot
+under CACHE_DIR (one per uid, user and group set). A snapshot is only used as
+long as the stat signatures (inode, mtime, size) of all the files it was built
+from and of the config dirs themselves are unchanged, so adding, removing,
+editing or replacing any config file triggers a rebuild.
+
+The snapshot only contains code, the config files are still executed on each
+invocation, so the uid, user_name, ... variables keep working as before.
+
+Supplementary groups of a user: they're resolved via getgrouplist(3) (instead
+of scanning the whole, possibly LDAP backed group database) and cached per
+uid (see GROUPS_CACHE_TTL in default.py).
+"""
+
+import grp
+import hashlib
+import importlib.util
+import json
+import marshal
+import os
+import stat
+import tempfile
+import time
+from glob import glob
+
+
+CACHE_DIR = '/var/cache/userdocker/'
+
+# marshal's format is python version specific, so is our snapshot
+_SNAPSHOT_MAGIC = b'UDCS' + importlib.util.MAGIC_NUMBER
+_CONFIG_SUBDIRS = ('group', 'gid', 'user', 'uid')
+
+
+def config_file_names(cd, uid, user_name, gids, group_names):
+    """Returns the config files to load in load order (see default.py)."""
+    return (
+        glob(cd + 'config.py')
+        + sorted([
+            cfn for gn in group_names
+                for cfn in glob(cd + 'group/config_[0-9][0-9]_%s.py' % gn)])
+        + sorted([
+            cfn for g in gids
+                for cfn in glob(cd + 'gid/config_[0-9][0-9]_%d.py' % g)])
+        + glob(cd + 'user/config_%s.py' % user_name)
+        + glob(cd + 'uid/config_%d.py' % uid)
+    )
+
+
+def stat_signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def is_trusted(st):
+    """Only trust files that only root or we ourselves could have written."""
+    return (
+        st.st_uid in (0, os.geteuid())
+        and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+    )
+
+
+def _snapshot_file_name(cache_dir, cd, uid, user_name, gids, group_names):
+    key = repr((cd, uid, user_name, tuple(gids), tuple(group_names)))
+    return os.path.join(
+        cache_dir, 'config_%s.snapshot' % hashlib.sha1(key.encode()).hexdigest()
+    )
+
+
+def _read_snapshot(fn):
+    try:
+        with open(fn, 'rb') as f:
+            if not is_trusted(os.fstat(f.fileno())):
+                return None
+            if f.read(len(_SNAPSHOT_MAGIC)) != _SNAPSHOT_MAGIC:
+                return None
+            return marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+
+def _write_atomic(fn, data):
+    cache_dir = os.path.dirname(fn)
+    try:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        if not is_trusted(os.stat(cache_dir)):
+            return
+        fd, tmp_fn = tempfile.mkstemp(dir=cache_dir, prefix='.tmp_')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_fn, fn)
+        except BaseException:
+            os.unlink(tmp_fn)
+            raise
+    except OSError:
+        # caching is best effort (e.g., when not run via sudo)
+        pass
+
+
+def load_compiled_configs(
+        cd, uid, user_name, gids, group_names, cache_dir=CACHE_DIR):
+    """Returns [(config_file_name, code), ...] in load order.
+
+    Uses a valid snapshot if possible, otherwise compiles the config files
+    and (re-)writes the snapshot.
+    """
+    dir_sigs = tuple(
+        stat_signature(d) for d in [cd] + [cd + sd for sd in _CONFIG_SUBDIRS])
+    snapshot_fn = _snapshot_file_name(
+        cache_dir, cd, uid, user_name, gids, group_names)
+
+    snapshot = _read_snapshot(snapshot_fn)
+    if snapshot is not None:
+        snapshot_dir_sigs, entries = snapshot
+        if snapshot_dir_sigs == dir_sigs and all(
+                stat_signature(cfn) == sig for cfn, sig, _ in entries):
+            return [(cfn, code) for cfn, _, code in entries]
+
+    entries = []
+    for cfn in config_file_names(cd, uid, user_name, gids, group_names):
+        # stat before reading, so a concurrent edit invalidates the snapshot
+        sig = stat_signature(cfn)
+        with open(cfn) as cf:
+            entries.append((cfn, sig, compile(cf.read(), cfn, 'exec')))
+    _write_atomic(
+        snapshot_fn, _SNAPSHOT_MAGIC + marshal.dumps((dir_sigs, entries)))
+    return [(cfn, code) for cfn, _, code in entries]
+
+
+def _resolve_user_groups(user_name, gid):
+    group_names = []
+    gids = []
+    for g in os.getgrouplist(user_name, gid):
+        if g in gids:
+            continue
+        try:
+            gr = grp.getgrgid(g)
+        except KeyError:
+            continue
+        # getgrouplist always includes the given (primary) gid, but we only
+        # want groups that list the user as a member
+        if g == gid and user_name not in gr.gr_mem:
+            continue
+        group_names.append(gr.gr_name)
+        gids.append(g)
+    return group_names, gids
+
+
+def user_groups(uid, user_name, gid, ttl, cache_dir=CACHE_DIR):
+    """Returns (group_names, gids) of the groups user_name is a member of.
+
+    The result is cached for ttl seconds (0 disables the cache).
+    """
+    cache_fn = os.path.join(cache_dir, 'groups_%d.json' % uid)
+    if ttl > 0:
+        try:
+            with open(cache_fn) as f:
+                if is_trusted(os.fstat(f.fileno())):
+                    cached = json.load(f)
+                    if (
+                            cached['user_name'] == user_name
+                            and cached['gid'] == gid
+                            and 0 <= time.time() - cached['time'] < ttl
+                    ):
+                        return cached['group_names'], cached['gids']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    group_names, gids = _resolve_user_groups(user_name, gid)
+    if ttl > 0:
+        _write_atomic(cache_fn, json.dumps({
+            'user_name': user_name,
+            'gid': gid,
+            'time': time.time(),
+            'group_names': group_names,
+            'gids': gids,
+        }).encode())
+    return group_names, gids
@@ -23,6 +23,12 @@ from . import uid, gid, user_name, group_name, user_home
 # override or modify previous ones. The above might sound complicated, but just
 # start with a /etc/userdocker/config.py and then define exceptions later.
 #
+# To speed up startup, the compiled config files are cached in
+# /var/cache/userdocker/ and automatically rebuilt whenever any config file is
+# added, removed or changed. It's safe to delete that dir at any time.
+# The groups of a user are cached there as well (see GROUPS_CACHE_TTL below),
+# so changes to group memberships can take a while to affect the loaded configs.
+#
 # As a user can be in several groups, the group configs include a 2 digit prio.
 # On execution, we will get all groups for the user, collect the corresponding
 # config files matching those groups if they exist and load all collected
@@ -53,6 +59,44 @@ EXECUTORS = {
 }
 EXECUTOR_DEFAULT = 'docker'
 
+# If set, the final docker command (e.g., docker run) replaces the userdocker
+# process (exec) after all checks passed, instead of being run as a child
+# process. This saves a python process per (long running) container session.
+# The docker command then directly receives all signals sent to the process
+# (e.g., Ctrl+C, terminal resizes) and its exit code is returned as is. With
+# dry-runs or if unset, the command is run as a child process and its exit code
+# is relayed.
+EXEC_IN_PLACE = True
+
+# userdocker's internal read-only queries (e.g., which containers use which
+# GPUs, is an image locally available) are sent directly to the docker daemon's
+# engine API via the following UNIX socket, which is a lot faster than running
+# the docker cli for each of them. If set to None (or the socket doesn't exist)
+# the docker cli of the chosen executor is used instead. User facing commands
+# are always run via the docker cli.
+DOCKER_SOCKET = '/var/run/docker.sock'
+DOCKER_QUERY_TIMEOUT = 10  # seconds (per API request or docker cli query)
+
+# Containers started by userdocker are labelled with the user, uid and GPUs
+# (userdocker.user, userdocker.uid, userdocker.nv_gpu), which allows efficient
+# server-side filtering. Containers started by userdocker versions before 2.1.0
+# only carry this information in their env vars. To find those, all unlabelled
+# running containers need to be inspected. Once no such containers are running
+# anymore, you can set this to False to speed up GPU related commands.
+CONTAINER_ENV_FALLBACK = True
+
+# Directory for host state shared between concurrent userdocker invocations
+# (e.g., cached GPU status). Should be on a tmpfs (cleared on reboot) and will
+# be created (only accessible by root) if it doesn't exist.
+STATE_DIR = '/run/userdocker/'
+
+# Seconds for which the groups of a user are cached in /var/cache/userdocker/
+# (0 disables the cache). The groups select the group config files, so for
+# that lookup only the package default applies. Setting it in a config file
+# only affects later lookups (e.g., of group members for
+# NV_MAX_GPU_COUNT_PER_GROUP).
+GROUPS_CACHE_TTL = 60
+
 # The following allows you to specify which docker top level commands a user can
 # run at all (still restricted by the following settings):
 ALLOWED_SUBCOMMANDS = [
@@ -113,7 +157,7 @@ ARGS_AVAILABLE = {
         '--read-only',
         # users can map all exposed container ports to random free host ports:
         ('-P', '--publish-all'),
-        # '--shm-size=16g',  # allows users to set shared mem size
+        # '--shm-size=16g',  # fixed shared mem size, see RUN_SHM_SIZE
     ],
 }
 
@@ -146,9 +190,13 @@ VOLUME_MOUNTS_DEFAULT = [
     user_home + ':' + user_home,
 ]
 
-# This setting issues a listdir for used host dirs in mounts.
+# This setting reads the first entry of used host dirs in mounts.
 # Useful for server-side auto-mounts.
 PROBE_USED_MOUNTS = True
+# All used mounts are checked (and probed) in parallel. Mounts that don't
+# respond within the following number of seconds (e.g., due to an unresponsive
+# NFS server) result in an error.
+MOUNT_PROBE_TIMEOUT = 10
 
 
 # User is allowed to run an image if any of the following regexps match it
@@ -173,6 +221,53 @@ USER_IN_CONTAINER = True
 CAPS_DROP = ['ALL']
 CAPS_ADD = []
 
+# Resource limits of containers, as dicts {option: value} of the docker run
+# options 'cpus' (number of CPUs), 'memory' (e.g., '16g'), 'memory-swap'
+# (memory + swap, e.g., '32g', -1 for unlimited swap) and 'pids-limit' (number
+# of processes). Users can request values with the run options of the same
+# name:
+# - RUN_LIMITS_DEFAULT: Applied to each container unless the user requests
+#   another value.
+# - RUN_LIMITS_MAX: The maximum a user can request per container. Without a
+#   default, it's also the default.
+# - RUN_LIMITS_PER_USER: Limits of the sum over all running containers of a
+#   user, checked before starting another one. Containers started before a
+#   limit was set don't count. Needs a default or max for the option.
+# Like all settings they can be set per group or user (see config load order
+# above), e.g., RUN_LIMITS_MAX['memory'] = '256g' in a group config.
+# Options passed through via ARGS_AVAILABLE or ARGS_ALWAYS aren't handled.
+RUN_LIMITS_DEFAULT = {
+    # 'cpus': 4,
+    # 'memory': '16g',
+    # 'memory-swap': '16g',
+    # 'pids-limit': 4096,
+}
+RUN_LIMITS_MAX = {}
+RUN_LIMITS_PER_USER = {}
+
+# Size of /dev/shm, ulimits and tmpfs mounts of containers, e.g., for data
+# loaders that need more than docker's default of 64m /dev/shm or locked
+# memory. Each value is bounded by a dict with the optional keys 'min',
+# 'default' and 'max' (like all settings they can be set per group or user):
+# - RUN_SHM_SIZE: Bounds of run --shm-size (None to not offer it). The default
+#   applies unless the user requests a size.
+# - RUN_ULIMITS: {name: bounds} of the ulimits users can set with run --ulimit
+#   NAME=SOFT[:HARD] (memlock in bytes or as size like 64m, -1 for
+#   unlimited). Defaults are set as soft and hard limit unless requested.
+# - RUN_TMPFS: {container path: size bounds} of the tmpfs mounts users can
+#   request with run --tmpfs PATH[:size=SIZE]. Without size the default (or
+#   max) applies. tmpfs mounts live in memory, so they count towards the
+#   container's memory limit.
+# Options passed through via ARGS_AVAILABLE or ARGS_ALWAYS aren't handled.
+RUN_SHM_SIZE = None  # e.g., {'min': '64m', 'default': '1g', 'max': '16g'}
+RUN_ULIMITS = {
+    # 'memlock': {'default': -1, 'max': -1},
+    # 'nofile': {'min': 1024, 'default': 65536, 'max': 1048576},
+}
+RUN_TMPFS = {
+    # '/tmp': {'default': '1g', 'max': '16g'},
+}
+
 # User ability to map ports explicitly:
 # Unlike the probably safe `-P` run arg (which maps all exposed container ports
 # to random free host ports (world accessible)), giving users explicit control
@@ -229,17 +324,153 @@ ENV_VARS_EXT = {
 #   access to all GPUs!
 # - NV_MAX_GPU_COUNT_RESERVATION allows you to limit the amount of GPUs made
 #   available to a single container. Setting this to -1 means no limit.
+# - NV_MAX_GPU_COUNT_PER_USER limits the number of GPUs a user can use
+#   concurrently over all of their containers (-1 means no limit). Like all
+#   settings it can be set per group or user (see config load order above),
+#   e.g., in /etc/userdocker/group/config_50_students.py.
+# - NV_MAX_GPU_COUNT_PER_GROUP limits the number of GPUs all members of a group
+#   can use together, e.g., {'students': 4}. Only GPUs of containers started
+#   by userdocker count.
+# - NV_GPU_FAIR_SHARE_HALF_LIFE: If > 0 (seconds), the GPU usage (GPU-seconds)
+#   of each user is accounted in STATE_DIR, decaying with this half-life. When
+#   GPUs are scarce, runs waiting for GPUs (--wait-for-gpu) of users with less
+#   recent usage are served first (still round robin over users).
 # - GPUs on which more than NV_GPU_UNAVAILABLE_ABOVE_MEMORY_USED MB of memory is
 #   used will be marked as unavailable. This setting is userdocker independent.
 #   Setting this to -1 results in GPUs always being regarded as available.
+#   Similarly, NV_GPU_UNAVAILABLE_ABOVE_UTILIZATION (in %) and
+#   NV_GPU_UNAVAILABLE_ABOVE_PROCESSES (number of compute processes, e.g., also
+#   from outside of containers) mark GPUs as unavailable (-1 to disable).
+# - NV_GPU_SCORE_WEIGHTS: Available GPUs are handed out in ascending order of
+#   their score, a weighted sum of the metrics 'mem_used' (MB), 'mem_total'
+#   (MB), 'utilization' (%), 'processes' (number of compute processes) and
+#   'reservations' (number of containers using the GPU), ties are broken by
+#   reservations. Negative weights prefer higher values (e.g., -1 for
+#   'mem_total' prefers bigger GPUs). The default just orders by memory used.
+#   Example to also avoid busy GPUs: {'mem_used': 1, 'utilization': 100}
+# - NV_GPU_STATUS_SAMPLES: Memory used and utilization are averaged over this
+#   many samples, NV_GPU_STATUS_SAMPLE_INTERVAL seconds apart, as a single
+#   instantaneous read can be misleading. Only done via NVML, without it a
+#   single sample is taken (each would run nvidia-smi).
 # - If NV_EXCLUSIVE_GPU_RESERVATION is set, any GPUs already used in any other
 #   container are regarded as unavailable for this container.
 # - NV_ALLOW_OWN_GPU_REUSE allows users to run multiple containers on GPUs they
 #   already use. This only happens when explicitly setting NV_GPU.
+# - NV_GPU_BACKEND: How to query the GPU status (memory, utilization, ...):
+#   'nvml' queries NVML (libnvidia-ml, NVML_LIB) in-process, which is a lot
+#   faster than 'nvidia-smi', which runs NVIDIA_SMI and parses its output.
+#   'auto' uses NVML if it can be loaded, nvidia-smi otherwise.
+# - NV_GPU_STATE_CACHE_TTL: The GPU status (nvidia-smi) and the GPU usage by
+#   containers are cached in STATE_DIR for this many seconds and shared between
+#   concurrent invocations, so a burst of launches (e.g., a sweep script) only
+#   probes once instead of each running nvidia-smi. Whenever userdocker starts
+#   a container the cached container GPU usage is invalidated. 0 disables the
+#   cache.
+# - NV_GPU_RESERVATION_TIMEOUT: GPUs selected by run are recorded as reserved
+#   in STATE_DIR (under an exclusive lock), so concurrent launches get disjoint
+#   GPUs. A reservation is released as soon as its container is running or
+#   docker run failed, or after this many seconds if neither could be noticed.
+#   Should be longer than starting a container can take (e.g., incl. pulling
+#   its image).
+# - NV_GPU_RESERVATION_LOCK_TIMEOUT: GPU selection is serialized, so under
+#   heavy concurrent launching run waits up to this many seconds for its turn
+#   before failing (each turn probes containers and GPUs, see
+#   NV_GPU_PROBE_TIMEOUT and DOCKER_QUERY_TIMEOUT).
+# - NV_GPU_WAIT_TIMEOUT_MAX: If no GPUs are available, run --wait-for-gpu
+#   waits for up to this many seconds in a fair queue (see ps --gpu-queue),
+#   trying to acquire GPUs every NV_GPU_WAIT_POLL_INTERVAL seconds. 0 disables
+#   waiting. Runs that don't wait fail instead of taking GPUs a waiting run
+#   could use.
+# - NV_GPU_MEM_HEADROOM: Users can declare the GPU memory their container
+#   needs per GPU (run --gpu-mem=6G). Only GPUs with that much free memory
+#   (MB) left after subtracting this headroom are selected. The free memory is
+#   estimated from the total memory minus the declared footprints of the
+#   containers (and reservations) on the GPU, but at least minus the memory
+#   currently used. To let several containers share a GPU (bin-packed by their
+#   footprints, fullest GPU first), set
+#   NV_EXCLUSIVE_CONTAINER_GPU_RESERVATION = False and
+#   NV_GPU_UNAVAILABLE_ABOVE_MEMORY_USED = -1.
+# - NV_GPU_HISTORY_FILE: "userdocker gpu-sample" (root only) appends the GPU
+#   utilization and memory used to this fixed-size, memory-mapped ring buffer
+#   file, which keeps the last NV_GPU_HISTORY_SLOTS samples. Run it regularly,
+#   e.g., from cron: "* * * * * root userdocker -q gpu-sample", or as a
+#   service with "gpu-sample --every 60".
+# - NV_GPU_IDLE_UTILIZATION: "ps --gpu-idle[=DURATION]" uses the history to
+#   show containers holding GPUs that weren't utilized more than this (%) for
+#   DURATION (default: NV_GPU_IDLE_DURATION seconds), e.g., forgotten
+#   notebooks. Needs samples more often than DURATION.
+# - NV_GPU_HEALTH_POLICY: What to do with unhealthy GPUs: 'exclude' them,
+#   'deprioritize' them (only handed out if no healthy GPU is available) or
+#   'ignore' their health (doesn't query it). NV_GPU_HEALTH_CHECKS selects the
+#   checks out of: 'throttling' (any of NV_GPU_HEALTH_THROTTLE_REASONS is
+#   active, e.g., overheating), 'ecc' (uncorrected ECC errors since driver
+#   load), 'retired_pages' (page retirement pending, needs a GPU reset),
+#   'pcie_width' (PCIe link width below max, the link generation is lowered
+#   when idle, so not checked) and 'persistence_mode' (disabled).
+#   "ps --gpu-health" shows the health of all GPUs. The health changes slowly,
+#   so it's cached for NV_GPU_HEALTH_CACHE_TTL seconds.
+# - NV_GPU_MIG: Makes MIG (Multi-Instance GPU, e.g., A100) instances usable
+#   like GPUs: users can request one with "run --gpu-profile 1g.5gb" (or just
+#   1g) or set NV_GPU to MIG UUIDs (see "ps --gpu-free"). A GPU in MIG mode
+#   isn't handed out as a whole and MIG instances are only handed out if
+#   requested. NV_ALLOWED_GPUS can list MIG UUIDs, a GPU index allows all of
+#   its instances. The MIG instances are cached for NV_GPU_MIG_CACHE_TTL
+#   seconds.
+# - NV_GPU_CPU_AFFINITY: Pins nvidia-docker containers to the CPUs and memory
+#   of the NUMA nodes of their GPUs (--cpuset-cpus, --cpuset-mems), as read
+#   from sysfs (numa_node, local_cpulist of the GPUs' PCI devices), so their
+#   host threads and memory don't end up on the other socket. If
+#   NV_GPU_CPUS_PER_GPU is > 0, each container instead gets a disjoint slice
+#   of that many unused local CPUs per GPU (all local CPUs are shared if there
+#   aren't enough). Not done if --cpuset-cpus or --cpuset-mems are passed
+#   through (see ARGS_AVAILABLE and ARGS_ALWAYS).
+NV_GPU_BACKEND = 'auto'  # 'auto', 'nvml' or 'nvidia-smi'
+NVML_LIB = 'libnvidia-ml.so.1'
 NVIDIA_SMI = '/usr/bin/nvidia-smi'  # path to nvidia-smi
+NV_GPU_PROBE_TIMEOUT = 10  # seconds after which a GPU status query fails
+NV_GPU_STATE_CACHE_TTL = 2  # seconds
+NV_GPU_RESERVATION_TIMEOUT = 600  # seconds
+NV_GPU_RESERVATION_LOCK_TIMEOUT = 60  # seconds
+NV_GPU_MEM_HEADROOM = 1024  # MB
+NV_GPU_WAIT_TIMEOUT_MAX = 24 * 60 * 60  # seconds
+NV_GPU_WAIT_POLL_INTERVAL = 10  # seconds
+NV_GPU_TOPOLOGY_SCORES = {
+    'NV': 100,
+    'PIX': 50,
+    'PXB': 40,
+    'PHB': 30,
+    'NODE': 20,
+    'SYS': 0,
+}
+NV_GPU_TOPOLOGY_CACHE_TTL = 24 * 60 * 60  # seconds
+NV_GPU_HEALTH_POLICY = 'deprioritize'  # 'exclude', 'deprioritize', 'ignore'
+NV_GPU_HEALTH_CHECKS = ['throttling', 'ecc', 'retired_pages', 'pcie_width']
+NV_GPU_HEALTH_THROTTLE_REASONS = [
+    'hw_slowdown',
+    'sw_thermal_slowdown',
+    'hw_thermal_slowdown',
+    'hw_power_brake_slowdown',
+]
+NV_GPU_HEALTH_CACHE_TTL = 5 * 60  # seconds
+NV_GPU_MIG = False
+NV_GPU_CPU_AFFINITY = False
+NV_GPU_CPUS_PER_GPU = 0  # disjoint CPU slices if > 0
+NV_GPU_MIG_CACHE_TTL = 60  # seconds
+NV_GPU_HISTORY_FILE = '/var/lib/userdocker/gpu_history'
+NV_GPU_HISTORY_SLOTS = 4 * 7 * 24 * 60  # 4 weeks of samples every minute
+NV_GPU_IDLE_UTILIZATION = 5  # %
+NV_GPU_IDLE_DURATION = 24 * 60 * 60  # seconds
 NV_ALLOWED_GPUS = 'ALL'  # otherwise a list like [1, 3]. [] for none.
 NV_DEFAULT_GPU_COUNT_RESERVATION = 1
 NV_MAX_GPU_COUNT_RESERVATION = -1
+NV_MAX_GPU_COUNT_PER_USER = -1
+NV_MAX_GPU_COUNT_PER_GROUP = {}
+NV_GPU_FAIR_SHARE_HALF_LIFE = 0  # seconds, e.g., 7 * 24 * 60 * 60
 NV_GPU_UNAVAILABLE_ABOVE_MEMORY_USED = 0
+NV_GPU_UNAVAILABLE_ABOVE_UTILIZATION = -1
+NV_GPU_UNAVAILABLE_ABOVE_PROCESSES = -1
+NV_GPU_SCORE_WEIGHTS = {'mem_used': 1}
+NV_GPU_STATUS_SAMPLES = 3
+NV_GPU_STATUS_SAMPLE_INTERVAL = 0.05  # seconds
 NV_EXCLUSIVE_CONTAINER_GPU_RESERVATION = True
 NV_ALLOW_OWN_GPU_REUSE = True
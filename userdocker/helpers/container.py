@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+"""Read-only container and image queries.
+
+Queries are answered via the docker engine API if available (see
+docker_api.py), otherwise via the given docker cli executable.
+"""
+
+import json
+import logging
+from collections import defaultdict
+
+from ..config import DOCKER_QUERY_TIMEOUT
+from .docker_api import get_docker_api
+from .execute import exec_cmd
+
+
+# labels of containers started by userdocker run
+LABEL_VERSION = 'userdocker.version'
+LABEL_USER = 'userdocker.user'
+LABEL_UID = 'userdocker.uid'
+LABEL_NV_GPU = 'userdocker.nv_gpu'
+LABEL_NV_GPU_MEM = 'userdocker.nv_gpu_mem'  # declared footprint in MiB
+LABEL_NV_GPU_RESERVATION = 'userdocker.nv_gpu_reservation'
+LABEL_CPUSET = 'userdocker.cpuset'  # CPU slice (see gpu_affinity.py)
+LABEL_LIMIT_PREFIX = 'userdocker.limit.'  # + option (see limits.py)
+
+# shared state of the GPU usage by containers (see nvidia.py), needs to be
+# invalidated whenever GPUs stop being reserved otherwise
+STATE_CONTAINER_GPUS = 'container_gpu_state'
+
+
+def _get_field(data, field):
+    for key in field.split('.'):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    return data
+
+
+def container_list_running(docker):
+    """Returns the ids of all running containers."""
+    api = get_docker_api()
+    if api:
+        return [c['Id'] for c in api.containers()]
+    return exec_cmd(
+        [docker, 'ps', '-q'],
+        return_status=False,
+        loglvl=logging.DEBUG,
+        timeout=DOCKER_QUERY_TIMEOUT,
+    ).split()
+
+
+def container_list(docker, filters=(), labels=(), all_containers=False):
+    """Lists running containers, optionally filtered (like docker ps --filter).
+
+    Returns a dict per container with its 'Id', 'Name' and 'Labels', the
+    latter restricted to the given (and set) labels. With all_containers
+    stopped containers are included (like docker ps -a).
+    """
+    api = get_docker_api()
+    if api:
+        api_filters = defaultdict(list)
+        for f in filters:
+            key, _, val = f.partition('=')
+            api_filters[key].append(val)
+        res = []
+        for c in api.containers(
+                filters=api_filters, all_containers=all_containers):
+            c_labels = c.get('Labels') or {}
+            res.append({
+                'Id': c['Id'],
+                'Name': (c.get('Names') or [''])[0],
+                'Labels': {l: c_labels[l] for l in labels if l in c_labels},
+            })
+        return res
+
+    cmd = [
+        docker, 'ps', '--no-trunc', '--format',
+        '\t'.join(
+            ['{{.ID}}', '{{.Names}}']
+            + ['{{.Label "%s"}}' % l for l in labels])
+    ]
+    if all_containers:
+        cmd += ['-a']
+    for f in filters:
+        cmd += ['--filter', f]
+    out = exec_cmd(
+        cmd,
+        return_status=False,
+        loglvl=logging.DEBUG,
+        timeout=DOCKER_QUERY_TIMEOUT,
+    )
+    res = []
+    for line in out.splitlines():
+        if not line.strip():
+            continue
+        fields = line.split('\t')
+        res.append({
+            'Id': fields[0],
+            'Name': '/' + fields[1],  # same as in docker inspect
+            'Labels': {l: v for l, v in zip(labels, fields[2:]) if v},
+        })
+    return res
+
+
+def container_inspect(docker, containers, fields):
+    """Returns a {field: value} dict per found container.
+
+    Fields are inspect paths like 'Config.Env'. Containers that can't be found
+    are skipped.
+    """
+    if not containers:
+        return []
+    api = get_docker_api()
+    if api:
+        res = []
+        for container in containers:
+            data = api.inspect_container(container)
+            if data is not None:
+                res.append({f: _get_field(data, f) for f in fields})
+        return res
+
+    fmt = '{%s}' % ', '.join(
+        '%s: {{json .%s}}' % (json.dumps(f), f) for f in fields)
+    # docker inspect fails if any container is missing (e.g., exited since it
+    # was listed), but still prints the found ones
+    out = exec_cmd(
+        [docker, 'inspect', '--format', fmt] + list(containers),
+        return_status=False,
+        loglvl=logging.DEBUG,
+        timeout=DOCKER_QUERY_TIMEOUT,
+        check=False,
+    )
+    return [json.loads(line) for line in out.splitlines() if line.strip()]
+
+
+def image_available_locally(docker, image):
+    api = get_docker_api()
+    if api:
+        return api.inspect_image(image) is not None
+    return bool(exec_cmd(
+        [docker, 'images', '-q', image],
+        return_status=False,
+        loglvl=logging.DEBUG,
+        timeout=DOCKER_QUERY_TIMEOUT,
+    ).strip())
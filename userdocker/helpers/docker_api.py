@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+"""Minimal docker engine API client for userdocker's read-only queries.
+
+Running the docker cli for each internal query (e.g., which containers use
+which GPUs) is slow. Instead they're sent as HTTP requests over the docker
+daemon's UNIX socket, re-using a single keep-alive connection per process.
+The docker cli is still used for the final user facing command.
+"""
+
+import http.client
+import json
+import os
+import socket
+import threading
+from urllib.parse import quote
+from urllib.parse import urlencode
+
+from ..config import DOCKER_QUERY_TIMEOUT
+from ..config import DOCKER_SOCKET
+from .exceptions import UserDockerException
+from .logger import logger
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super(_UnixHTTPConnection, self).__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+class DockerAPI(object):
+    """Docker engine API client speaking HTTP over a UNIX socket."""
+
+    def __init__(self, socket_path, timeout=None):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def request(self, path, query=None):
+        """GETs path and returns (status, body)."""
+        url = path
+        if query:
+            url += '?' + urlencode(query)
+        with self._lock:
+            while True:
+                reused = self._conn is not None
+                if not reused:
+                    self._conn = _UnixHTTPConnection(
+                        self.socket_path, timeout=self.timeout)
+                try:
+                    self._conn.request('GET', url)
+                    resp = self._conn.getresponse()
+                    body = resp.read()
+                    break
+                except (http.client.HTTPException, OSError) as e:
+                    self.close()
+                    # the daemon might have closed a kept-alive connection,
+                    # in that case just retry once with a fresh one
+                    if not reused:
+                        raise UserDockerException(
+                            'ERROR: docker API request %s failed: %s' % (
+                                url, e))
+        logger.debug('docker API: GET %s: %d', url, resp.status)
+        return resp.status, body
+
+    def get_json(self, path, query=None):
+        """GETs path and returns the decoded JSON body (None if not found)."""
+        status, body = self.request(path, query)
+        if status == 404:
+            return None
+        try:
+            data = json.loads(body.decode('utf-8')) if body else None
+        except ValueError as e:
+            raise UserDockerException(
+                'ERROR: docker API returned invalid JSON for %s: %s' % (
+                    path, e))
+        if status >= 400:
+            msg = data.get('message') if isinstance(data, dict) else data
+            raise UserDockerException(
+                'ERROR: docker API request %s failed (%d): %s' % (
+                    path, status, msg))
+        return data
+
+    def containers(self, filters=None, all_containers=False):
+        """Lists (by default only running) containers like docker ps."""
+        query = {}
+        if all_containers:
+            query['all'] = '1'
+        if filters:
+            query['filters'] = json.dumps(filters)
+        return self.get_json('/containers/json', query) or []
+
+    def inspect_container(self, container):
+        """Returns the inspect dict of the container (None if not found)."""
+        return self.get_json('/containers/%s/json' % quote(container, safe=''))
+
+    def inspect_image(self, image):
+        """Returns the inspect dict of the image (None if not found)."""
+        return self.get_json('/images/%s/json' % quote(image, safe='/:@'))
+
+
+_docker_api = None
+
+
+def get_docker_api():
+    """Returns the shared DockerAPI client (None if disabled or missing)."""
+    global _docker_api
+    if _docker_api is None:
+        if not DOCKER_SOCKET or not os.path.exists(DOCKER_SOCKET):
+            logger.debug(
+                'docker API socket %r not available, using docker cli',
+                DOCKER_SOCKET)
+            return None
+        _docker_api = DockerAPI(DOCKER_SOCKET, timeout=DOCKER_QUERY_TIMEOUT)
+    return _docker_api
@@ -3,3 +3,17 @@
 
 class UserDockerException(Exception):
     pass
+
+
+class ParallelTimeoutError(UserDockerException):
+    def __init__(self, pending, timeout):
+        super(ParallelTimeoutError, self).__init__(
+            'ERROR: %d call(s) did not finish within %.1f seconds' % (
+                len(pending), timeout))
+        self.pending = pending
+        self.timeout = timeout
+
+
+class GPUsUnavailableException(UserDockerException):
+    """The requested GPUs are currently not available (might change)."""
+    pass
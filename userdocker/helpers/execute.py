@@ -6,11 +6,12 @@ from shlex import quote
 import subprocess
 import sys
 
+from ..config import EXEC_IN_PLACE
 from .exceptions import UserDockerException
 from .logger import logger
 
 
-def exec_cmd(cmd, dry_run=False, return_status=True, loglvl=logging.INFO):
+def _log_and_check_cmd(cmd, dry_run, loglvl):
     logger.log(
         loglvl,
         '%s command: %s',
@@ -19,24 +20,58 @@ def exec_cmd(cmd, dry_run=False, return_status=True, loglvl=logging.INFO):
     )
     logger.debug('internal repr: %s', cmd)
 
-    if dry_run:
-        return 0
-
-    if not os.path.exists(cmd[0]):
+    if not dry_run and not os.path.exists(cmd[0]):
         raise UserDockerException(
             "ERROR: can't find executable: %s" % cmd[0]
         )
 
+
+def exec_cmd(
+        cmd, dry_run=False, return_status=True, loglvl=logging.INFO,
+        timeout=None, check=True):
+    """Executes cmd, exits with its exit code if it fails.
+
+    With check=False a failing cmd's status (or output) is returned instead.
+    """
+    _log_and_check_cmd(cmd, dry_run, loglvl)
+    if dry_run:
+        return 0
+
     try:
         if return_status:
-            ret = subprocess.check_call(cmd)
+            ret = subprocess.check_call(cmd, timeout=timeout)
         else:
-            ret = subprocess.check_output(cmd, universal_newlines=True)
+            ret = subprocess.check_output(
+                cmd, universal_newlines=True, timeout=timeout)
         return ret
+    except subprocess.TimeoutExpired:
+        raise UserDockerException(
+            "ERROR: command didn't finish within %s seconds: %s" % (
+                timeout, ' '.join([quote(c) for c in cmd]))
+        )
     except subprocess.CalledProcessError as e:
         ret = e.returncode
+        if not check:
+            return ret if return_status else e.output
         sys.exit(ret)
 
 
+def exec_cmd_in_place(cmd, loglvl=logging.INFO):
+    """Replaces the current process with cmd (never returns).
+
+    As cmd then is the process itself, it directly receives all signals
+    (e.g., Ctrl+C, SIGWINCH) and its exit code is the exit code of the
+    invocation.
+    """
+    _log_and_check_cmd(cmd, False, loglvl)
+    # make sure nothing we printed so far gets lost
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execv(cmd[0], cmd)
+
+
 def exit_exec_cmd(cmd, dry_run=False):
+    """Executes the final (user facing) cmd and exits with its exit code."""
+    if EXEC_IN_PLACE and not dry_run:
+        exec_cmd_in_place(cmd)
     sys.exit(exec_cmd(cmd, dry_run=dry_run))
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+"""CPU and memory (NUMA) affinity of GPUs to pin containers to.
+
+Each GPU is attached to the PCIe root complex of one CPU socket (NUMA node).
+sysfs exposes the NUMA node (numa_node) and the CPUs local to it
+(local_cpulist) for each PCI device. If NV_GPU_CPU_AFFINITY is set, run pins
+nvidia-docker containers to the CPUs and memory of their GPUs' NUMA nodes
+(--cpuset-cpus, --cpuset-mems), so their host threads (e.g., data loaders)
+and memory don't end up on the other socket.
+
+If NV_GPU_CPUS_PER_GPU is > 0, containers get disjoint slices of that many
+CPUs local to each of their GPUs instead. The CPUs of a slice are recorded in
+the GPU reservation ledger and as container label, so concurrent containers
+on the same socket get different CPUs.
+"""
+
+import os
+from collections import namedtuple
+
+from ..config import NV_GPU_CPUS_PER_GPU
+from ..config import NV_GPU_PROBE_TIMEOUT
+from ..config import NV_GPU_TOPOLOGY_CACHE_TTL
+from .container import LABEL_CPUSET
+from .container import container_list
+from .exceptions import UserDockerException
+from .gpu_backend import get_gpu_backend
+from .logger import logger
+from .nvidia import nvidia_get_mig_devices
+from .statefile import cached_state
+
+
+STATE_GPU_AFFINITY = 'gpu_affinity'
+
+SYSFS_PCI_DEVICES = '/sys/bus/pci/devices'
+
+# numa_node: None if unknown (or not a NUMA system), cpus: sorted CPU ids
+GPUAffinity = namedtuple('GPUAffinity', ['numa_node', 'cpus'])
+
+# cpus and mems: lists of CPU and NUMA node ids, exclusive: if cpus is a
+# disjoint slice (see NV_GPU_CPUS_PER_GPU)
+CPUSet = namedtuple('CPUSet', ['cpus', 'mems', 'exclusive'])
+
+
+def parse_cpulist(s):
+    """Parses a CPU list (like 0-3,8,10-11) into a sorted list of ids."""
+    cpus = set()
+    for part in s.strip().split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return sorted(cpus)
+
+
+def format_cpulist(cpus):
+    """Formats CPU (or NUMA node) ids as list with ranges (like 0-3,8)."""
+    ranges = []
+    for cpu in sorted(set(cpus)):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(
+        '%d' % first if first == last else '%d-%d' % (first, last)
+        for first, last in ranges)
+
+
+def read_gpu_affinity(pci_bus_ids, devices=SYSFS_PCI_DEVICES):
+    """Returns [(gpu, numa_node, cpus)] from sysfs for {gpu: PCI bus id}."""
+    res = []
+    for gpu, bus_id in sorted(pci_bus_ids.items()):
+        path = os.path.join(devices, bus_id)
+        try:
+            with open(os.path.join(path, 'numa_node')) as f:
+                numa_node = int(f.read())
+            with open(os.path.join(path, 'local_cpulist')) as f:
+                cpus = parse_cpulist(f.read())
+        except (OSError, ValueError) as e:
+            raise UserDockerException(
+                'ERROR: could not read affinity of GPU %d from %s: %s' % (
+                    gpu, path, e))
+        # -1: no NUMA (or not known by the firmware)
+        res.append((gpu, numa_node if numa_node >= 0 else None, cpus))
+    return res
+
+
+def nvidia_get_gpu_affinity():
+    """Returns {gpu: GPUAffinity}, {} if the affinity can't be determined.
+
+    As it only changes with the hardware, the result is shared between
+    invocations for NV_GPU_TOPOLOGY_CACHE_TTL seconds.
+    """
+    try:
+        affinity = cached_state(
+            STATE_GPU_AFFINITY,
+            NV_GPU_TOPOLOGY_CACHE_TTL,
+            lambda: read_gpu_affinity(get_gpu_backend().pci_bus_ids()),
+            lock_timeout=NV_GPU_PROBE_TIMEOUT,
+        )
+    except UserDockerException as e:
+        logger.warning('GPU CPU affinity not available: %s', e)
+        return {}
+    return {gpu: GPUAffinity(node, cpus) for gpu, node, cpus in affinity}
+
+
+def cpus_in_use(docker, reservations=()):
+    """Returns the CPUs of slices of containers and pending reservations."""
+    cpus = set()
+    for c in container_list(
+            docker,
+            filters=['label=' + LABEL_CPUSET],
+            labels=[LABEL_CPUSET],
+    ):
+        try:
+            cpus.update(parse_cpulist(c['Labels'].get(LABEL_CPUSET, '')))
+        except ValueError:
+            logger.warning(
+                'Ignoring invalid %s label of container %s',
+                LABEL_CPUSET, c['Id'])
+    for r in reservations:
+        cpus.update(r.get('cpus') or [])
+    return cpus
+
+
+def nvidia_gpu_cpuset(docker, gpus, reservations=()):
+    """Returns the CPUSet to pin a container using gpus to (None if unknown).
+
+    gpus can contain GPU indices and MIG UUIDs. If NV_GPU_CPUS_PER_GPU > 0 a
+    disjoint slice of unused CPUs local to each GPU is selected. If there
+    aren't enough unused CPUs, all local CPUs are shared.
+    """
+    affinity = nvidia_get_gpu_affinity()
+    if any(not isinstance(gpu, int) for gpu in gpus):
+        mig_gpu = {d.uuid: d.gpu for d in nvidia_get_mig_devices()}
+        gpus = [mig_gpu.get(gpu, gpu) for gpu in gpus]
+    if not gpus or any(gpu not in affinity for gpu in gpus):
+        logger.debug('CPU affinity of GPUs %r not known', gpus)
+        return None
+
+    local_cpus = sorted(set(
+        cpu for gpu in gpus for cpu in affinity[gpu].cpus))
+    mems = sorted(set(
+        affinity[gpu].numa_node for gpu in gpus
+        if affinity[gpu].numa_node is not None))
+    if NV_GPU_CPUS_PER_GPU <= 0 or not local_cpus:
+        return CPUSet(local_cpus, mems, False)
+
+    used = cpus_in_use(docker, reservations)
+    cpus = []
+    for gpu in gpus:
+        free = [
+            cpu for cpu in affinity[gpu].cpus
+            if cpu not in used and cpu not in cpus
+        ]
+        if len(free) < NV_GPU_CPUS_PER_GPU:
+            logger.warning(
+                'Only %d unused CPUs local to GPU %d, sharing its local CPUs '
+                'instead of a slice of %d', len(free), gpu,
+                NV_GPU_CPUS_PER_GPU)
+            return CPUSet(local_cpus, mems, False)
+        cpus += free[:NV_GPU_CPUS_PER_GPU]
+    return CPUSet(sorted(cpus), mems, True)
@@ -0,0 +1,833 @@
+# -*- coding: utf-8 -*-
+
+"""Backends to query the GPU status and topology.
+
+- NVMLBackend queries NVML (libnvidia-ml, which nvidia-smi uses internally)
+  directly via ctypes in-process, which is a lot faster than forking
+  nvidia-smi.
+- NvidiaSmiBackend runs nvidia-smi and parses its (machine readable) CSV
+  output. It's the fallback if NVML can't be loaded.
+
+Both return a list of GPUInfo tuples (gpus()), the interconnect level of all
+GPU pairs (topology()), the running compute processes as list of
+GPUProcess tuples (compute_processes()), health attributes as list of
+GPUHealth tuples (health()), the MIG instances as list of MIGDevice tuples
+(mig_devices()) and the PCI bus ids of the GPUs (pci_bus_ids()). See
+get_gpu_backend() and the NV_GPU_BACKEND config var for how the backend is
+chosen.
+"""
+
+import ctypes
+import logging
+import re
+import time
+from collections import defaultdict
+from collections import namedtuple
+
+from ..config import NVIDIA_SMI
+from ..config import NVML_LIB
+from ..config import NV_GPU_BACKEND
+from ..config import NV_GPU_PROBE_TIMEOUT
+from .exceptions import UserDockerException
+from .execute import exec_cmd
+from .logger import logger
+
+
+# mem_used and mem_total in MiB, utilization in % (None if not supported),
+# processes: number of compute processes (None if not queried)
+GPUInfo = namedtuple(
+    'GPUInfo',
+    ['index', 'uuid', 'mem_used', 'mem_total', 'utilization', 'processes'])
+
+# gpu: index of the GPU, mem_used in MiB (None if not available)
+GPUProcess = namedtuple('GPUProcess', ['gpu', 'pid', 'mem_used'])
+
+# Health attributes of a GPU (each None if not supported / available):
+# - throttle_reasons: list of active clock throttle reasons (THROTTLE_REASONS)
+# - ecc_errors: uncorrected (volatile) ECC errors since the driver was loaded
+# - retired_pages_pending: if page retirements wait for a GPU reset
+# - retired_pages: number of pages retired due to double bit ECC errors
+# - persistence_mode: if persistence mode is enabled
+# - pcie_gen, pcie_gen_max, pcie_width, pcie_width_max: current and max PCIe
+#   link generation and width
+GPUHealth = namedtuple(
+    'GPUHealth',
+    ['index', 'throttle_reasons', 'ecc_errors', 'retired_pages_pending',
+     'retired_pages', 'persistence_mode', 'pcie_gen', 'pcie_gen_max',
+     'pcie_width', 'pcie_width_max'])
+
+# MIG (multi-instance GPU) device: its uuid (MIG-...), the index of its
+# GPU and its profile (e.g., 1g.5gb)
+MIGDevice = namedtuple('MIGDevice', ['uuid', 'gpu', 'profile'])
+
+# clock throttle reason bits (as in NVML / nvidia-smi)
+THROTTLE_REASONS = (
+    (0x1, 'gpu_idle'),
+    (0x2, 'applications_clocks_setting'),
+    (0x4, 'sw_power_cap'),
+    (0x8, 'hw_slowdown'),
+    (0x10, 'sync_boost'),
+    (0x20, 'sw_thermal_slowdown'),
+    (0x40, 'hw_thermal_slowdown'),
+    (0x80, 'hw_power_brake_slowdown'),
+    (0x100, 'display_clock_setting'),
+)
+
+_MIB = 1024 * 1024
+
+# GPU interconnect levels (as in nvidia-smi topo -m), best first:
+# - NV: NVLink
+# - PIX: at most a single PCIe switch
+# - PXB: multiple PCIe switches (without the PCIe host bridge)
+# - PHB: PCIe host bridge (same CPU)
+# - NODE: interconnect between PCIe host bridges within a NUMA node
+# - SYS: across NUMA nodes (e.g., QPI / UPI / SMP interconnect)
+TOPOLOGY_LEVELS = ('NV', 'PIX', 'PXB', 'PHB', 'NODE', 'SYS')
+
+_ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;]*m')
+_GPU_LIST_GPU = re.compile(r'^GPU (\d+):')
+_GPU_LIST_MIG = re.compile(
+    r'^\s+MIG\s+(\S+)\s+Device\s+\d+:\s*\(UUID:\s*([^\s)]+)\)')
+_MIG_PROFILE = re.compile(r'\bMIG\s+(\S+)')
+_PCI_BUS_ID = re.compile(
+    r'^(\d+),\s*([0-9a-fA-F]+):([0-9a-fA-F]+):([0-9a-fA-F]+)\.([0-7])$')
+
+
+def _average(values):
+    values = [v for v in values if v is not None]
+    return sum(values) / len(values) if values else None
+
+
+def _sample(sample_once, samples, interval, processes):
+    """Calls sample_once(processes) samples times and averages the results.
+
+    Memory used and utilization are averaged, the number of processes is only
+    queried in the last sample.
+    """
+    gpu_samples = defaultdict(list)
+    for i in range(samples):
+        if i:
+            time.sleep(interval)
+        for gpu in sample_once(processes and i == samples - 1):
+            gpu_samples[gpu.index].append(gpu)
+    res = []
+    for index, gs in sorted(gpu_samples.items()):
+        if len(gs) == 1:
+            res.append(gs[0])
+            continue
+        res.append(gs[-1]._replace(
+            mem_used=_average(g.mem_used for g in gs),
+            utilization=_average(g.utilization for g in gs),
+        ))
+    return res
+
+
+def _parse_optional_int(s, base=10):
+    s = s.strip()
+    try:
+        return int(s, base)
+    except ValueError:
+        # e.g., [N/A] or [Not Supported]
+        return None
+
+
+def _parse_optional_bool(s, true, false):
+    return {true: True, false: False}.get(s.strip())
+
+
+def sysfs_pci_bus_id(domain, bus, device, function=0):
+    """Returns a PCI bus id as in /sys/bus/pci/devices (e.g., 0000:3b:00.0)."""
+    return '%04x:%02x:%02x.%x' % (domain, bus, device, function)
+
+
+def throttle_reason_names(mask):
+    if mask is None:
+        return None
+    return [name for bit, name in THROTTLE_REASONS if mask & bit]
+
+
+class NvidiaSmiBackend(object):
+    name = 'nvidia-smi'
+    query_fields = ('index', 'uuid', 'memory.used', 'memory.total',
+                    'utilization.gpu')
+
+    def __init__(self, nvidia_smi=NVIDIA_SMI, timeout=NV_GPU_PROBE_TIMEOUT):
+        self.nvidia_smi = nvidia_smi
+        self.timeout = timeout
+
+    def gpus(self, samples=1, interval=0., processes=False):
+        """Returns a list of GPUInfo (a single sample).
+
+        Each sample would run nvidia-smi (and sleep in between), so more
+        samples are only taken via NVML.
+        """
+        return _sample(self._gpus, 1, interval, processes)
+
+    def _nvidia_smi_csv(self, query):
+        return exec_cmd(
+            [self.nvidia_smi, query, '--format=csv,noheader,nounits'],
+            return_status=False,
+            loglvl=logging.DEBUG,
+            timeout=self.timeout,
+        )
+
+    def _compute_apps(self):
+        """Returns a list of (gpu uuid, pid, MiB used) of compute processes."""
+        out = self._nvidia_smi_csv(
+            '--query-compute-apps=gpu_uuid,pid,used_memory')
+        res = []
+        for line in out.splitlines():
+            if not line.strip():
+                continue
+            fields = [f.strip() for f in line.split(',')]
+            try:
+                res.append((
+                    fields[0],
+                    int(fields[1]),
+                    _parse_optional_int(fields[2]) if len(fields) > 2
+                    else None,
+                ))
+            except (IndexError, ValueError):
+                raise UserDockerException(
+                    'ERROR: unexpected nvidia-smi output: %s' % line)
+        return res
+
+    def _process_counts(self):
+        """Returns {gpu uuid: number of compute processes}."""
+        counts = defaultdict(int)
+        for uuid, _, _ in self._compute_apps():
+            counts[uuid] += 1
+        return counts
+
+    def compute_processes(self):
+        """Returns a list of GPUProcess of all running compute processes."""
+        out = self._nvidia_smi_csv('--query-gpu=index,uuid')
+        uuid_index = {}
+        for line in out.splitlines():
+            if line.strip():
+                index, _, uuid = line.partition(',')
+                uuid_index[uuid.strip()] = int(index)
+        return [
+            GPUProcess(uuid_index[uuid], pid, mem_used)
+            for uuid, pid, mem_used in self._compute_apps()
+            if uuid in uuid_index
+        ]
+
+    def _gpus(self, processes=False):
+        out = self._nvidia_smi_csv('--query-gpu=' + ','.join(self.query_fields))
+        logger.debug('nvidia-smi gpu status:\n%s', out)
+        process_counts = self._process_counts() if processes else None
+        res = []
+        for line in out.splitlines():
+            if not line.strip():
+                continue
+            fields = [f.strip() for f in line.split(',')]
+            if len(fields) != len(self.query_fields):
+                raise UserDockerException(
+                    'ERROR: unexpected nvidia-smi output: %s' % line)
+            index, uuid, mem_used, mem_total, utilization = fields
+            try:
+                res.append(GPUInfo(
+                    int(index),
+                    uuid,
+                    int(mem_used),
+                    _parse_optional_int(mem_total),
+                    _parse_optional_int(utilization),
+                    process_counts.get(uuid, 0) if processes else None,
+                ))
+            except ValueError:
+                raise UserDockerException(
+                    'ERROR: unexpected nvidia-smi output: %s' % line)
+        return res
+
+    health_fields = (
+        'index', 'clocks_throttle_reasons.active',
+        'ecc.errors.uncorrected.volatile.total', 'retired_pages.pending',
+        'retired_pages.double_bit.count', 'persistence_mode',
+        'pcie.link.gen.current', 'pcie.link.gen.max',
+        'pcie.link.width.current', 'pcie.link.width.max')
+
+    def health(self):
+        """Returns a list of GPUHealth."""
+        out = self._nvidia_smi_csv(
+            '--query-gpu=' + ','.join(self.health_fields))
+        logger.debug('nvidia-smi gpu health:\n%s', out)
+        res = []
+        for line in out.splitlines():
+            if not line.strip():
+                continue
+            fields = [f.strip() for f in line.split(',')]
+            if len(fields) != len(self.health_fields):
+                raise UserDockerException(
+                    'ERROR: unexpected nvidia-smi output: %s' % line)
+            try:
+                index = int(fields[0])
+            except ValueError:
+                raise UserDockerException(
+                    'ERROR: unexpected nvidia-smi output: %s' % line)
+            res.append(GPUHealth(
+                index,
+                throttle_reason_names(_parse_optional_int(fields[1], 16)),
+                _parse_optional_int(fields[2]),
+                _parse_optional_bool(fields[3], 'Yes', 'No'),
+                _parse_optional_int(fields[4]),
+                _parse_optional_bool(fields[5], 'Enabled', 'Disabled'),
+                *[_parse_optional_int(f) for f in fields[6:]]
+            ))
+        return res
+
+    def pci_bus_ids(self):
+        """Returns {gpu: PCI bus id} (see sysfs_pci_bus_id)."""
+        out = self._nvidia_smi_csv('--query-gpu=index,pci.bus_id')
+        logger.debug('nvidia-smi gpu pci bus ids:\n%s', out)
+        res = {}
+        for line in out.splitlines():
+            if not line.strip():
+                continue
+            # e.g., 3, 00000000:3B:00.0 (domain with 8 hex digits)
+            m = _PCI_BUS_ID.match(line.strip())
+            if not m:
+                raise UserDockerException(
+                    'ERROR: unexpected nvidia-smi output: %s' % line)
+            res[int(m.group(1))] = sysfs_pci_bus_id(
+                *[int(g, 16) for g in m.groups()[1:]])
+        return res
+
+    def mig_devices(self):
+        """Returns a list of MIGDevice."""
+        out = exec_cmd(
+            [self.nvidia_smi, '-L'],
+            return_status=False,
+            loglvl=logging.DEBUG,
+            timeout=self.timeout,
+        )
+        logger.debug('nvidia-smi gpu list:\n%s', out)
+        return parse_gpu_list(out)
+
+    def topology(self):
+        out = exec_cmd(
+            [self.nvidia_smi, 'topo', '-m'],
+            return_status=False,
+            loglvl=logging.DEBUG,
+            timeout=self.timeout,
+        )
+        logger.debug('nvidia-smi topology:\n%s', out)
+        return parse_topology_matrix(out)
+
+
+def _topology_level(s):
+    if s.startswith('NV') and s[2:].isdigit():
+        # NV# means bonded set of # NVLinks
+        return 'NV'
+    if s == 'SOC':
+        # old name of SYS
+        return 'SYS'
+    return s
+
+
+def parse_gpu_list(out):
+    """Parses the output of nvidia-smi -L into a list of MIGDevice."""
+    res = []
+    gpu = None
+    for line in out.splitlines():
+        m = _GPU_LIST_GPU.match(line)
+        if m:
+            gpu = int(m.group(1))
+            continue
+        m = _GPU_LIST_MIG.match(line)
+        if m:
+            if gpu is None:
+                raise UserDockerException(
+                    'ERROR: unexpected nvidia-smi -L output: %s' % line)
+            res.append(MIGDevice(m.group(2), gpu, m.group(1)))
+    return res
+
+
+def parse_topology_matrix(out):
+    """Parses the output of nvidia-smi topo -m into {(gpu, gpu): level}."""
+    lines = [
+        _ANSI_ESCAPE.sub('', l).rstrip() for l in out.splitlines()
+        if l.strip()
+    ]
+    if not lines:
+        raise UserDockerException('ERROR: empty nvidia-smi topology output')
+    header = lines[0].split()
+    # the device columns (GPUs, NICs) come before CPU Affinity, ...
+    devices = []
+    for col in header:
+        if col in ('CPU', 'NUMA', 'GPU') or not re.match(r'^[\w-]+\d+$', col):
+            break
+        devices.append(col)
+    gpu_cols = [
+        (i, int(d[3:])) for i, d in enumerate(devices)
+        if re.match(r'^GPU\d+$', d)
+    ]
+    topology = {}
+    for line in lines[1:]:
+        fields = line.split()
+        if not fields or not re.match(r'^GPU\d+$', fields[0]):
+            continue
+        gpu = int(fields[0][3:])
+        levels = fields[1:1 + len(devices)]
+        if len(levels) != len(devices):
+            raise UserDockerException(
+                'ERROR: unexpected nvidia-smi topology output: %s' % line)
+        for i, other in gpu_cols:
+            level = _topology_level(levels[i])
+            if other == gpu:
+                continue
+            if level not in TOPOLOGY_LEVELS:
+                raise UserDockerException(
+                    'ERROR: unknown GPU topology level: %s' % levels[i])
+            topology[(gpu, other)] = level
+    return topology
+
+
+class _NVMLMemory(ctypes.Structure):
+    _fields_ = [
+        ('total', ctypes.c_ulonglong),
+        ('free', ctypes.c_ulonglong),
+        ('used', ctypes.c_ulonglong),
+    ]
+
+
+class _NVMLProcessInfo(ctypes.Structure):
+    # nvmlProcessInfo_v1_t of the unversioned function
+    _fields_ = [
+        ('pid', ctypes.c_uint),
+        ('usedGpuMemory', ctypes.c_ulonglong),
+    ]
+
+
+class _NVMLPciInfo(ctypes.Structure):
+    # nvmlPciInfo_t of the _v3 function
+    _fields_ = [
+        ('busIdLegacy', ctypes.c_char * 16),
+        ('domain', ctypes.c_uint),
+        ('bus', ctypes.c_uint),
+        ('device', ctypes.c_uint),
+        ('pciDeviceId', ctypes.c_uint),
+        ('pciSubSystemId', ctypes.c_uint),
+        ('busId', ctypes.c_char * 32),
+    ]
+
+
+class _NVMLUtilization(ctypes.Structure):
+    _fields_ = [
+        ('gpu', ctypes.c_uint),
+        ('memory', ctypes.c_uint),
+    ]
+
+
+class NVMLLibrary(object):
+    """Thin python wrapper around the few NVML functions we need.
+
+    NVMLBackend only uses the methods of this class, so tests can inject a
+    stub with the same methods instead of loading a (fake) shared library.
+    """
+    NVML_SUCCESS = 0
+    NVML_ERROR_NOT_FOUND = 6
+    NVML_ERROR_NOT_SUPPORTED = 3
+    NVML_ERROR_INSUFFICIENT_SIZE = 7
+    NVML_P2P_CAPS_INDEX_NVLINK = 3
+    NVML_P2P_STATUS_OK = 0
+    NVML_VALUE_NOT_AVAILABLE = 2 ** 64 - 1
+    NVML_MEMORY_ERROR_TYPE_UNCORRECTED = 1
+    NVML_VOLATILE_ECC = 0
+    NVML_PAGE_RETIREMENT_CAUSE_DBE = 1
+    # nvmlGpuTopologyLevel_t: level
+    NVML_TOPOLOGY_LEVELS = {
+        0: 'PIX',  # internal (e.g., multi-GPU boards)
+        10: 'PIX',
+        20: 'PXB',
+        30: 'PHB',
+        40: 'NODE',
+        50: 'SYS',
+    }
+
+    def __init__(self, lib_name=NVML_LIB):
+        try:
+            self._lib = ctypes.CDLL(lib_name)
+        except OSError as e:
+            raise UserDockerException(
+                'ERROR: could not load NVML (%s): %s' % (lib_name, e))
+        self._func('nvmlErrorString').restype = ctypes.c_char_p
+
+    def _check(self, ret, func):
+        if ret != self.NVML_SUCCESS:
+            raise UserDockerException('ERROR: NVML %s failed: %s' % (
+                func, self._lib.nvmlErrorString(ret).decode(errors='replace')))
+
+    def _func(self, func):
+        try:
+            return getattr(self._lib, func)
+        except AttributeError as e:
+            # e.g., older driver versions
+            raise UserDockerException('ERROR: NVML %s not found: %s' % (
+                func, e))
+
+    def _call(self, func, *args):
+        self._check(self._func(func)(*args), func)
+
+    def init(self):
+        self._call('nvmlInit_v2')
+
+    def shutdown(self):
+        self._call('nvmlShutdown')
+
+    def device_count(self):
+        count = ctypes.c_uint()
+        self._call('nvmlDeviceGetCount_v2', ctypes.byref(count))
+        return count.value
+
+    def device_handle(self, index):
+        handle = ctypes.c_void_p()
+        self._call(
+            'nvmlDeviceGetHandleByIndex_v2',
+            ctypes.c_uint(index), ctypes.byref(handle))
+        return handle
+
+    def device_name(self, handle):
+        buf = ctypes.create_string_buffer(96)
+        self._call('nvmlDeviceGetName', handle, buf, ctypes.c_uint(len(buf)))
+        return buf.value.decode()
+
+    def device_mig_handles(self, handle):
+        """Returns the handles of the MIG devices of a GPU ([] if none)."""
+        current, pending = ctypes.c_uint(), ctypes.c_uint()
+        ret = self._func('nvmlDeviceGetMigMode')(
+            handle, ctypes.byref(current), ctypes.byref(pending))
+        if ret == self.NVML_ERROR_NOT_SUPPORTED:
+            return []
+        self._check(ret, 'nvmlDeviceGetMigMode')
+        if not current.value:
+            return []
+        count = ctypes.c_uint()
+        self._call(
+            'nvmlDeviceGetMaxMigDeviceCount', handle, ctypes.byref(count))
+        res = []
+        for i in range(count.value):
+            mig_handle = ctypes.c_void_p()
+            ret = self._func('nvmlDeviceGetMigDeviceHandleByIndex')(
+                handle, ctypes.c_uint(i), ctypes.byref(mig_handle))
+            if ret == self.NVML_ERROR_NOT_FOUND:
+                # unused slot
+                continue
+            self._check(ret, 'nvmlDeviceGetMigDeviceHandleByIndex')
+            res.append(mig_handle)
+        return res
+
+    def device_uuid(self, handle):
+        buf = ctypes.create_string_buffer(96)
+        self._call('nvmlDeviceGetUUID', handle, buf, ctypes.c_uint(len(buf)))
+        return buf.value.decode()
+
+    def device_pci_bus_id(self, handle):
+        """Returns the PCI bus id (see sysfs_pci_bus_id)."""
+        info = _NVMLPciInfo()
+        self._call('nvmlDeviceGetPciInfo_v3', handle, ctypes.byref(info))
+        return sysfs_pci_bus_id(info.domain, info.bus, info.device)
+
+    def device_memory(self, handle):
+        """Returns (used, total) in bytes."""
+        mem = _NVMLMemory()
+        self._call('nvmlDeviceGetMemoryInfo', handle, ctypes.byref(mem))
+        return mem.used, mem.total
+
+    def device_utilization(self, handle):
+        """Returns the GPU utilization in % (None if not supported)."""
+        util = _NVMLUtilization()
+        ret = self._func('nvmlDeviceGetUtilizationRates')(
+            handle, ctypes.byref(util))
+        if ret == self.NVML_ERROR_NOT_SUPPORTED:
+            return None
+        self._check(ret, 'nvmlDeviceGetUtilizationRates')
+        return util.gpu
+
+    def device_process_count(self, handle):
+        """Returns the number of compute processes (None if not supported)."""
+        count = ctypes.c_uint(0)
+        # with a buffer of size 0, NVML just tells us the required size
+        ret = self._func('nvmlDeviceGetComputeRunningProcesses')(
+            handle, ctypes.byref(count), None)
+        if ret == self.NVML_ERROR_NOT_SUPPORTED:
+            return None
+        if ret != self.NVML_ERROR_INSUFFICIENT_SIZE:
+            self._check(ret, 'nvmlDeviceGetComputeRunningProcesses')
+        return count.value
+
+    def device_processes(self, handle):
+        """Returns a list of (pid, bytes used or None) of compute processes."""
+        func = 'nvmlDeviceGetComputeRunningProcesses'
+        count = ctypes.c_uint(0)
+        while True:
+            # processes might start between asking for the size and the call
+            infos = (_NVMLProcessInfo * (count.value + 4))()
+            count = ctypes.c_uint(len(infos))
+            ret = self._func(func)(handle, ctypes.byref(count), infos)
+            if ret == self.NVML_ERROR_NOT_SUPPORTED:
+                return []
+            if ret != self.NVML_ERROR_INSUFFICIENT_SIZE:
+                break
+        self._check(ret, func)
+        na = self.NVML_VALUE_NOT_AVAILABLE
+        return [
+            (info.pid, info.usedGpuMemory if info.usedGpuMemory != na else None)
+            for info in infos[:count.value]
+        ]
+
+    def _optional_value(self, func, handle, ctype, *args):
+        """Calls func(handle, *args, &value), returns None if not supported."""
+        value = ctype()
+        ret = self._func(func)(handle, *(args + (ctypes.byref(value),)))
+        if ret == self.NVML_ERROR_NOT_SUPPORTED:
+            return None
+        self._check(ret, func)
+        return value.value
+
+    def device_health(self, handle):
+        """Returns a dict with the GPUHealth fields (except index)."""
+        throttle_mask = self._optional_value(
+            'nvmlDeviceGetCurrentClocksThrottleReasons', handle,
+            ctypes.c_ulonglong)
+        retired_pages = ctypes.c_uint(0)
+        ret = self._func('nvmlDeviceGetRetiredPages')(
+            handle, ctypes.c_int(self.NVML_PAGE_RETIREMENT_CAUSE_DBE),
+            ctypes.byref(retired_pages), None)
+        if ret not in (self.NVML_SUCCESS, self.NVML_ERROR_INSUFFICIENT_SIZE):
+            if ret != self.NVML_ERROR_NOT_SUPPORTED:
+                self._check(ret, 'nvmlDeviceGetRetiredPages')
+            retired_pages = None
+        else:
+            retired_pages = retired_pages.value
+        pending = self._optional_value(
+            'nvmlDeviceGetRetiredPagesPendingStatus', handle, ctypes.c_int)
+        persistence = self._optional_value(
+            'nvmlDeviceGetPersistenceMode', handle, ctypes.c_int)
+        return {
+            'throttle_reasons': throttle_reason_names(throttle_mask),
+            'ecc_errors': self._optional_value(
+                'nvmlDeviceGetTotalEccErrors', handle, ctypes.c_ulonglong,
+                ctypes.c_int(self.NVML_MEMORY_ERROR_TYPE_UNCORRECTED),
+                ctypes.c_int(self.NVML_VOLATILE_ECC)),
+            'retired_pages_pending': bool(pending)
+            if pending is not None else None,
+            'retired_pages': retired_pages,
+            'persistence_mode': bool(persistence)
+            if persistence is not None else None,
+            'pcie_gen': self._optional_value(
+                'nvmlDeviceGetCurrPcieLinkGeneration', handle, ctypes.c_uint),
+            'pcie_gen_max': self._optional_value(
+                'nvmlDeviceGetMaxPcieLinkGeneration', handle, ctypes.c_uint),
+            'pcie_width': self._optional_value(
+                'nvmlDeviceGetCurrPcieLinkWidth', handle, ctypes.c_uint),
+            'pcie_width_max': self._optional_value(
+                'nvmlDeviceGetMaxPcieLinkWidth', handle, ctypes.c_uint),
+        }
+
+    def device_topology_level(self, handle1, handle2):
+        """Returns the interconnect level (see TOPOLOGY_LEVELS) of 2 GPUs."""
+        status = ctypes.c_int()
+        ret = self._func('nvmlDeviceGetP2PStatus')(
+            handle1, handle2, ctypes.c_int(self.NVML_P2P_CAPS_INDEX_NVLINK),
+            ctypes.byref(status))
+        if ret != self.NVML_ERROR_NOT_SUPPORTED:
+            self._check(ret, 'nvmlDeviceGetP2PStatus')
+            if status.value == self.NVML_P2P_STATUS_OK:
+                return 'NV'
+        level = ctypes.c_int()
+        self._call(
+            'nvmlDeviceGetTopologyCommonAncestor',
+            handle1, handle2, ctypes.byref(level))
+        try:
+            return self.NVML_TOPOLOGY_LEVELS[level.value]
+        except KeyError:
+            raise UserDockerException(
+                'ERROR: unknown NVML topology level: %d' % level.value)
+
+
+class NVMLBackend(object):
+    name = 'nvml'
+
+    def __init__(self, lib=None):
+        self.lib = lib if lib is not None else NVMLLibrary()
+
+    def gpus(self, samples=1, interval=0., processes=False):
+        """Returns a list of GPUInfo (averaged over samples)."""
+        lib = self.lib
+        lib.init()
+        try:
+            handles = [
+                lib.device_handle(index)
+                for index in range(lib.device_count())
+            ]
+            uuids = [lib.device_uuid(handle) for handle in handles]
+
+            def sample_once(with_processes):
+                res = []
+                for index, (handle, uuid) in enumerate(zip(handles, uuids)):
+                    mem_used, mem_total = lib.device_memory(handle)
+                    res.append(GPUInfo(
+                        index,
+                        uuid,
+                        mem_used // _MIB,
+                        mem_total // _MIB,
+                        lib.device_utilization(handle),
+                        lib.device_process_count(handle)
+                        if with_processes else None,
+                    ))
+                return res
+
+            res = _sample(sample_once, samples, interval, processes)
+        finally:
+            lib.shutdown()
+        logger.debug('NVML gpu status: %s', res)
+        return res
+
+    def topology(self):
+        lib = self.lib
+        lib.init()
+        try:
+            handles = [
+                lib.device_handle(index)
+                for index in range(lib.device_count())
+            ]
+            topology = {}
+            for i, h1 in enumerate(handles):
+                for j, h2 in enumerate(handles[i + 1:], i + 1):
+                    topology[(i, j)] = topology[(j, i)] = \
+                        lib.device_topology_level(h1, h2)
+        finally:
+            lib.shutdown()
+        logger.debug('NVML gpu topology: %s', topology)
+        return topology
+
+    def compute_processes(self):
+        """Returns a list of GPUProcess of all running compute processes."""
+        lib = self.lib
+        lib.init()
+        try:
+            res = []
+            for index in range(lib.device_count()):
+                for pid, mem_used in lib.device_processes(
+                        lib.device_handle(index)):
+                    res.append(GPUProcess(
+                        index, pid,
+                        mem_used // _MIB if mem_used is not None else None,
+                    ))
+        finally:
+            lib.shutdown()
+        logger.debug('NVML compute processes: %s', res)
+        return res
+
+    def mig_devices(self):
+        """Returns a list of MIGDevice."""
+        lib = self.lib
+        lib.init()
+        try:
+            res = []
+            for index in range(lib.device_count()):
+                for mig_handle in lib.device_mig_handles(
+                        lib.device_handle(index)):
+                    # e.g., NVIDIA A100-SXM4-40GB MIG 1g.5gb
+                    m = _MIG_PROFILE.search(lib.device_name(mig_handle))
+                    res.append(MIGDevice(
+                        lib.device_uuid(mig_handle), index,
+                        m.group(1) if m else ''))
+        finally:
+            lib.shutdown()
+        logger.debug('NVML MIG devices: %s', res)
+        return res
+
+    def pci_bus_ids(self):
+        """Returns {gpu: PCI bus id} (see sysfs_pci_bus_id)."""
+        lib = self.lib
+        lib.init()
+        try:
+            res = {
+                index: lib.device_pci_bus_id(lib.device_handle(index))
+                for index in range(lib.device_count())
+            }
+        finally:
+            lib.shutdown()
+        logger.debug('NVML gpu pci bus ids: %s', res)
+        return res
+
+    def health(self):
+        """Returns a list of GPUHealth."""
+        lib = self.lib
+        lib.init()
+        try:
+            res = [
+                GPUHealth(
+                    index=index,
+                    **lib.device_health(lib.device_handle(index)))
+                for index in range(lib.device_count())
+            ]
+        finally:
+            lib.shutdown()
+        logger.debug('NVML gpu health: %s', res)
+        return res
+
+
+class _AutoBackend(object):
+    """Uses NVML if possible, falls back to nvidia-smi otherwise."""
+    name = 'auto'
+
+    def __init__(self):
+        self._nvml = None
+        try:
+            self._nvml = NVMLBackend()
+        except UserDockerException as e:
+            logger.debug('%s, using nvidia-smi', e)
+        self._nvidia_smi = NvidiaSmiBackend()
+
+    def _call(self, method, *args, **kwds):
+        if self._nvml is not None:
+            try:
+                return getattr(self._nvml, method)(*args, **kwds)
+            except UserDockerException as e:
+                logger.debug('%s, using nvidia-smi', e)
+                self._nvml = None
+        return getattr(self._nvidia_smi, method)(*args, **kwds)
+
+    def gpus(self, samples=1, interval=0., processes=False):
+        return self._call('gpus', samples, interval, processes)
+
+    def topology(self):
+        return self._call('topology')
+
+    def compute_processes(self):
+        return self._call('compute_processes')
+
+    def health(self):
+        return self._call('health')
+
+    def mig_devices(self):
+        return self._call('mig_devices')
+
+    def pci_bus_ids(self):
+        return self._call('pci_bus_ids')
+
+
+GPU_BACKENDS = {
+    'auto': _AutoBackend,
+    'nvml': NVMLBackend,
+    'nvidia-smi': NvidiaSmiBackend,
+}
+
+_gpu_backend = None
+
+
+def get_gpu_backend():
+    """Returns the (shared) GPU backend chosen by NV_GPU_BACKEND."""
+    global _gpu_backend
+    if _gpu_backend is None:
+        try:
+            backend_cls = GPU_BACKENDS[NV_GPU_BACKEND]
+        except KeyError:
+            raise UserDockerException(
+                "ERROR: NV_GPU_BACKEND config variable not in %s, contact "
+                "admin" % sorted(GPU_BACKENDS))
+        _gpu_backend = backend_cls()
+    return _gpu_backend
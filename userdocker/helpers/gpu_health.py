@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+"""Health checks of GPUs for placement.
+
+A GPU that's throttling its clocks (e.g., overheating), accumulating
+uncorrectable ECC errors or running on a degraded PCIe link looks free, but
+would run jobs a lot slower (or crash them). The health attributes (see
+GPUHealth in gpu_backend.py) change slowly, so they're shared in STATE_DIR
+for NV_GPU_HEALTH_CACHE_TTL seconds. Which checks are done is configured via
+NV_GPU_HEALTH_CHECKS, what happens to unhealthy GPUs via NV_GPU_HEALTH_POLICY.
+"""
+
+from ..config import NV_GPU_HEALTH_CACHE_TTL
+from ..config import NV_GPU_HEALTH_CHECKS
+from ..config import NV_GPU_HEALTH_POLICY
+from ..config import NV_GPU_HEALTH_THROTTLE_REASONS
+from ..config import NV_GPU_PROBE_TIMEOUT
+from .exceptions import UserDockerException
+from .gpu_backend import GPUHealth
+from .gpu_backend import get_gpu_backend
+from .logger import logger
+from .statefile import cached_state
+
+
+STATE_GPU_HEALTH = 'gpu_health'
+
+GPU_HEALTH_POLICIES = ('ignore', 'deprioritize', 'exclude')
+
+
+def _check_throttling(health):
+    reasons = [
+        r for r in health.throttle_reasons or []
+        if r in NV_GPU_HEALTH_THROTTLE_REASONS
+    ]
+    if reasons:
+        return 'throttling: %s' % ', '.join(reasons)
+    return None
+
+
+def _check_ecc(health):
+    if health.ecc_errors:
+        return '%d uncorrected ECC errors' % health.ecc_errors
+    return None
+
+
+def _check_retired_pages(health):
+    if health.retired_pages_pending:
+        return 'retired pages pending (needs reset)'
+    return None
+
+
+def _check_persistence_mode(health):
+    if health.persistence_mode is False:
+        return 'persistence mode disabled'
+    return None
+
+
+def _check_pcie_width(health):
+    # the link generation is lowered when idle to save power, the width not
+    if (
+            health.pcie_width is not None and health.pcie_width_max
+            and health.pcie_width < health.pcie_width_max
+    ):
+        return 'PCIe link width x%d < x%d' % (
+            health.pcie_width, health.pcie_width_max)
+    return None
+
+
+GPU_HEALTH_CHECKS = {
+    'throttling': _check_throttling,
+    'ecc': _check_ecc,
+    'retired_pages': _check_retired_pages,
+    'persistence_mode': _check_persistence_mode,
+    'pcie_width': _check_pcie_width,
+}
+
+
+def gpu_health_problems(health, checks=NV_GPU_HEALTH_CHECKS):
+    """Returns a list of the health problems of a GPU (empty if healthy)."""
+    problems = []
+    for check in checks:
+        try:
+            problem = GPU_HEALTH_CHECKS[check](health)
+        except KeyError:
+            raise UserDockerException(
+                "ERROR: unknown check in NV_GPU_HEALTH_CHECKS config "
+                "variable: %s, contact admin" % check)
+        if problem:
+            problems.append(problem)
+    return problems
+
+
+def nvidia_get_gpu_health():
+    """Returns {gpu: GPUHealth}, {} if the health can't be queried."""
+    try:
+        health = cached_state(
+            STATE_GPU_HEALTH,
+            NV_GPU_HEALTH_CACHE_TTL,
+            lambda: get_gpu_backend().health(),
+            lock_timeout=NV_GPU_PROBE_TIMEOUT,
+        )
+    except UserDockerException as e:
+        logger.debug('GPU health not available: %s', e)
+        return {}
+    return {h[0]: GPUHealth(*h) for h in health}
+
+
+def nvidia_get_gpu_health_problems():
+    """Returns {gpu: [problem, ...]} according to NV_GPU_HEALTH_POLICY.
+
+    Returns {} without querying anything if the policy is 'ignore'.
+    """
+    if NV_GPU_HEALTH_POLICY not in GPU_HEALTH_POLICIES:
+        raise UserDockerException(
+            "ERROR: NV_GPU_HEALTH_POLICY config variable not in %s, contact "
+            "admin" % (GPU_HEALTH_POLICIES,))
+    if NV_GPU_HEALTH_POLICY == 'ignore':
+        return {}
+    res = {}
+    for gpu, health in nvidia_get_gpu_health().items():
+        problems = gpu_health_problems(health)
+        if problems:
+            logger.debug('GPU %d unhealthy: %s', gpu, '; '.join(problems))
+            res[gpu] = problems
+    return res
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+"""Compact on-disk history of the GPU utilization and memory used.
+
+The history is a fixed-size ring buffer file (NV_GPU_HISTORY_FILE) with room
+for NV_GPU_HISTORY_SLOTS samples, written by "userdocker gpu-sample" (e.g.,
+run by root from cron every minute). The file is memory-mapped, so appending
+a sample only touches a single record and readers only read the records they
+need, which keeps reads cheap even with weeks of history.
+
+Layout (little endian):
+- header: magic, version, number of GPUs, number of slots, number of samples
+  written so far (the next sample goes into slot written % slots)
+- records: time (double), utilization per GPU (uint8 in %, 255 if unknown),
+  memory used per GPU (uint32 in MiB)
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+import time
+
+from ..config import NV_GPU_HISTORY_FILE
+from ..config import NV_GPU_HISTORY_SLOTS
+from ..config import NV_GPU_IDLE_UTILIZATION
+from ..config.cache import is_trusted
+from .exceptions import UserDockerException
+from .logger import logger
+
+
+_MAGIC = b'UDGH'
+_VERSION = 1
+_HEADER = struct.Struct('<4sIIIQ')
+_UNKNOWN_UTILIZATION = 255
+
+
+def _record_struct(n_gpus):
+    return struct.Struct('<d%dB%dI' % (n_gpus, n_gpus))
+
+
+def append_gpu_sample(gpus, t=None, fn=NV_GPU_HISTORY_FILE,
+                      slots=NV_GPU_HISTORY_SLOTS):
+    """Appends a sample of gpus (list of GPUInfo) to the history.
+
+    The file is (re-)created if it doesn't match the number of GPUs or slots.
+    """
+    n_gpus = max(gpu.index for gpu in gpus) + 1 if gpus else 0
+    record = _record_struct(n_gpus)
+    utilization = [_UNKNOWN_UTILIZATION] * n_gpus
+    mem_used = [0] * n_gpus
+    for gpu in gpus:
+        if gpu.utilization is not None:
+            utilization[gpu.index] = min(int(round(gpu.utilization)), 100)
+        mem_used[gpu.index] = int(round(gpu.mem_used))
+
+    try:
+        os.makedirs(os.path.dirname(fn), mode=0o755, exist_ok=True)
+        fd = os.open(fn, os.O_RDWR | os.O_CREAT, 0o644)
+    except OSError as e:
+        raise UserDockerException(
+            'ERROR: could not open GPU history %s: %s' % (fn, e))
+    try:
+        # serializes concurrent samplers
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        if not is_trusted(os.fstat(fd)):
+            raise UserDockerException(
+                'ERROR: GPU history not trusted (owner or permissions): %s'
+                % fn)
+        size = _HEADER.size + slots * record.size
+        header = os.pread(fd, _HEADER.size, 0)
+        written = 0
+        if len(header) == _HEADER.size:
+            header = _HEADER.unpack(header)
+            written = header[-1]
+        if (
+                header[:-1] != (_MAGIC, _VERSION, n_gpus, slots)
+                or os.fstat(fd).st_size != size
+        ):
+            logger.info('Creating new GPU history: %s', fn)
+            os.ftruncate(fd, 0)
+            os.ftruncate(fd, size)
+            written = 0
+        mm = mmap.mmap(fd, size)
+        try:
+            record.pack_into(
+                mm, _HEADER.size + (written % slots) * record.size,
+                time.time() if t is None else t, *(utilization + mem_used))
+            # the header is updated last, so readers never see a partial
+            # record as the newest one
+            _HEADER.pack_into(
+                mm, 0, _MAGIC, _VERSION, n_gpus, slots, written + 1)
+        finally:
+            mm.close()
+    except OSError as e:
+        raise UserDockerException(
+            'ERROR: could not write GPU history %s: %s' % (fn, e))
+    finally:
+        os.close(fd)
+
+
+class GPUHistory(object):
+    """Read-only view of the GPU history (use as context manager).
+
+    samples() iterates the samples from newest to oldest, only unpacking the
+    records that are actually consumed.
+    """
+
+    def __init__(self, fn=NV_GPU_HISTORY_FILE):
+        self.fn = fn
+        self._mm = None
+        self.n_gpus = 0
+        self.slots = 0
+        self.written = 0
+
+    def __enter__(self):
+        try:
+            with open(self.fn, 'rb') as f:
+                if not is_trusted(os.fstat(f.fileno())):
+                    raise UserDockerException(
+                        'ERROR: GPU history not trusted (owner or '
+                        'permissions): %s' % self.fn)
+                self._mm = mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            # ValueError: empty file
+            raise UserDockerException(
+                'ERROR: no GPU history available (is "userdocker gpu-sample" '
+                'run regularly?): %s' % e)
+        header = (None, None, 0, 0, 0)
+        if len(self._mm) >= _HEADER.size:
+            header = _HEADER.unpack_from(self._mm, 0)
+        magic, version, self.n_gpus, self.slots, self.written = header
+        self._record = _record_struct(self.n_gpus)
+        if (
+                (magic, version) != (_MAGIC, _VERSION)
+                or len(self._mm) != _HEADER.size
+                + self.slots * self._record.size
+        ):
+            self._mm.close()
+            raise UserDockerException(
+                'ERROR: unexpected GPU history format: %s' % self.fn)
+        return self
+
+    def __exit__(self, *exc):
+        self._mm.close()
+
+    def samples(self):
+        """Yields (time, [utilization or None], [mem_used]) newest first."""
+        n = self.n_gpus
+        for i in range(min(self.written, self.slots)):
+            slot = (self.written - 1 - i) % self.slots
+            values = self._record.unpack_from(
+                self._mm, _HEADER.size + slot * self._record.size)
+            yield (
+                values[0],
+                [None if u == _UNKNOWN_UTILIZATION else u
+                 for u in values[1:1 + n]],
+                list(values[1 + n:]),
+            )
+
+
+def gpu_idle_times(gpus, min_idle, threshold=NV_GPU_IDLE_UTILIZATION,
+                   now=None, fn=NV_GPU_HISTORY_FILE):
+    """Returns {gpu: (idle seconds, MiB used)} of gpus idle for min_idle.
+
+    A GPU is idle while its utilization is <= threshold (%), unknown
+    utilization doesn't count as idle. The history is only read back until
+    the last busy sample of each of the gpus.
+    """
+    now = time.time() if now is None else now
+    gpus = set(gpus)
+    res = {}
+    with GPUHistory(fn) as history:
+        gpus &= set(range(history.n_gpus))
+        newest_mem_used = None
+        idle_since = {}
+        for t, utilization, mem_used in history.samples():
+            if newest_mem_used is None:
+                newest_mem_used = mem_used
+                if now - t > min_idle:
+                    logger.warning(
+                        'Newest GPU history sample is %d seconds old',
+                        now - t)
+                    return res
+            for gpu in list(gpus):
+                u = utilization[gpu]
+                if u is None or u > threshold:
+                    gpus.discard(gpu)
+                else:
+                    idle_since[gpu] = t
+            if not gpus:
+                break
+    for gpu, t in idle_since.items():
+        if now - t >= min_idle:
+            res[gpu] = (now - t, newest_mem_used[gpu])
+    return res
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+"""Maps the compute processes running on GPUs to containers.
+
+The GPU backend reports the (host) PIDs of compute processes. Their
+containers are found via /proc/<pid>/cgroup, which contains the container id
+for processes of docker containers (cgroup v1 and v2, cgroupfs and systemd
+drivers). /proc is scanned once for all PIDs instead of looking up each PID.
+
+A process on a GPU which isn't reserved for its container (or which doesn't
+run in a container at all) is a "squatter".
+"""
+
+import os
+import pwd
+import re
+from collections import OrderedDict
+
+from .container import LABEL_UID
+from .container import LABEL_USER
+from .container import container_list
+from .gpu_backend import get_gpu_backend
+from .nvidia import nvidia_get_gpus_used_by_containers
+from .nvidia import nvidia_get_mig_devices
+from .parallel import run_parallel
+
+
+_CONTAINER_ID_RE = re.compile(r'([0-9a-f]{64})')
+
+PROC = '/proc'
+
+
+def _cgroup_container_id(cgroup):
+    for line in cgroup.splitlines():
+        m = _CONTAINER_ID_RE.search(line)
+        if m:
+            return m.group(1)
+    return None
+
+
+def proc_containers(pids, proc=PROC):
+    """Returns {pid: (container id or None, uid)} for the given PIDs.
+
+    Scans proc once, PIDs which are gone (or not visible) are left out.
+    """
+    pids = set(pids)
+    res = {}
+    if not pids:
+        return res
+    for entry in os.listdir(proc):
+        if not entry.isdigit() or int(entry) not in pids:
+            continue
+        try:
+            with open(os.path.join(proc, entry, 'cgroup')) as f:
+                cgroup = f.read()
+            proc_uid = os.stat(os.path.join(proc, entry)).st_uid
+        except OSError:
+            # process gone meanwhile
+            continue
+        res[int(entry)] = (_cgroup_container_id(cgroup), proc_uid)
+    return res
+
+
+def _user_name(proc_uid):
+    try:
+        return pwd.getpwuid(proc_uid).pw_name
+    except KeyError:
+        return str(proc_uid)
+
+
+def gpu_processes_by_container(docker):
+    """Returns a list of dicts, one per GPU and container (or host process).
+
+    Keys: 'gpu', 'container' (None for host processes), 'name', 'user',
+    'uid', 'pids', 'mem_used' (MiB, None if not available) and 'squatter'
+    (if the GPU isn't reserved for the container).
+    """
+    processes, gpus_used_by_containers, containers, mig_devices = \
+        run_parallel([
+            (get_gpu_backend().compute_processes, ()),
+            (nvidia_get_gpus_used_by_containers, (docker,)),
+            (container_list, (docker, (), (LABEL_USER, LABEL_UID))),
+            (nvidia_get_mig_devices, ()),
+        ])
+    mig_gpu = {d.uuid: d.gpu for d in mig_devices}
+    pid_containers = proc_containers(p.pid for p in processes)
+
+    container_info = {}
+    for c in containers:
+        labels = c['Labels']
+        container_info[c['Id']] = (
+            c['Name'], labels.get(LABEL_USER, ''),
+            int(labels[LABEL_UID]) if LABEL_UID in labels else None)
+    reserved = set()
+    for gpu, uses in gpus_used_by_containers.items():
+        for container, name, user, container_uid, _, _ in uses:
+            # processes on MIG instances are reported for their GPU
+            reserved.add((mig_gpu.get(gpu, gpu), container))
+            container_info[container] = (name, user, container_uid)
+
+    rows = OrderedDict()
+    for p in sorted(processes):
+        container, proc_uid = pid_containers.get(p.pid, (None, None))
+        if container is not None:
+            name, user, row_uid = container_info.get(
+                container, ('', '', None))
+        else:
+            # host process (or not visible)
+            name = ''
+            user = _user_name(proc_uid) if proc_uid is not None else ''
+            row_uid = proc_uid
+        row = rows.get((p.gpu, container, row_uid))
+        if row is None:
+            row = rows[(p.gpu, container, row_uid)] = {
+                'gpu': p.gpu,
+                'container': container,
+                'name': name,
+                'user': user,
+                'uid': row_uid,
+                'pids': [],
+                'mem_used': None,
+                'squatter': (p.gpu, container) not in reserved,
+            }
+        row['pids'].append(p.pid)
+        if p.mem_used is not None:
+            row['mem_used'] = (row['mem_used'] or 0) + p.mem_used
+    return list(rows.values())
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+"""Host-local queue of runs waiting for GPUs (run --wait-for-gpu).
+
+The queue is a state file in STATE_DIR, only modified under its fcntl lock.
+Waiting runs are served in a fair order: round robin over users, FIFO per
+user, so a user enqueueing a lot of runs can't starve the others. With
+fair-share accounting (NV_GPU_FAIR_SHARE_HALF_LIFE, see gpu_quota.py), users
+with less recent GPU usage come first in each round. Only the
+run at the head of the queue tries to acquire GPUs (every
+NV_GPU_WAIT_POLL_INTERVAL seconds), all others just sleep, which bounds the
+polling cost independent of the queue length.
+
+Each waiting run regularly updates its heartbeat in the queue. Entries of
+runs that died (or stopped updating their heartbeat) are dropped.
+
+Runs that don't wait can't take GPUs any waiting run could use either (see
+gpu_queue_waiting_for()), so they can't overtake the queue.
+"""
+
+import os
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+
+from ..config import NV_GPU_PROBE_TIMEOUT
+from ..config import NV_GPU_WAIT_POLL_INTERVAL
+from ..config import uid
+from ..config import user_name
+from .exceptions import UserDockerException
+from .gpu_quota import read_gpu_usage
+from .logger import logger
+from .statefile import locked_state
+from .statefile import read_state
+from .statefile import write_state
+
+
+STATE_GPU_QUEUE = 'gpu_queue'
+
+
+def _alive(entry):
+    max_heartbeat_age = max(3 * NV_GPU_WAIT_POLL_INTERVAL, 60)
+    if time.time() - entry['heartbeat'] > max_heartbeat_age:
+        return False
+    try:
+        os.kill(entry['pid'], 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # e.g., not permitted, but exists
+        pass
+    return True
+
+
+def fair_order(entries, usage=None):
+    """Orders queue entries round robin over users, FIFO per user.
+
+    If usage ({uid: decayed GPU usage}) is given, users with less usage come
+    first within each round.
+    """
+    usage = usage or {}
+    user_rank = defaultdict(int)
+    keyed = []
+    for entry in sorted(entries, key=lambda e: e['time']):
+        keyed.append((
+            user_rank[entry['uid']], usage.get(entry['uid'], 0),
+            entry['time'], entry))
+        user_rank[entry['uid']] += 1
+    return [entry for _, _, _, entry in sorted(keyed, key=lambda k: k[:3])]
+
+
+def read_gpu_queue():
+    """Returns the (alive) waiting runs in the order they will be served."""
+    _, entries = read_state(STATE_GPU_QUEUE)
+    return fair_order(
+        [e for e in entries or [] if _alive(e)], read_gpu_usage())
+
+
+def gpu_queue_waiting_for(gpus):
+    """Returns the waiting runs that could use any of gpus.
+
+    These are the runs waiting for any GPUs, for one of the given GPUs or
+    (if gpus include MIG instances) for any MIG instance.
+    """
+    names = set(str(g) for g in gpus)
+    mig = any(not isinstance(g, int) for g in gpus)
+    res = []
+    for e in read_gpu_queue():
+        if e['nv_gpu'].startswith('MIG '):
+            if mig:
+                res.append(e)
+        elif not e['nv_gpu'] or names & set(e['nv_gpu'].split(',')):
+            res.append(e)
+    return res
+
+
+@contextmanager
+def gpu_queue(count, nv_gpu, timeout):
+    """Enqueues a run waiting for count GPUs (or the ones in nv_gpu).
+
+    Yields a wait_turn() function, which blocks until it's our turn to try
+    to acquire GPUs. Calling it again means that the previous try failed, so
+    it first sleeps for the poll interval. Raises a UserDockerException if
+    the timeout (seconds) passes. The run is dequeued when leaving the block.
+    """
+    entry_id = uuid.uuid4().hex
+    now = time.time()
+    deadline = now + timeout
+    entry = {
+        'id': entry_id,
+        'user': user_name,
+        'uid': uid,
+        'pid': os.getpid(),
+        'count': count,
+        'nv_gpu': nv_gpu,
+        'time': now,
+        'heartbeat': now,
+    }
+
+    def update(remove=False):
+        """Updates our entry, returns our position in the queue (0 based)."""
+        with locked_state(STATE_GPU_QUEUE, NV_GPU_PROBE_TIMEOUT) as locked:
+            if not locked:
+                raise UserDockerException(
+                    'ERROR: could not lock the GPU queue, try again later')
+            _, entries = read_state(STATE_GPU_QUEUE)
+            entries = [
+                e for e in entries or []
+                if e['id'] != entry_id and _alive(e)
+            ]
+            if not remove:
+                entry['heartbeat'] = time.time()
+                entries.append(entry)
+            write_state(STATE_GPU_QUEUE, entries)
+        if remove:
+            return None
+        return [
+            e['id'] for e in fair_order(entries, read_gpu_usage())
+        ].index(entry_id)
+
+    # number of tries, last known and last logged position in the queue
+    state = {'tries': 0, 'pos': None, 'logged_pos': None}
+
+    def wait_turn():
+        while True:
+            if state['tries'] or state['pos']:
+                # the last try happens at the deadline
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise UserDockerException(
+                        'ERROR: no GPUs became available within %s seconds'
+                        % timeout)
+                time.sleep(min(NV_GPU_WAIT_POLL_INTERVAL, remaining))
+            pos = update()
+            if pos != state['logged_pos'] and (pos or state['tries']):
+                logger.info('Waiting for GPUs, position in queue: %d', pos + 1)
+                state['logged_pos'] = pos
+            state['pos'] = pos
+            if pos == 0:
+                state['tries'] += 1
+                return
+
+    update()
+    try:
+        yield wait_turn
+    finally:
+        try:
+            update(remove=True)
+        except UserDockerException as e:
+            # will be dropped by others as soon as the heartbeat is too old
+            logger.debug('could not dequeue: %s', e)
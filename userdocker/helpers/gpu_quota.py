@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""Concurrent GPU limits per user / group and fair-share usage accounting.
+
+NV_MAX_GPU_COUNT_PER_USER limits the number of GPUs a user holds over all of
+their containers (and pending reservations) at the same time. As any config
+variable it can be set per group / user via the config layering.
+NV_MAX_GPU_COUNT_PER_GROUP limits the GPUs held by all members of a group
+together.
+
+If NV_GPU_FAIR_SHARE_HALF_LIFE is set, the GPU-seconds each user held are
+accumulated (exponentially decaying) in STATE_DIR. When GPUs are scarce, runs
+waiting for GPUs (see gpu_queue.py) of users with less recent usage are then
+served first.
+"""
+
+import pwd
+import time
+from collections import defaultdict
+
+from ..config import GROUPS_CACHE_TTL
+from ..config import NV_GPU_FAIR_SHARE_HALF_LIFE
+from ..config import NV_MAX_GPU_COUNT_PER_GROUP
+from ..config import NV_MAX_GPU_COUNT_PER_USER
+from ..config import group_names
+from ..config import uid
+from ..config.cache import user_groups
+from .exceptions import GPUsUnavailableException
+from .exceptions import UserDockerException
+from .logger import logger
+from .statefile import locked_state
+from .statefile import read_state
+from .statefile import write_state
+
+
+STATE_GPU_USAGE = 'gpu_usage'
+
+
+def gpus_held(gpus_used_by_containers, uids):
+    """Returns the set of GPUs used by any container (reservation) of uids."""
+    return set(
+        gpu for gpu, uses in gpus_used_by_containers.items()
+        if any(use[3] in uids for use in uses)
+    )
+
+
+def _group_member_uids(group, container_uids):
+    """Returns the uids out of container_uids that are members of group."""
+    members = set()
+    for container_uid in container_uids:
+        try:
+            pw = pwd.getpwuid(container_uid)
+        except KeyError:
+            continue
+        groups = user_groups(
+            container_uid, pw.pw_name, pw.pw_gid, GROUPS_CACHE_TTL)[0]
+        if group in groups:
+            members.add(container_uid)
+    return members
+
+
+def check_gpu_quota(gpus_used_by_containers, gpus):
+    """Checks if the user may (additionally) use gpus.
+
+    Raises a GPUsUnavailableException if the user (or one of their groups)
+    would exceed its limit due to GPUs currently held, or a
+    UserDockerException if the request on its own exceeds a limit.
+    """
+    gpus = set(gpus)
+    limits = []
+    if NV_MAX_GPU_COUNT_PER_USER >= 0:
+        limits.append(('you', NV_MAX_GPU_COUNT_PER_USER, {uid}))
+    group_limits = [
+        (g, m) for g, m in sorted(NV_MAX_GPU_COUNT_PER_GROUP.items())
+        if g in group_names and m >= 0
+    ]
+    if group_limits:
+        container_uids = set(
+            use[3] for uses in gpus_used_by_containers.values()
+            for use in uses
+        )
+        for group, max_gpus in group_limits:
+            limits.append((
+                'group %s' % group, max_gpus,
+                _group_member_uids(group, container_uids) | {uid},
+            ))
+
+    for who, max_gpus, uids in limits:
+        held = gpus_held(gpus_used_by_containers, uids)
+        logger.debug('GPUs held by %s: %r (max %d)', who, held, max_gpus)
+        if len(gpus) > max_gpus:
+            raise UserDockerException(
+                'ERROR: Number of requested GPUs > %d (admin limit for %s)'
+                % (max_gpus, who)
+            )
+        if len(held | gpus) > max_gpus:
+            raise GPUsUnavailableException(
+                'ERROR: GPUs currently used by %s: %d, %d more would exceed '
+                'the admin limit of %d concurrently used GPUs.\n'
+                'Use "sudo userdocker ps --gpu-used" to see status.' % (
+                    who, len(held), len(gpus - held), max_gpus)
+            )
+
+
+def _decay(t, now):
+    return 0.5 ** (max(now - t, 0) / NV_GPU_FAIR_SHARE_HALF_LIFE)
+
+
+def account_gpu_usage(gpus_used_by_containers):
+    """Adds the GPUs held since the last accounting to the decayed usage.
+
+    GPU holdings are sampled whenever GPU availability is checked, so the
+    GPUs held now are assumed to have been held since the previous sample.
+    Best effort: skipped if the usage state is busy.
+    """
+    if NV_GPU_FAIR_SHARE_HALF_LIFE <= 0:
+        return
+    gpus_per_uid = defaultdict(set)
+    for gpu, uses in gpus_used_by_containers.items():
+        for use in uses:
+            gpus_per_uid[use[3]].add(gpu)
+    with locked_state(STATE_GPU_USAGE, 0) as locked:
+        if not locked:
+            return
+        now = time.time()
+        t, usage = read_state(STATE_GPU_USAGE)
+        usage = usage or {}
+        # without samples for a long time we don't know what happened
+        dt = min(now - t, NV_GPU_FAIR_SHARE_HALF_LIFE) if t else 0
+        decay = _decay(t, now) if t else 1
+        usage = {
+            u: v * decay for u, v in usage.items() if v * decay >= 1
+        }
+        for u, held in gpus_per_uid.items():
+            u = str(u)  # JSON keys
+            usage[u] = usage.get(u, 0) + len(held) * max(dt, 0)
+        write_state(STATE_GPU_USAGE, usage, t=now)
+
+
+def read_gpu_usage():
+    """Returns {uid: decayed GPU-seconds}, {} if fair-share is disabled."""
+    if NV_GPU_FAIR_SHARE_HALF_LIFE <= 0:
+        return {}
+    t, usage = read_state(STATE_GPU_USAGE)
+    if not usage:
+        return {}
+    decay = _decay(t, time.time())
+    return {int(u): v * decay for u, v in usage.items()}
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+"""Ledger of GPUs reserved for containers that are about to be started.
+
+Between selecting GPUs and the started container becoming visible to other
+invocations (which can take a while, e.g., if the image needs to be pulled),
+concurrent launches would otherwise see the same GPUs as free. Hence GPU
+selection happens under an exclusive lock and the selected GPUs are recorded
+in a ledger in STATE_DIR, which all GPU availability checks treat as used.
+
+Each reservation has a token, which run attaches to the container as a label.
+Reservations are released by run if starting the container fails or once
+docker run returned. Otherwise they are dropped once a container with their
+token exists (running or not), once the launching process (with
+EXEC_IN_PLACE the docker client) is gone, or after NV_GPU_RESERVATION_TIMEOUT
+seconds. Whenever reservations are dropped, the shared container GPU usage is
+invalidated, as it might have been probed before their container existed.
+"""
+
+import os
+import time
+import uuid
+from contextlib import contextmanager
+
+from ..config import NV_GPU_RESERVATION_LOCK_TIMEOUT
+from ..config import NV_GPU_RESERVATION_TIMEOUT
+from ..config import NV_GPU_STATE_CACHE_TTL
+from ..config import uid
+from ..config import user_name
+from .container import LABEL_NV_GPU_RESERVATION
+from .container import STATE_CONTAINER_GPUS
+from .container import container_list
+from .exceptions import UserDockerException
+from .logger import logger
+from .statefile import invalidate_state
+from .statefile import locked_state
+from .statefile import read_state
+from .statefile import write_state
+
+
+STATE_GPU_RESERVATIONS = 'gpu_reservations'
+
+
+def _unexpired(reservations):
+    now = time.time()
+    return [
+        r for r in reservations or []
+        if 0 <= now - r['time'] < NV_GPU_RESERVATION_TIMEOUT
+    ]
+
+
+def _launcher_alive(reservation):
+    try:
+        os.kill(reservation['pid'], 0)
+    except KeyError:
+        # reservation of an older version
+        pass
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # e.g., not permitted, but exists
+        pass
+    return True
+
+
+def read_gpu_reservations():
+    """Returns the pending reservations as list of dicts.
+
+    Keys: 'token', 'gpus', 'gpu_mem', 'cpus', 'user', 'uid', 'pid', 'time'.
+    Might include reservations whose containers were started (or whose
+    launching process is gone) since the ledger was last cleaned up.
+    """
+    _, reservations = read_state(STATE_GPU_RESERVATIONS)
+    return _unexpired(reservations)
+
+
+def _write_reservations(reservations, dropped):
+    write_state(STATE_GPU_RESERVATIONS, reservations)
+    if dropped and NV_GPU_STATE_CACHE_TTL > 0:
+        # concurrent invocations might have cached the container GPU usage
+        # from before the containers of the dropped reservations existed
+        invalidate_state(STATE_CONTAINER_GPUS)
+
+
+@contextmanager
+def gpu_reservation(docker, dry_run=False):
+    """Serializes GPU selection with all concurrent invocations.
+
+    Yields a reserve(gpus, gpu_mem=None, cpus=None) function, which records
+    the selected GPUs (and the declared memory footprint in MiB and the CPU
+    slice) in the ledger and returns the token to label the container with
+    (None for dry runs). Within the block read_gpu_reservations() returns the
+    current ledger. Reservations made in a block that raises are released.
+    """
+    if dry_run:
+        yield lambda gpus, gpu_mem=None, cpus=None: None
+        return
+
+    with locked_state(
+            STATE_GPU_RESERVATIONS, NV_GPU_RESERVATION_LOCK_TIMEOUT) as locked:
+        if locked is False:
+            raise UserDockerException(
+                'ERROR: GPU selection is busy with concurrent launches (lock '
+                'not acquired within %s seconds), please retry' % (
+                    NV_GPU_RESERVATION_LOCK_TIMEOUT,))
+        if not locked:
+            logger.warning(
+                'Could not lock GPU reservations (STATE_DIR not usable), '
+                'concurrent launches might get the same GPUs')
+        reservations = read_gpu_reservations()
+        if reservations and locked:
+            # drop the reservations of meanwhile started (maybe already
+            # exited) containers and of launches that are gone
+            started = set(
+                c['Labels'].get(LABEL_NV_GPU_RESERVATION)
+                for c in container_list(
+                    docker,
+                    filters=['label=' + LABEL_NV_GPU_RESERVATION],
+                    labels=[LABEL_NV_GPU_RESERVATION],
+                    all_containers=True,
+                )
+            )
+            n = len(reservations)
+            reservations = [
+                r for r in reservations
+                if r['token'] not in started and _launcher_alive(r)]
+            _write_reservations(reservations, len(reservations) < n)
+
+        tokens = []
+
+        def reserve(gpus, gpu_mem=None, cpus=None):
+            token = uuid.uuid4().hex
+            tokens.append(token)
+            reservations.append({
+                'token': token,
+                'gpus': list(gpus),
+                'gpu_mem': gpu_mem,
+                'cpus': cpus,
+                'user': user_name,
+                'uid': uid,
+                'pid': os.getpid(),
+                'time': time.time(),
+            })
+            if locked:
+                write_state(STATE_GPU_RESERVATIONS, reservations)
+            logger.debug('reserved GPUs %r with token %s', gpus, token)
+            return token
+
+        try:
+            yield reserve
+        except BaseException:
+            if tokens and locked:
+                write_state(STATE_GPU_RESERVATIONS, [
+                    r for r in reservations if r['token'] not in tokens])
+            raise
+
+
+def release_gpu_reservation(token):
+    """Releases the reservation token (e.g., if the container didn't start)."""
+    with locked_state(
+            STATE_GPU_RESERVATIONS, NV_GPU_RESERVATION_LOCK_TIMEOUT) as locked:
+        if locked is None:
+            # STATE_DIR not usable, so the reservation wasn't recorded
+            return
+        if not locked:
+            logger.warning(
+                'Could not lock GPU reservations, reservation %s is released '
+                'after %d seconds', token, NV_GPU_RESERVATION_TIMEOUT)
+            return
+        reservations = read_gpu_reservations()
+        _write_reservations(
+            [r for r in reservations if r['token'] != token], True)
+    logger.debug('released GPU reservation %s', token)
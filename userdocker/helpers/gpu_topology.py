@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+"""Topology aware selection of multiple GPUs.
+
+For multi-GPU containers the interconnect between the GPUs matters a lot
+(e.g., for NCCL all-reduce), so out of the available GPUs we select the best
+connected subset: the weakest link between any 2 selected GPUs is maximized
+first, then the sum of all links, then the order of preference in which the
+GPUs were passed in (e.g., least memory used first). How good a link is, is
+defined by the admin via NV_GPU_TOPOLOGY_SCORES. Unhealthy GPUs (see
+gpu_health.py) are only selected if there aren't enough healthy ones.
+
+The topology is static, so it's only queried once and shared in STATE_DIR
+for NV_GPU_TOPOLOGY_CACHE_TTL seconds.
+"""
+
+from itertools import combinations
+
+from ..config import NV_GPU_PROBE_TIMEOUT
+from ..config import NV_GPU_TOPOLOGY_CACHE_TTL
+from ..config import NV_GPU_TOPOLOGY_SCORES
+from .exceptions import UserDockerException
+from .gpu_backend import get_gpu_backend
+from .gpu_health import nvidia_get_gpu_health_problems
+from .logger import logger
+from .statefile import cached_state
+
+
+STATE_GPU_TOPOLOGY = 'gpu_topology'
+
+# above this number of subsets a greedy search is used instead of trying all
+_MAX_COMBINATIONS = 20000
+
+
+def nvidia_get_gpu_topology():
+    """Returns {(gpu, gpu): level} (see gpu_backend.py), None if unavailable."""
+    try:
+        topology = cached_state(
+            STATE_GPU_TOPOLOGY,
+            NV_GPU_TOPOLOGY_CACHE_TTL,
+            lambda: [
+                [g1, g2, level] for (g1, g2), level in sorted(
+                    get_gpu_backend().topology().items())
+            ],
+            lock_timeout=NV_GPU_PROBE_TIMEOUT,
+        )
+    except UserDockerException as e:
+        logger.debug('GPU topology not available: %s', e)
+        return None
+    return {(g1, g2): level for g1, g2, level in topology}
+
+
+def _n_combinations(n, k):
+    res = 1
+    for i in range(k):
+        res = res * (n - i) // (i + 1)
+    return res
+
+
+def select_gpus(
+        candidates, count, topology, scores=NV_GPU_TOPOLOGY_SCORES,
+        unhealthy=()):
+    """Returns the best connected count GPUs out of candidates.
+
+    candidates are expected in the order of preference. The selected GPUs are
+    returned in the same order. GPUs in unhealthy are only selected if there
+    aren't enough others, then as few of them as possible.
+    """
+    healthy = [g for g in candidates if g not in unhealthy]
+    if len(healthy) >= count:
+        candidates = healthy
+    if count <= 1 or len(candidates) <= count or not topology or not scores:
+        return candidates[:count]
+
+    worst = min(scores.values())
+    rank = {gpu: i for i, gpu in enumerate(candidates)}
+
+    def link(g1, g2):
+        return scores.get(topology.get((g1, g2)), worst)
+
+    def quality(gpus):
+        links = [link(g1, g2) for g1, g2 in combinations(gpus, 2)]
+        return (
+            -sum(g in unhealthy for g in gpus),
+            min(links), sum(links), -sum(rank[g] for g in gpus))
+
+    if _n_combinations(len(candidates), count) <= _MAX_COMBINATIONS:
+        subsets = combinations(candidates, count)
+    else:
+        # greedily grow the best connected subset from each candidate
+        subsets = []
+        for seed in candidates:
+            gpus = [seed]
+            while len(gpus) < count:
+                gpus.append(max(
+                    (g for g in candidates if g not in gpus),
+                    key=lambda g: (
+                        g not in unhealthy,
+                        min(link(g, s) for s in gpus),
+                        sum(link(g, s) for s in gpus),
+                        -rank[g],
+                    ),
+                ))
+            subsets.append(gpus)
+    best = max(subsets, key=quality)
+    logger.debug(
+        'topology aware GPU selection out of %r: %r', candidates, best)
+    return sorted(best, key=rank.get)
+
+
+def nvidia_select_gpus(candidates, count):
+    """Selects count GPUs out of candidates (in order of preference).
+
+    Only queries the topology (and health) if there actually is a choice.
+    """
+    if count <= 1 or len(candidates) <= count or not NV_GPU_TOPOLOGY_SCORES:
+        return candidates[:count]
+    return select_gpus(
+        candidates, count, nvidia_get_gpu_topology(),
+        unhealthy=nvidia_get_gpu_health_problems())
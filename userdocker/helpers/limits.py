@@ -0,0 +1,450 @@
+# -*- coding: utf-8 -*-
+
+"""Per container and per user resource limits of run.
+
+The limits are docker run options (see RUN_LIMIT_OPTIONS). Each container
+gets the value requested by the user or the admin default
+(RUN_LIMITS_DEFAULT), bounded by RUN_LIMITS_MAX. The values are recorded as
+container labels (LABEL_LIMIT_PREFIX + option), so that the sums over the
+running containers of a user can be checked against RUN_LIMITS_PER_USER
+before launching another one.
+
+The size of /dev/shm (RUN_SHM_SIZE), ulimits (RUN_ULIMITS) and tmpfs mounts
+(RUN_TMPFS) are bounded by an admin minimum and maximum per value, with an
+optional default.
+
+Options the admin already passes through via ARGS_AVAILABLE or ARGS_ALWAYS
+aren't managed here.
+"""
+
+from collections import OrderedDict
+import math
+
+from ..config import ARGS_ALWAYS
+from ..config import ARGS_AVAILABLE
+from ..config import RUN_LIMITS_DEFAULT
+from ..config import RUN_LIMITS_MAX
+from ..config import RUN_LIMITS_PER_USER
+from ..config import RUN_SHM_SIZE
+from ..config import RUN_TMPFS
+from ..config import RUN_ULIMITS
+from ..config import uid
+from .container import LABEL_LIMIT_PREFIX
+from .container import LABEL_UID
+from .container import container_list
+from .exceptions import UserDockerException
+from .logger import logger
+from .units import format_size
+from .units import parse_size
+
+
+def _parse_cpus(s):
+    cpus = float(s)
+    if not math.isfinite(cpus) or cpus <= 0:
+        raise ValueError('must be positive and finite: %r' % s)
+    return cpus
+
+
+def _format_cpus(cpus):
+    return '%g' % cpus
+
+
+def _parse_count(s):
+    count = int(s)
+    if count <= 0:
+        raise ValueError('must be positive: %r' % s)
+    return count
+
+
+def _parse_bytes(s):
+    size = parse_size(s)
+    if size <= 0:
+        raise ValueError('must be positive: %r' % s)
+    return size
+
+
+def _parse_memory_swap(s):
+    # -1: unlimited swap (docker semantics)
+    if str(s).strip() == '-1':
+        return -1
+    return _parse_bytes(s)
+
+
+# option: (option strings, parse, format, help)
+RUN_LIMIT_OPTIONS = OrderedDict((
+    ('cpus', (('--cpus',), _parse_cpus, _format_cpus, 'number of CPUs')),
+    ('memory', (
+        ('-m', '--memory'), _parse_bytes, format_size,
+        'memory limit (e.g., 16g)')),
+    ('memory-swap', (
+        ('--memory-swap',), _parse_memory_swap, format_size,
+        'memory + swap limit (e.g., 32g), -1 for unlimited swap')),
+    ('pids-limit', (
+        ('--pids-limit',), _parse_count, str,
+        'maximum number of processes')),
+))
+
+
+def _limit(value):
+    # -1 (memory-swap, ulimits) means unlimited
+    return float('inf') if value == -1 else value
+
+
+def parse_run_limit(option, value):
+    """Parses a value of a limit option, raises ValueError."""
+    return RUN_LIMIT_OPTIONS[option][1](value)
+
+
+def format_run_limit(option, value):
+    return RUN_LIMIT_OPTIONS[option][2](value)
+
+
+def _config_limits(var, limits):
+    res = {}
+    for option, value in limits.items():
+        try:
+            res[option] = parse_run_limit(option, value)
+        except (KeyError, ValueError) as e:
+            raise UserDockerException(
+                "ERROR: invalid %s config variable entry %r: %r (%s), contact "
+                "admin" % (var, option, value, e))
+    return res
+
+
+def passed_through(*option_strings):
+    """If any of the run options is passed through via ARGS_* by the admin."""
+    options = set()
+    for args in ARGS_AVAILABLE.get('run', []) + ARGS_ALWAYS.get('run', []):
+        for arg in [args] if isinstance(args, str) else args:
+            options.add(arg.split('=', 1)[0])
+    return bool(options & set(option_strings))
+
+
+def managed_run_limits():
+    """Returns the limit options not passed through via ARGS_* by the admin."""
+    return [
+        option for option, (option_strings, _, _, _)
+        in RUN_LIMIT_OPTIONS.items()
+        if not passed_through(*option_strings)
+    ]
+
+
+def run_limit_help(option):
+    """Returns the help of a limit option incl. its default and maximum."""
+    help_ = RUN_LIMIT_OPTIONS[option][3]
+    defaults = _config_limits('RUN_LIMITS_DEFAULT', RUN_LIMITS_DEFAULT)
+    maxima = _config_limits('RUN_LIMITS_MAX', RUN_LIMITS_MAX)
+    per_user = _config_limits('RUN_LIMITS_PER_USER', RUN_LIMITS_PER_USER)
+    if option in defaults:
+        help_ += ', default: %s' % format_run_limit(option, defaults[option])
+    if option in maxima:
+        help_ += ', max: %s' % format_run_limit(option, maxima[option])
+    if option in per_user:
+        help_ += ', max over all your containers: %s' % format_run_limit(
+            option, per_user[option])
+    return help_
+
+
+def resolve_run_limits(requested):
+    """Returns an OrderedDict {option: value} of the limits of a container.
+
+    requested: {option: parsed value or None} as given by the user. Unless
+    requested, the default applies (capped at the maximum), without default
+    the maximum. Raises a UserDockerException if a requested value exceeds
+    the maximum.
+    """
+    defaults = _config_limits('RUN_LIMITS_DEFAULT', RUN_LIMITS_DEFAULT)
+    maxima = _config_limits('RUN_LIMITS_MAX', RUN_LIMITS_MAX)
+    per_user = _config_limits('RUN_LIMITS_PER_USER', RUN_LIMITS_PER_USER)
+    limits = OrderedDict()
+    for option in managed_run_limits():
+        value = requested.get(option)
+        if value is not None:
+            if option in maxima and _limit(value) > _limit(maxima[option]):
+                raise UserDockerException(
+                    "ERROR: --%s=%s exceeds the admin limit of %s per "
+                    "container" % (
+                        option, format_run_limit(option, value),
+                        format_run_limit(option, maxima[option])))
+        elif option in defaults:
+            value = defaults[option]
+            if option in maxima and _limit(value) > _limit(maxima[option]):
+                value = maxima[option]
+        elif option in maxima:
+            value = maxima[option]
+        if value is None and option in per_user:
+            raise UserDockerException(
+                "ERROR: --%s is required (admin limit of %s over all your "
+                "containers)" % (
+                    option, format_run_limit(option, per_user[option])))
+        if value is not None:
+            limits[option] = value
+
+    memory, memory_swap = limits.get('memory'), limits.get('memory-swap')
+    if memory is None and memory_swap is not None:
+        # docker only allows memory-swap together with memory
+        if requested.get('memory-swap') is not None:
+            raise UserDockerException(
+                "ERROR: --memory-swap can only be used together with --memory")
+        del limits['memory-swap']
+    elif memory is not None and memory_swap is not None \
+            and _limit(memory_swap) < memory:
+        if requested.get('memory-swap') is not None:
+            raise UserDockerException(
+                "ERROR: --memory-swap must be at least --memory (%s)" % (
+                    format_size(memory),))
+        # memory-swap is memory + swap, so the default means no swap here
+        logger.debug(
+            'memory-swap default %s < memory, using %s',
+            format_size(memory_swap), format_size(memory))
+        limits['memory-swap'] = memory
+    return limits
+
+
+def check_user_run_limits(docker, limits):
+    """Checks the limits summed over the user's running containers.
+
+    Raises a UserDockerException if the new container with limits would
+    exceed RUN_LIMITS_PER_USER. Containers without label for an option (e.g.,
+    started before it was limited) don't count.
+    """
+    per_user = _config_limits('RUN_LIMITS_PER_USER', RUN_LIMITS_PER_USER)
+    per_user = OrderedDict(
+        (o, v) for o, v in sorted(per_user.items()) if o in limits)
+    if not per_user:
+        return
+    used = dict.fromkeys(per_user, 0)
+    for c in container_list(
+            docker,
+            filters=['label=%s=%d' % (LABEL_UID, uid)],
+            labels=[LABEL_LIMIT_PREFIX + o for o in per_user],
+    ):
+        for option in per_user:
+            value = c['Labels'].get(LABEL_LIMIT_PREFIX + option)
+            if value is None:
+                continue
+            try:
+                used[option] += _limit(parse_run_limit(option, value))
+            except ValueError:
+                logger.warning(
+                    'Ignoring invalid %s%s label of container %s',
+                    LABEL_LIMIT_PREFIX, option, c['Id'])
+    for option, max_value in per_user.items():
+        logger.debug(
+            '%s used by your containers: %s (max %s)',
+            option, used[option], max_value)
+        if used[option] + _limit(limits[option]) > _limit(max_value):
+            raise UserDockerException(
+                "ERROR: your running containers use --%s=%s in total, %s more "
+                "would exceed the admin limit of %s over all your "
+                "containers.\nUse \"sudo userdocker ps\" to see them." % (
+                    option,
+                    format_run_limit(option, used[option])
+                    if used[option] != float('inf') else 'unlimited',
+                    format_run_limit(option, limits[option]),
+                    format_run_limit(option, max_value)))
+
+
+def run_limit_args(limits):
+    """Returns the docker run args for limits."""
+    return [
+        '--%s=%s' % (option, format_run_limit(option, value))
+        for option, value in limits.items()
+    ]
+
+
+# Bounded values (shm-size, ulimits, tmpfs sizes): dicts with the optional
+# keys 'min', 'default' and 'max'
+
+_BOUND_KEYS = ('min', 'default', 'max')
+
+
+def _parse_ulimit_value(s):
+    # -1: unlimited
+    value = int(s)
+    if value < -1:
+        raise ValueError('must be >= -1: %r' % s)
+    return value
+
+
+def _parse_memlock(s):
+    # in bytes, allows sizes like 64m
+    if str(s).strip() == '-1':
+        return -1
+    return parse_size(s)
+
+
+# ulimits with values in bytes, all others are counts
+_ULIMIT_PARSERS = {
+    'memlock': _parse_memlock,
+}
+
+
+def _ulimit_parser(name):
+    return _ULIMIT_PARSERS.get(name, _parse_ulimit_value)
+
+
+def _format_ulimit_value(value):
+    return 'unlimited' if value == -1 else '%d' % value
+
+
+def _config_bounds(var, bounds, parse):
+    if not isinstance(bounds, dict) or set(bounds) - set(_BOUND_KEYS):
+        raise UserDockerException(
+            "ERROR: %s config variable entries need to be dicts with keys %s, "
+            "contact admin" % (var, ', '.join(_BOUND_KEYS)))
+    try:
+        return {k: parse(v) for k, v in bounds.items()}
+    except (TypeError, ValueError) as e:
+        raise UserDockerException(
+            "ERROR: invalid %s config variable: %s, contact admin" % (var, e))
+
+
+def _check_bounds(what, value, bounds, fmt):
+    lower = bounds.get('min')
+    upper = bounds.get('max')
+    if (
+            lower is not None and _limit(value) < _limit(lower)
+            or upper is not None and _limit(value) > _limit(upper)
+    ):
+        raise UserDockerException(
+            "ERROR: %s=%s not within the admin limits (%s)" % (
+                what, fmt(value), _bounds_help(
+                    {k: v for k, v in bounds.items() if k != 'default'},
+                    fmt)))
+
+
+def _bounds_help(bounds, fmt):
+    return ', '.join(
+        '%s: %s' % (k, fmt(bounds[k])) for k in _BOUND_KEYS if k in bounds)
+
+
+def parse_shm_size(s):
+    """Parses a /dev/shm size (like 8g) into bytes, raises ValueError."""
+    return _parse_bytes(s)
+
+
+def shm_size_help():
+    """Returns the help of --shm-size incl. its bounds."""
+    bounds = _config_bounds('RUN_SHM_SIZE', RUN_SHM_SIZE, _parse_bytes)
+    return 'size of /dev/shm (e.g., 8g). %s' % _bounds_help(
+        bounds, format_size)
+
+
+def resolve_shm_size(requested):
+    """Returns the /dev/shm size (bytes) for requested (None: default)."""
+    if RUN_SHM_SIZE is None or passed_through('--shm-size'):
+        return None
+    bounds = _config_bounds('RUN_SHM_SIZE', RUN_SHM_SIZE, _parse_bytes)
+    if requested is None:
+        return bounds.get('default')
+    _check_bounds('--shm-size', requested, bounds, format_size)
+    return requested
+
+
+def parse_ulimit(s):
+    """Parses a ulimit like nofile=4096[:8192] into (name, soft, hard).
+
+    Raises a ValueError if s can't be parsed.
+    """
+    name, eq, values = s.partition('=')
+    if not eq or not name:
+        raise ValueError('invalid ulimit (expected NAME=SOFT[:HARD]): %r' % s)
+    soft, _, hard = values.partition(':')
+    parse = _ulimit_parser(name)
+    soft = parse(soft)
+    hard = parse(hard) if hard else soft
+    if _limit(soft) > _limit(hard):
+        raise ValueError('soft limit > hard limit: %r' % s)
+    return name, soft, hard
+
+
+def ulimit_help():
+    """Returns the help of --ulimit incl. the available ulimits."""
+    ulimits = []
+    for name, bounds in sorted(RUN_ULIMITS.items()):
+        bounds = _config_bounds(
+            'RUN_ULIMITS', bounds, _ulimit_parser(name))
+        ulimits.append('%s (%s)' % (
+            name, _bounds_help(bounds, _format_ulimit_value)))
+    return (
+        'ulimit as NAME=SOFT[:HARD] (can be given multiple times, -1 for '
+        'unlimited). Available: %s' % ', '.join(ulimits))
+
+
+def resolve_ulimits(requested):
+    """Returns an OrderedDict {name: (soft, hard)} of the container's ulimits.
+
+    requested: list of (name, soft, hard) as given by the user. Ulimits with
+    a default are set unless requested.
+    """
+    res = OrderedDict()
+    for name, soft, hard in requested:
+        if name not in RUN_ULIMITS:
+            raise UserDockerException(
+                "ERROR: --ulimit %s not allowed by admin. Available: %s" % (
+                    name, ', '.join(sorted(RUN_ULIMITS)) or 'none'))
+        bounds = _config_bounds(
+            'RUN_ULIMITS', RUN_ULIMITS[name], _ulimit_parser(name))
+        for value in (soft, hard):
+            _check_bounds(
+                '--ulimit %s' % name, value, bounds, _format_ulimit_value)
+        res[name] = (soft, hard)
+    for name, bounds in sorted(RUN_ULIMITS.items()):
+        bounds = _config_bounds('RUN_ULIMITS', bounds, _ulimit_parser(name))
+        if name not in res and 'default' in bounds:
+            res[name] = (bounds['default'], bounds['default'])
+    return res
+
+
+def parse_tmpfs(s):
+    """Parses a tmpfs mount like /tmp[:size=4g] into (path, size or None).
+
+    Raises a ValueError if s can't be parsed.
+    """
+    path, _, opts = s.partition(':')
+    if not path.startswith('/'):
+        raise ValueError('tmpfs path must be absolute: %r' % s)
+    size = None
+    for opt in opts.split(',') if opts else []:
+        key, eq, value = opt.partition('=')
+        if key != 'size' or not eq:
+            raise ValueError(
+                'only the size option is supported (PATH[:size=SIZE]): %r' % s)
+        size = _parse_bytes(value)
+    return path, size
+
+
+def tmpfs_help():
+    """Returns the help of --tmpfs incl. the available paths."""
+    paths = []
+    for path, bounds in sorted(RUN_TMPFS.items()):
+        bounds = _config_bounds('RUN_TMPFS', bounds, _parse_bytes)
+        paths.append('%s (%s)' % (path, _bounds_help(bounds, format_size)))
+    return (
+        'mount a tmpfs (in memory, counts towards the memory limit) as '
+        'PATH[:size=SIZE] (can be given multiple times). Available: %s'
+        % ', '.join(paths))
+
+
+def resolve_tmpfs(requested):
+    """Returns an OrderedDict {path: size} of the container's tmpfs mounts.
+
+    requested: list of (path, size or None) as given by the user. Without
+    size the default applies, without default the maximum.
+    """
+    res = OrderedDict()
+    for path, size in requested:
+        if path not in RUN_TMPFS:
+            raise UserDockerException(
+                "ERROR: --tmpfs %s not allowed by admin. Available: %s" % (
+                    path, ', '.join(sorted(RUN_TMPFS)) or 'none'))
+        bounds = _config_bounds('RUN_TMPFS', RUN_TMPFS[path], _parse_bytes)
+        if size is None:
+            size = bounds.get('default', bounds.get('max'))
+        if size is None:
+            raise UserDockerException(
+                "ERROR: --tmpfs %s needs a size (PATH:size=SIZE)" % path)
+        _check_bounds('--tmpfs %s size' % path, size, bounds, format_size)
+        res[path] = size
+    return res
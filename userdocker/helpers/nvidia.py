@@ -1,18 +1,75 @@
 # -*- coding: utf-8 -*-
-import os
-import json
-import logging
-import re
 from collections import defaultdict
 from operator import itemgetter
+import re
 
 from ..config import uid
-from ..config import NVIDIA_SMI
+from ..config import CONTAINER_ENV_FALLBACK
 from ..config import NV_ALLOWED_GPUS
 from ..config import NV_EXCLUSIVE_CONTAINER_GPU_RESERVATION
+from ..config import NV_GPU_HEALTH_POLICY
+from ..config import NV_GPU_MEM_HEADROOM
+from ..config import NV_GPU_MIG
+from ..config import NV_GPU_MIG_CACHE_TTL
+from ..config import NV_GPU_PROBE_TIMEOUT
+from ..config import NV_GPU_SCORE_WEIGHTS
+from ..config import NV_GPU_STATE_CACHE_TTL
+from ..config import NV_GPU_STATUS_SAMPLES
+from ..config import NV_GPU_STATUS_SAMPLE_INTERVAL
 from ..config import NV_GPU_UNAVAILABLE_ABOVE_MEMORY_USED
+from ..config import NV_GPU_UNAVAILABLE_ABOVE_PROCESSES
+from ..config import NV_GPU_UNAVAILABLE_ABOVE_UTILIZATION
+from .container import LABEL_NV_GPU
+from .container import LABEL_NV_GPU_MEM
+from .container import LABEL_NV_GPU_RESERVATION
+from .container import LABEL_UID
+from .container import LABEL_USER
+from .container import STATE_CONTAINER_GPUS
+from .container import container_inspect
+from .container import container_list
+from .exceptions import UserDockerException
+from .gpu_backend import GPUInfo
+from .gpu_backend import MIGDevice
+from .gpu_backend import get_gpu_backend
+from .gpu_health import nvidia_get_gpu_health_problems
+from .gpu_quota import account_gpu_usage
 from .logger import logger
-from .execute import exec_cmd
+from .gpu_reservation import read_gpu_reservations
+from .parallel import run_parallel
+from .statefile import cached_state
+from .statefile import invalidate_state
+
+
+# names of the shared state files (see statefile.py)
+STATE_GPUS = 'gpu_state'
+STATE_MIG_DEVICES = 'mig_devices'
+
+# metrics that can be weighted in NV_GPU_SCORE_WEIGHTS
+GPU_SCORE_METRICS = (
+    'mem_used', 'mem_total', 'utilization', 'processes', 'reservations')
+
+
+# GPUs are identified by their index (int), MIG instances by their UUID (str)
+def gpu_sort_key(gpu):
+    """Sort key for GPUs: GPU indices first, then MIG UUIDs."""
+    if isinstance(gpu, int):
+        return 0, gpu, ''
+    return 1, 0, gpu
+
+
+def nvidia_parse_gpu(gpu):
+    """Parses a GPU index or MIG UUID (if NV_GPU_MIG), raises ValueError."""
+    gpu = gpu.strip()
+    if NV_GPU_MIG and gpu.startswith('MIG-'):
+        return gpu
+    return int(gpu)
+
+
+def _parse_gpus(gpus):
+    return [
+        int(g) if g.strip().isdigit() else g.strip()
+        for g in gpus.split(',') if g.strip()
+    ]
 
 
 def container_find_userdocker_user_uid_gpus(container_env):
@@ -21,81 +78,322 @@ def container_find_userdocker_user_uid_gpus(container_env):
     uids = [v for k, _, v in pairs if k == 'USERDOCKER_UID']
     gpus = [v for k, _, v in pairs if k == 'USERDOCKER_NV_GPU']
     if gpus:
-        gpus = [int(g) for g in gpus[0].split(',')]
+        gpus = _parse_gpus(gpus[0])
     return users[0] if users else '', int(uids[0]) if uids else None, gpus
 
 
-def nvidia_get_gpus_used_by_containers(docker):
-    running_containers = exec_cmd(
-        [docker, 'ps', '-q'],
-        return_status=False,
-        loglvl=logging.DEBUG,
-    ).split()
-    gpu_used_by_containers = defaultdict(list)
-    if not running_containers:
-        return gpu_used_by_containers
-    gpu_used_by_containers_str = exec_cmd(
-        [
-            docker, 'inspect', '--format',
-            '[{{json .Name}}, {{json .Id}}, {{json .Config.Env}}]'
-        ] + running_containers,
-        return_status=False,
-        loglvl=logging.DEBUG,
+def container_find_userdocker_user_uid_gpus_labels(container_labels):
+    gpus = container_labels.get(LABEL_NV_GPU)
+    return (
+        container_labels.get(LABEL_USER, ''),
+        int(container_labels[LABEL_UID]),
+        _parse_gpus(gpus) if gpus else [],
     )
-    logger.debug('gpu_used_by_containers_str: %s', gpu_used_by_containers_str)
-    for line in gpu_used_by_containers_str.splitlines():
-        container_name, container, container_env = json.loads(line)
-        container_user, container_uid, gpus = \
-            container_find_userdocker_user_uid_gpus(container_env)
+
+
+def _parse_gpu_mem(gpu_mem):
+    try:
+        return int(gpu_mem)
+    except (TypeError, ValueError):
+        return None
+
+
+def _probe_gpus_used_by_containers(docker, owner_uid=None):
+    gpu_used_by_containers = defaultdict(list)
+    labels = (
+        LABEL_USER, LABEL_UID, LABEL_NV_GPU, LABEL_NV_GPU_MEM,
+        LABEL_NV_GPU_RESERVATION)
+    if CONTAINER_ENV_FALLBACK:
+        # containers started by older userdocker versions aren't labelled,
+        # so we need to see all of them
+        containers = container_list(docker, labels=labels)
+    else:
+        filters = ['label=' + LABEL_NV_GPU]
+        if owner_uid is not None:
+            filters.append('label=%s=%d' % (LABEL_UID, owner_uid))
+        containers = container_list(docker, filters=filters, labels=labels)
+
+    container_gpu_uses = []
+    unlabelled_containers = []
+    for c in containers:
+        if LABEL_UID in c['Labels']:
+            container_gpu_uses.append((c['Id'], c['Name']) + (
+                container_find_userdocker_user_uid_gpus_labels(c['Labels'])
+            ) + (_parse_gpu_mem(c['Labels'].get(LABEL_NV_GPU_MEM)),
+                 c['Labels'].get(LABEL_NV_GPU_RESERVATION)))
+        else:
+            unlabelled_containers.append(c['Id'])
+    if unlabelled_containers:
+        containers_info = container_inspect(
+            docker, unlabelled_containers, ['Name', 'Id', 'Config.Env'])
+        logger.debug('unlabelled containers_info: %s', containers_info)
+        for info in containers_info:
+            container_gpu_uses.append((info['Id'], info['Name']) + (
+                container_find_userdocker_user_uid_gpus(
+                    info['Config.Env'] or [])
+            ) + (None, None))
+
+    for (container, container_name, container_user, container_uid,
+         gpus, gpu_mem, reservation) in container_gpu_uses:
+        if owner_uid is not None and container_uid != owner_uid:
+            continue
         for gpu_id in gpus:
             gpu_used_by_containers[gpu_id].append(
-                (container, container_name, container_user, container_uid)
+                (container, container_name, container_user, container_uid,
+                 gpu_mem, reservation)
             )
             logger.debug(
-                'gpu %d used by container: %s, name: %s, user: %s, uid: %s',
+                'gpu %s used by container: %s, name: %s, user: %s, uid: %s',
                 gpu_id, container, container_name, container_user, container_uid
             )
     return gpu_used_by_containers
 
 
-def nvidia_get_available_gpus(docker, nvidia_smi=NVIDIA_SMI):
-    if not NV_ALLOWED_GPUS:
+def nvidia_get_gpus_used_by_containers(docker, owner_uid=None):
+    """Returns {gpu: [(container, name, user, uid, gpu_mem, reservation)]}.
+
+    gpu_mem is the GPU memory footprint (MiB) declared on run (or None),
+    reservation the token of the GPU reservation it was started with (or None).
+
+    If owner_uid is given, only containers of that user are considered.
+
+    The result for all users is shared between concurrent invocations for
+    NV_GPU_STATE_CACHE_TTL seconds (or until userdocker starts a container).
+    """
+    if NV_GPU_STATE_CACHE_TTL <= 0:
+        return _probe_gpus_used_by_containers(docker, owner_uid)
+    cached = cached_state(
+        STATE_CONTAINER_GPUS,
+        NV_GPU_STATE_CACHE_TTL,
+        lambda: sorted(
+            _probe_gpus_used_by_containers(docker).items(),
+            key=lambda item: gpu_sort_key(item[0])),
+        lock_timeout=NV_GPU_PROBE_TIMEOUT,
+    )
+    gpu_used_by_containers = defaultdict(list)
+    for gpu, uses in cached:
+        for use in uses:
+            if owner_uid is None or use[3] == owner_uid:
+                gpu_used_by_containers[gpu].append(tuple(use))
+    return gpu_used_by_containers
+
+
+def nvidia_invalidate_gpus_used_by_containers():
+    """To be called when starting a container (changes GPU usage)."""
+    if NV_GPU_STATE_CACHE_TTL > 0:
+        invalidate_state(STATE_CONTAINER_GPUS)
+
+
+def nvidia_get_mig_devices():
+    """Returns the MIG instances as list of MIGDevice ([] if not NV_GPU_MIG).
+
+    The result is shared between concurrent invocations for
+    NV_GPU_MIG_CACHE_TTL seconds.
+    """
+    if not NV_GPU_MIG:
         return []
+    try:
+        mig_devices = cached_state(
+            STATE_MIG_DEVICES,
+            NV_GPU_MIG_CACHE_TTL,
+            lambda: get_gpu_backend().mig_devices(),
+            lock_timeout=NV_GPU_PROBE_TIMEOUT,
+        )
+    except UserDockerException as e:
+        logger.warning('Could not list MIG instances: %s', e)
+        return []
+    return [MIGDevice(*d) for d in mig_devices]
+
+
+def nvidia_gpu_allowed(gpu, mig_devices=None):
+    """Checks NV_ALLOWED_GPUS, MIG instances are also allowed via their GPU."""
+    if NV_ALLOWED_GPUS == 'ALL' or gpu in NV_ALLOWED_GPUS:
+        return True
+    if isinstance(gpu, int):
+        return False
+    if mig_devices is None:
+        mig_devices = nvidia_get_mig_devices()
+    return any(
+        d.uuid == gpu and d.gpu in NV_ALLOWED_GPUS for d in mig_devices)
+
+
+def mig_profile_matches(profile, requested):
+    """If a MIG profile (e.g., 1g.5gb) matches a requested one (e.g., 1g)."""
+    return profile == requested or profile.startswith(requested + '.')
+
+
+def mig_profile_sort_key(profile):
+    """Orders MIG profiles by size (e.g., 1g.5gb < 1g.10gb < 2g.10gb)."""
+    m = re.search(r'(\d+)g\.(\d+)gb', profile)
+    if not m:
+        return float('inf'), float('inf'), profile
+    return int(m.group(1)), int(m.group(2)), profile
+
 
-    gpu_mem_used_str = exec_cmd(
-        [nvidia_smi,
-         '--query-gpu=index,memory.used,utilization.gpu',
-         '--format=csv'],
-        return_status=False,
-        loglvl=logging.DEBUG,
+def _need_process_counts():
+    return (
+        bool(NV_GPU_SCORE_WEIGHTS.get('processes'))
+        or NV_GPU_UNAVAILABLE_ABOVE_PROCESSES >= 0
     )
-    logger.debug('gpu usage:\n%s', gpu_mem_used_str)
-    gpu_mem_used = {}
-    for line in gpu_mem_used_str.splitlines()[1:]:  # skip header
-        gpu, mem_used, gpu_utilization = line.split(', ')
-        gpu = int(gpu)
-        mem_used = int(mem_used.split(' MiB')[0])
-        gpu_mem_used[gpu] = mem_used
-
-    gpus_used_by_containers = nvidia_get_gpus_used_by_containers(docker)
+
+
+def nvidia_get_gpus():
+    """Returns the status of all GPUs as list of GPUInfo (see gpu_backend.py).
+
+    Memory used and utilization are averaged over NV_GPU_STATUS_SAMPLES
+    samples (via NVML). The result is shared between concurrent invocations for
+    NV_GPU_STATE_CACHE_TTL seconds, so a burst of invocations only queries
+    the GPUs once.
+    """
+    return [
+        GPUInfo(*gpu) for gpu in cached_state(
+            STATE_GPUS,
+            NV_GPU_STATE_CACHE_TTL,
+            lambda: get_gpu_backend().gpus(
+                samples=max(1, NV_GPU_STATUS_SAMPLES),
+                interval=NV_GPU_STATUS_SAMPLE_INTERVAL,
+                processes=_need_process_counts(),
+            ),
+            lock_timeout=NV_GPU_PROBE_TIMEOUT,
+        )
+    ]
+
+
+def nvidia_gpu_score(gpu, reservations, weights=NV_GPU_SCORE_WEIGHTS):
+    """Returns the weighted score of a GPU (lower is better).
+
+    Unknown metrics (e.g., utilization not supported) count as 0.
+    """
+    metrics = {
+        'mem_used': gpu.mem_used,
+        'mem_total': gpu.mem_total,
+        'utilization': gpu.utilization,
+        'processes': gpu.processes,
+        'reservations': reservations,
+    }
+    try:
+        return sum(w * (metrics[m] or 0) for m, w in weights.items())
+    except KeyError as e:
+        raise UserDockerException(
+            "ERROR: unknown metric in NV_GPU_SCORE_WEIGHTS config variable: "
+            "%s, contact admin" % e)
+
+
+def nvidia_gpu_unavailable(gpu):
+    """Returns why a GPU is unavailable due to hard thresholds (or None)."""
+    for metric, val, limit in (
+            ('memory used', gpu.mem_used,
+             NV_GPU_UNAVAILABLE_ABOVE_MEMORY_USED),
+            ('utilization', gpu.utilization,
+             NV_GPU_UNAVAILABLE_ABOVE_UTILIZATION),
+            ('processes', gpu.processes,
+             NV_GPU_UNAVAILABLE_ABOVE_PROCESSES),
+    ):
+        if limit >= 0 and val is not None and val > limit:
+            return '%s %s > %s' % (metric, val, limit)
+    return None
+
+
+def _gpu_mem_free(gpu, uses):
+    """Estimates the free memory (MiB) of a GPU (None if unknown).
+
+    Uses the declared footprints of the containers (and reservations) on the
+    GPU, but at least the currently used memory, minus NV_GPU_MEM_HEADROOM.
+    """
+    if gpu.mem_total is None:
+        return None
+    declared = sum(u[4] or 0 for u in uses)
+    return gpu.mem_total - max(gpu.mem_used, declared) - NV_GPU_MEM_HEADROOM
+
+
+def nvidia_get_available_gpus(docker, gpu_mem=None, gpu_profile=None):
+    """Returns (available GPUs in order of preference, GPUs used by us).
+
+    If gpu_mem (MiB) is given, only GPUs with enough (estimated) free memory
+    are available. If GPUs aren't exclusively reserved, they're bin-packed:
+    the GPUs with the least free memory left after placement come first.
+    Unhealthy GPUs are excluded or come last (see NV_GPU_HEALTH_POLICY).
+
+    Available MIG instances (if NV_GPU_MIG) follow the GPUs, GPUs in MIG mode
+    aren't available as a whole. If gpu_profile is given, only the MIG
+    instances with that profile are returned.
+    """
+    return nvidia_get_gpu_status(docker, gpu_mem, gpu_profile)[:2]
+
+
+def nvidia_get_gpu_status(docker, gpu_mem=None, gpu_profile=None):
+    """Like nvidia_get_available_gpus, but also returns the GPU usage.
+
+    Returns (available GPUs, GPUs used by us, {gpu: [(container, name, user,
+    uid, gpu_mem, reservation), ...]}), the latter including pending
+    reservations.
+    """
+    if not NV_ALLOWED_GPUS:
+        return [], [], {}
+
+    # the GPU and container probes are independent, so run them in parallel
+    (gpus, gpus_used_by_containers, gpu_health_problems,
+     mig_devices) = run_parallel([
+        (nvidia_get_gpus, ()),
+        (nvidia_get_gpus_used_by_containers, (docker,)),
+        (nvidia_get_gpu_health_problems, ()),
+        (nvidia_get_mig_devices, ()),
+    ])
+    mig_gpus = set(d.gpu for d in mig_devices)
+    # GPUs reserved for containers that are about to be started are used too
+    # (unless their container is listed already)
+    gpus_used_by_containers = defaultdict(list, gpus_used_by_containers)
+    started = set(
+        use[5] for uses in gpus_used_by_containers.values() for use in uses)
+    for r in read_gpu_reservations():
+        if r['token'] in started:
+            continue
+        for gpu in r['gpus']:
+            gpus_used_by_containers[gpu].append(
+                ('reservation:' + r['token'], '', r['user'], r['uid'],
+                 r.get('gpu_mem'), r['token']))
+    account_gpu_usage(gpus_used_by_containers)
     gpus_used_by_own_containers = [
         gpu for gpu, info in gpus_used_by_containers.items()
         if any(i[3] == uid for i in info)
     ]
 
-    # get available gpus asc by mem used and reservation counts
-    mem_limit = NV_GPU_UNAVAILABLE_ABOVE_MEMORY_USED
-    mem_res_gpu = [
-        (m, len(gpus_used_by_containers.get(gpu, [])), gpu)
-        for gpu, m in gpu_mem_used.items()
-    ]
-    available_gpus = [
-        g for m, r, g in sorted(mem_res_gpu) if mem_limit < 0 or m <= mem_limit
-    ]
+    # get available gpus, healthy ones first, asc by score (then reservation
+    # counts)
+    score_res_gpu = []
+    for gpu in gpus:
+        uses = gpus_used_by_containers.get(gpu.index, [])
+        reason = nvidia_gpu_unavailable(gpu)
+        if gpu.index in mig_gpus:
+            reason = 'in MIG mode'
+        unhealthy = gpu.index in gpu_health_problems
+        if unhealthy and NV_GPU_HEALTH_POLICY == 'exclude':
+            reason = 'unhealthy: %s' % '; '.join(
+                gpu_health_problems[gpu.index])
+        mem_left = 0
+        if not reason and gpu_mem is not None:
+            mem_free = _gpu_mem_free(gpu, uses)
+            if mem_free is not None:
+                mem_left = mem_free - gpu_mem
+                if mem_left < 0:
+                    reason = 'not enough free memory (%d MiB)' % mem_free
+        if reason:
+            logger.debug('GPU %d unavailable: %s', gpu.index, reason)
+            continue
+        if NV_EXCLUSIVE_CONTAINER_GPU_RESERVATION:
+            # no sharing, so nothing to pack
+            mem_left = 0
+        score_res_gpu.append((
+            unhealthy, mem_left, nvidia_gpu_score(gpu, len(uses)), len(uses),
+            gpu.index))
+    available_gpus = [g[-1] for g in sorted(score_res_gpu)]
     if NV_ALLOWED_GPUS != 'ALL':
         available_gpus = [g for g in available_gpus if g in NV_ALLOWED_GPUS]
+    if gpu_profile:
+        available_gpus = []
     logger.debug(
-        'available GPUs after mem and allowance filtering: %r', available_gpus)
+        'available GPUs after threshold and allowance filtering: %r',
+        available_gpus)
 
     if NV_EXCLUSIVE_CONTAINER_GPU_RESERVATION:
         available_gpus = [
@@ -103,4 +401,25 @@ def nvidia_get_available_gpus(docker, nvidia_smi=NVIDIA_SMI):
             if gpu not in gpus_used_by_containers
         ]
 
-    return available_gpus, gpus_used_by_own_containers
+    # MIG instances: healthy GPUs first, smallest profiles first
+    for d in sorted(mig_devices, key=lambda d: (
+            d.gpu in gpu_health_problems, mig_profile_sort_key(d.profile),
+            d.gpu, d.uuid)):
+        if gpu_profile and not mig_profile_matches(d.profile, gpu_profile):
+            continue
+        if not nvidia_gpu_allowed(d.uuid, mig_devices):
+            continue
+        if (
+                d.gpu in gpu_health_problems
+                and NV_GPU_HEALTH_POLICY == 'exclude'
+        ):
+            continue
+        if (
+                NV_EXCLUSIVE_CONTAINER_GPU_RESERVATION
+                and d.uuid in gpus_used_by_containers
+        ):
+            continue
+        available_gpus.append(d.uuid)
+
+    return (
+        available_gpus, gpus_used_by_own_containers, gpus_used_by_containers)
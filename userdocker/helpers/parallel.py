@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from .exceptions import ParallelTimeoutError
+
+
+def run_parallel(calls, timeout=None):
+    """Runs the given (func, args) calls in parallel and returns their results.
+
+    Exceptions raised by the calls are re-raised (the first one in order). If
+    not all calls finish within timeout seconds, a ParallelTimeoutError
+    containing the indices of the pending calls is raised. As the calls run in
+    daemon threads, calls that hang (e.g., in uninterruptible I/O on a stale
+    NFS mount) won't block userdocker from exiting.
+    """
+    results = [None] * len(calls)
+    errors = [None] * len(calls)
+    done = [threading.Event() for _ in calls]
+
+    def worker(i, func, args):
+        try:
+            results[i] = func(*args)
+        except BaseException as e:
+            errors[i] = e
+        finally:
+            done[i].set()
+
+    for i, (func, args) in enumerate(calls):
+        threading.Thread(
+            target=worker, args=(i, func, args), daemon=True).start()
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    for ev in done:
+        if deadline is None:
+            ev.wait()
+        else:
+            ev.wait(max(0, deadline - time.monotonic()))
+
+    for e in errors:
+        if e is not None:
+            raise e
+    pending = [i for i, ev in enumerate(done) if not ev.is_set()]
+    if pending:
+        raise ParallelTimeoutError(pending, timeout)
+    return results
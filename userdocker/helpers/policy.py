@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+"""Compiled authorization policy for images, port mappings and mounts of run.
+
+The policy is built once from the (admin) config and then answers each check
+without re-scanning the config lists: allowed regexps are compiled into a
+single alternation per category and mounts are looked up in hash indices.
+
+It can also be used standalone, e.g., by launchers to validate a lot of
+launch specs quickly:
+
+    policy = RunPolicy.from_config()
+    policy.image_allowed('debian:latest')
+    policy.resolve_mounts(['/data:/data:ro'])
+"""
+
+import re
+
+from ..config import ALLOWED_IMAGE_REGEXPS
+from ..config import ALLOWED_PORT_MAPPINGS
+from ..config import VOLUME_MOUNTS_ALWAYS
+from ..config import VOLUME_MOUNTS_AVAILABLE
+from ..config import VOLUME_MOUNTS_DEFAULT
+from .exceptions import UserDockerException
+
+
+def _compile_any_match(patterns):
+    """Returns a function telling if any of the regexps re.match()es a str."""
+    compiled = [re.compile(p) for p in patterns]
+    if not compiled:
+        return lambda s: False
+    default_flags = re.compile('').flags
+    if not any(c.groups or c.flags != default_flags for c in compiled):
+        # without groups (and thereby backrefs) combining them is equivalent,
+        # but global inline flags (e.g., (?i)) would apply to all of them
+        try:
+            combined = re.compile(
+                '|'.join('(?:%s)' % c.pattern for c in compiled))
+            return lambda s: combined.match(s) is not None
+        except re.error:
+            # e.g., flags that are only allowed at the start of a pattern
+            pass
+    return lambda s: any(c.match(s) for c in compiled)
+
+
+class RunPolicy(object):
+    def __init__(
+            self,
+            allowed_image_regexps=(),
+            allowed_port_mappings=(),
+            volume_mounts_always=(),
+            volume_mounts_default=(),
+            volume_mounts_available=(),
+    ):
+        self.allowed_image_regexps = list(allowed_image_regexps)
+        self.allowed_port_mappings = list(allowed_port_mappings)
+        self.volume_mounts_always = list(volume_mounts_always)
+        self.volume_mounts_default = list(volume_mounts_default)
+        self.volume_mounts_available = list(volume_mounts_available)
+
+        self._image_match = _compile_any_match(self.allowed_image_regexps)
+        self._port_mapping_match = _compile_any_match(
+            self.allowed_port_mappings)
+        self._mounts_available = frozenset(
+            self.volume_mounts_always
+            + self.volume_mounts_default
+            + self.volume_mounts_available
+        )
+
+    @classmethod
+    def from_config(cls):
+        return cls(
+            allowed_image_regexps=ALLOWED_IMAGE_REGEXPS,
+            allowed_port_mappings=ALLOWED_PORT_MAPPINGS,
+            volume_mounts_always=VOLUME_MOUNTS_ALWAYS,
+            volume_mounts_default=VOLUME_MOUNTS_DEFAULT,
+            volume_mounts_available=VOLUME_MOUNTS_AVAILABLE,
+        )
+
+    def image_allowed(self, img):
+        """Checks img (incl. tag or digest) against the allowed regexps."""
+        return not self.allowed_image_regexps or self._image_match(img)
+
+    def check_image(self, img):
+        if not self.image_allowed(img):
+            raise UserDockerException(
+                "ERROR: image %s not in allowed image regexps: %s" % (
+                    img, self.allowed_image_regexps))
+
+    def port_mapping_allowed(self, pm):
+        return self._port_mapping_match(pm)
+
+    def check_port_mapping(self, pm):
+        if not self.port_mapping_allowed(pm):
+            raise UserDockerException(
+                "ERROR: given port mapping not allowed: %s" % pm
+            )
+
+    def resolve_mounts(self, user_mounts=(), default_mounts=True):
+        """Returns the mounts for the given user mounts.
+
+        Includes the admin enforced (and default) mounts. Raises a
+        UserDockerException if a user mount isn't allowed.
+        """
+        mounts = list(self.volume_mounts_always)
+        if default_mounts:
+            mounts += self.volume_mounts_default
+        # mount: [indices in mounts]
+        mounts_idx = {}
+        for idx, mount in enumerate(mounts):
+            mounts_idx.setdefault(mount, []).append(idx)
+
+        def add(mount):
+            mounts_idx.setdefault(mount, []).append(len(mounts))
+            mounts.append(mount)
+
+        for user_mount in user_mounts:
+            if user_mount in mounts_idx:
+                continue
+            if user_mount in self._mounts_available:
+                add(user_mount)
+                continue
+
+            # literal matches didn't work, check if the user appended a 'ro'
+            # flag
+            parts = user_mount.split(':')
+            if len(parts) == 3:
+                host_path, container_path, flag = parts
+                if flag == 'ro':
+                    st = ':'.join([host_path, container_path])
+                    if st in mounts_idx:
+                        # upgrade (first) mount to include ro flag
+                        idx = mounts_idx[st].pop(0)
+                        if not mounts_idx[st]:
+                            del mounts_idx[st]
+                        mounts[idx] = user_mount
+                        mounts_idx.setdefault(user_mount, []).append(idx)
+                        continue
+                    if st in self._mounts_available:
+                        add(user_mount)
+                        continue
+
+            # allow potential unspecified container_path mounts
+            if parts[0] + ':' in self._mounts_available:
+                add(user_mount)
+                continue
+
+            raise UserDockerException(
+                "ERROR: given mount not allowed: %s" % user_mount
+            )
+        return mounts
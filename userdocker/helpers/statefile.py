@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+"""Host state shared between concurrent userdocker invocations.
+
+State files are small JSON files in STATE_DIR (a tmpfs like /run/userdocker/),
+written atomically (tempfile + rename), so they can be read without locking.
+Refreshes are serialized via fcntl locks on a separate lock file, so only one
+of many concurrent invocations finding a state stale actually probes the host,
+the others wait and then read its result.
+
+All of this is best effort: if the state dir can't be used (e.g., when not run
+via sudo), callers just probe the host themselves.
+"""
+
+import errno
+import fcntl
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+from ..config import STATE_DIR
+from ..config.cache import is_trusted
+from .logger import logger
+
+
+def state_file_name(name):
+    return os.path.join(STATE_DIR, name + '.json')
+
+
+def _ensure_state_dir():
+    os.makedirs(STATE_DIR, mode=0o700, exist_ok=True)
+    if not is_trusted(os.stat(STATE_DIR)):
+        raise OSError(
+            errno.EPERM, 'state dir not trusted (owner or permissions)',
+            STATE_DIR)
+
+
+@contextmanager
+def locked_state(name, timeout=None):
+    """Holds an exclusive lock for state name.
+
+    Yields True if locked, False if the lock couldn't be acquired within
+    timeout seconds and None if locking isn't possible (e.g., no STATE_DIR).
+    """
+    lock_fn = os.path.join(STATE_DIR, name + '.lock')
+    try:
+        _ensure_state_dir()
+        fd = os.open(lock_fn, os.O_RDWR | os.O_CREAT, 0o600)
+    except OSError as e:
+        logger.debug('state %s: not locking: %s', name, e)
+        yield None
+        return
+    try:
+        if timeout is None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        else:
+            deadline = time.time() + timeout
+            delay = 0.005
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except OSError as e:
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                if time.time() >= deadline:
+                    logger.debug('state %s: lock timeout', name)
+                    yield False
+                    return
+                time.sleep(delay)
+                delay = min(delay * 2, 0.1)
+        yield True
+    finally:
+        os.close(fd)  # releases the lock
+
+
+def read_state(name):
+    """Returns (time, data) of state name or (None, None) if not available."""
+    try:
+        with open(state_file_name(name)) as f:
+            if not is_trusted(os.fstat(f.fileno())):
+                return None, None
+            state = json.load(f)
+        return state['time'], state['data']
+    except (OSError, ValueError, KeyError, TypeError):
+        return None, None
+
+
+def write_state(name, data, t=None):
+    fn = state_file_name(name)
+    try:
+        _ensure_state_dir()
+        fd, tmp_fn = tempfile.mkstemp(dir=STATE_DIR, prefix='.tmp_')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'time': time.time() if t is None else t,
+                           'data': data}, f)
+            os.replace(tmp_fn, fn)
+        except BaseException:
+            os.unlink(tmp_fn)
+            raise
+    except OSError as e:
+        logger.debug('state %s: not written: %s', name, e)
+
+
+def _invalidated_at(name):
+    try:
+        return os.stat(os.path.join(STATE_DIR, name + '.invalidated')).st_mtime
+    except OSError:
+        return None
+
+
+def invalidate_state(name):
+    """Marks state name as stale (e.g., after the host state changed).
+
+    Probes that started before this are not written back either.
+    """
+    fn = os.path.join(STATE_DIR, name + '.invalidated')
+    try:
+        _ensure_state_dir()
+        with open(fn, 'a'):
+            pass
+        t = time.time()
+        os.utime(fn, (t, t))
+    except OSError as e:
+        logger.debug('state %s: not invalidated: %s', name, e)
+
+
+def _fresh(name, t, ttl):
+    if t is None or not 0 <= time.time() - t < ttl:
+        return False
+    invalidated = _invalidated_at(name)
+    return invalidated is None or t > invalidated
+
+
+def cached_state(name, ttl, probe, lock_timeout=None):
+    """Returns the shared state name if younger than ttl seconds, else probe().
+
+    The result of probe() (must be JSON serializable) is shared with all other
+    invocations. Concurrent invocations finding the state stale wait (up to
+    lock_timeout seconds) for the first one to refresh it instead of probing
+    themselves.
+    """
+    if ttl <= 0:
+        return probe()
+    t, data = read_state(name)
+    if _fresh(name, t, ttl):
+        logger.debug('state %s: using cached state from %.3f', name, t)
+        return data
+    with locked_state(name, lock_timeout) as locked:
+        if locked:
+            # someone else might have refreshed it while we waited
+            t, data = read_state(name)
+            if _fresh(name, t, ttl):
+                logger.debug('state %s: refreshed by other process', name)
+                return data
+        t = time.time()
+        data = probe()
+        if locked:
+            invalidated = _invalidated_at(name)
+            if invalidated is None or t > invalidated:
+                write_state(name, data, t=t)
+        return data
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import math
+import numbers
+import re
+from collections import OrderedDict
+
+
+# binary multiples, like docker (e.g., --shm-size=1g means 1 GiB)
+_SIZE_UNITS = {
+    '': 1,
+    'b': 1,
+    'k': 1024,
+    'm': 1024 ** 2,
+    'g': 1024 ** 3,
+    't': 1024 ** 4,
+}
+_SIZE_RE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([bkmgt]?)(?:i?b)?\s*$', re.I)
+
+MIB = 1024 ** 2
+
+
+def parse_size(s):
+    """Parses a size like 512m, 6G, 1.5GiB or 1024 (bytes) into bytes.
+
+    s can also be a number of bytes (e.g., 1.5e9 in the config). Raises a
+    ValueError if s can't be parsed.
+    """
+    if isinstance(s, numbers.Real):
+        if not math.isfinite(s) or s < 0:
+            raise ValueError('invalid size: %r' % s)
+        return int(s)
+    if not isinstance(s, str):
+        raise ValueError('invalid size: %r' % (s,))
+    m = _SIZE_RE.match(s)
+    if not m:
+        raise ValueError('invalid size: %r' % s)
+    num, unit = m.groups()
+    return int(float(num) * _SIZE_UNITS[unit.lower()])
+
+
+def format_size(n):
+    """Formats a number of bytes like docker understands it (e.g., 6g)."""
+    for unit in 'tgmk':
+        if n and n % _SIZE_UNITS[unit] == 0:
+            return '%d%s' % (n // _SIZE_UNITS[unit], unit)
+    return '%d' % n
+
+
+_DURATION_UNITS = OrderedDict((
+    ('d', 24 * 60 * 60),
+    ('h', 60 * 60),
+    ('m', 60),
+    ('s', 1),
+))
+_DURATION_RE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([dhms]?)\s*$', re.I)
+
+
+def parse_duration(s):
+    """Parses a duration like 90, 30m, 12h or 7d into seconds.
+
+    Raises a ValueError if s can't be parsed.
+    """
+    m = _DURATION_RE.match(s)
+    if not m:
+        raise ValueError('invalid duration: %r' % s)
+    num, unit = m.groups()
+    return float(num) * _DURATION_UNITS.get(unit.lower(), 1)
+
+
+def format_duration(seconds):
+    """Formats seconds in the 2 largest units (e.g., 3d4h, 5m30s)."""
+    seconds = int(seconds)
+    parts = []
+    for unit, n in _DURATION_UNITS.items():
+        if seconds >= n or (unit == 's' and not parts):
+            parts.append('%d%s' % (seconds // n, unit))
+            seconds %= n
+        elif parts:
+            break
+        if len(parts) == 2:
+            break
+    return ''.join(parts)
@@ -10,13 +10,36 @@ from .config import ALLOWED_SUBCOMMANDS
 from .config import EXECUTOR_DEFAULT
 from .config import EXECUTORS
 from .config import LOGLVL
+from .config import uid
 from .helpers.parser import init_subcommand_parser
 
 # dispatch specific specific_parsers to those defined in subcommands package
-from .subcommands import specific_parsers
+from .subcommands import ADMIN_SUBCOMMANDS
+from .subcommands import get_specific_parser
 
 
-def parse_args():
+def _peek_subcommand(argv):
+    """Returns the subcommand in argv (if any) without building any parsers.
+
+    Returns None if help for all subcommands is requested.
+    """
+    argv = iter(argv)
+    for arg in argv:
+        if arg == '--executor':
+            next(argv, None)  # skip its value
+        elif arg in ('-h', '--help') or (
+                arg.startswith('-') and not arg.startswith('--')
+                and 'h' in arg):
+            return None
+        elif not arg.startswith('-'):
+            return arg
+    return None
+
+
+def parse_args(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
     parser = argparse.ArgumentParser(
         description=__doc__.strip(),
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -63,13 +86,21 @@ def parse_args():
     subparsers = parser.add_subparsers(dest="subcommand")
     subparsers.required = True
 
-    for scmd in ALLOWED_SUBCOMMANDS:
-        specific_parser = specific_parsers.get(scmd)
+    # only build the sub-parser of the invoked subcommand (unless in doubt or
+    # the full help is requested), as some are expensive to build and import
+    allowed_subcommands = list(ALLOWED_SUBCOMMANDS)
+    if uid == 0:
+        allowed_subcommands += ADMIN_SUBCOMMANDS
+    scmd = _peek_subcommand(argv)
+    scmds = [scmd] if scmd in allowed_subcommands else allowed_subcommands
+
+    for scmd in scmds:
+        specific_parser = get_specific_parser(scmd)
         if specific_parser:
             specific_parser(subparsers)
         else:
             init_subcommand_parser(subparsers, scmd)
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     args.executor_path = EXECUTORS[args.executor]
     return args
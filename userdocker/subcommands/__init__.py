@@ -1,25 +1,49 @@
 # -*- coding: utf-8 -*-
 
-from .attach import *
-from .dockviz import *
-from .images import *
-from .ps import *
-from .pull import *
-from .run import *
-from .version import *
+"""Subcommand specific parsers and command executors.
 
-SPECIFIC_PARSER_PREFIX = 'parser_'
-specific_parsers = {
-    _var.split(SPECIFIC_PARSER_PREFIX)[1]: _val
-    for _var, _val in globals().items()
-    if _var.startswith(SPECIFIC_PARSER_PREFIX)
-}
+A module in this package can define a parser_<subcommand> and/or an
+exec_cmd_<subcommand> function. To keep startup fast, the modules are only
+imported when their subcommand is actually used.
+"""
+
+from importlib import import_module
+
+# modules in this package (dashes in subcommand names become underscores)
+SPECIFIC_SUBCOMMANDS = (
+    'attach',
+    'dockviz',
+    'gpu_sample',
+    'images',
+    'ps',
+    'pull',
+    'run',
+    'version',
+)
 
+# userdocker's own admin subcommands, only available to root
+ADMIN_SUBCOMMANDS = (
+    'gpu-sample',
+)
+
+SPECIFIC_PARSER_PREFIX = 'parser_'
 SPECIFIC_CMD_EXECUTOR_PREFIX = 'exec_cmd_'
-specific_command_executors = {
-    _var.split(SPECIFIC_CMD_EXECUTOR_PREFIX)[1]: _val
-    for _var, _val in globals().items()
-    if _var.startswith(SPECIFIC_CMD_EXECUTOR_PREFIX)
-}
 
-__all__ = [specific_parsers, specific_command_executors]
+
+def _get_specific(scmd, prefix):
+    name = scmd.replace('-', '_')
+    if name not in SPECIFIC_SUBCOMMANDS:
+        return None
+    module = import_module('.' + name, __name__)
+    return getattr(module, prefix + name, None)
+
+
+def get_specific_parser(scmd):
+    return _get_specific(scmd, SPECIFIC_PARSER_PREFIX)
+
+
+def get_specific_command_executor(scmd):
+    return _get_specific(scmd, SPECIFIC_CMD_EXECUTOR_PREFIX)
+
+
+__all__ = [get_specific_parser, get_specific_command_executor]
@@ -1,12 +1,10 @@
 # -*- coding: utf-8 -*-
 
-import json
-import logging
-
 from ..config import uid
 from ..helpers.cmd import init_cmd
+from ..helpers.container import LABEL_UID
+from ..helpers.container import container_inspect
 from ..helpers.exceptions import UserDockerException
-from ..helpers.execute import exec_cmd
 from ..helpers.execute import exit_exec_cmd
 from ..helpers.logger import logger
 from ..helpers.parser import init_subcommand_parser
@@ -36,29 +34,27 @@ def exec_cmd_attach(args):
     cmd += [container]
 
     # check if we're allowed to attach to container (if it's ours)
-    container_env = exec_cmd(
-        [
-            args.executor_path, 'inspect',
-            '--format', '{{json .Config.Env}}',
-            container
-        ],
-        return_status=False,
-        loglvl=logging.DEBUG,
-    )
-    if not container_env:
+    container_info = container_inspect(
+        args.executor_path, [container], ['Config.Labels', 'Config.Env'])
+    if not container_info:
         raise UserDockerException(
             'ERROR: could not find container %s' % container
         )
+    container_labels = container_info[0]['Config.Labels'] or {}
     userdocker_uid_env = [
-        env for env in json.loads(container_env)
+        env for env in container_info[0]['Config.Env'] or []
         if env.startswith('USERDOCKER_UID')
     ]
-    if not userdocker_uid_env:
+    if LABEL_UID in container_labels:
+        userdocker_uid = int(container_labels[LABEL_UID])
+    elif userdocker_uid_env:
+        # container started by an older userdocker version
+        userdocker_uid = int(userdocker_uid_env[0].split('USERDOCKER_UID=')[1])
+    else:
         raise UserDockerException(
-            'ERROR: could not find USERDOCKER_UID env var in container %s'
-            % container
+            'ERROR: could not find %s label or USERDOCKER_UID env var in '
+            'container %s' % (LABEL_UID, container)
         )
-    userdocker_uid = int(userdocker_uid_env[0].split('USERDOCKER_UID=')[1])
     logger.debug(
         "Container %s was started by user id %d", container, userdocker_uid)
     if uid != userdocker_uid:
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from ..config import NV_GPU_HISTORY_FILE
+from ..config import NV_GPU_STATUS_SAMPLES
+from ..config import NV_GPU_STATUS_SAMPLE_INTERVAL
+from ..config import uid
+from ..helpers.exceptions import UserDockerException
+from ..helpers.gpu_backend import get_gpu_backend
+from ..helpers.gpu_history import append_gpu_sample
+from ..helpers.logger import logger
+
+
+def parser_gpu_sample(parser):
+    sub_parser = parser.add_parser(
+        'gpu-sample',
+        help='(root only) appends a sample of the GPU utilization and memory '
+             'used to the GPU history (%s), e.g., run from cron every '
+             'minute. See ps --gpu-idle.' % NV_GPU_HISTORY_FILE,
+    )
+    sub_parser.set_defaults(
+        patch_through_args=[],
+    )
+
+    sub_parser.add_argument(
+        "--every",
+        help="don't exit after one sample, but keep sampling every SECONDS "
+             "seconds (e.g., as a service)",
+        type=float,
+        metavar="SECONDS",
+    )
+
+
+def exec_cmd_gpu_sample(args):
+    if uid != 0:
+        raise UserDockerException(
+            'ERROR: gpu-sample can only be run by root')
+
+    backend = get_gpu_backend()
+    while True:
+        start = time.time()
+        gpus = backend.gpus(
+            samples=NV_GPU_STATUS_SAMPLES,
+            interval=NV_GPU_STATUS_SAMPLE_INTERVAL,
+        )
+        logger.debug('GPU sample: %s', gpus)
+        if not args.dry_run:
+            append_gpu_sample(gpus, t=start)
+        if not args.every:
+            break
+        time.sleep(max(args.every - (time.time() - start), 0))
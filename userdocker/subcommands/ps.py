@@ -1,9 +1,35 @@
 # -*- coding: utf-8 -*-
+import argparse
+import json
+import time
+
+from ..config import NV_GPU_IDLE_DURATION
+from ..config import NV_GPU_IDLE_UTILIZATION
+from ..config import uid
 from ..helpers.cmd import init_cmd
 from ..helpers.execute import exit_exec_cmd
+from ..helpers.gpu_health import gpu_health_problems
+from ..helpers.gpu_health import nvidia_get_gpu_health
+from ..helpers.gpu_history import gpu_idle_times
+from ..helpers.gpu_procs import gpu_processes_by_container
+from ..helpers.gpu_queue import read_gpu_queue
 from ..helpers.nvidia import nvidia_get_available_gpus
+from ..helpers.nvidia import gpu_sort_key
 from ..helpers.nvidia import nvidia_get_gpus_used_by_containers
 from ..helpers.parser import init_subcommand_parser
+from ..helpers.units import format_duration
+from ..helpers.units import parse_duration
+
+
+def _fmt_optional(val, fmt=str):
+    return '-' if val is None else fmt(val)
+
+
+def _duration(s):
+    try:
+        return parse_duration(s)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
 
 
 def parser_ps(parser):
@@ -28,23 +54,159 @@ def parser_ps(parser):
         action="store_true",
     )
 
+    arg_group.add_argument(
+        "--gpu-queue",
+        help="show runs waiting for GPUs (run --wait-for-gpu) in the order "
+             "they will be served",
+        action="store_true",
+    )
+
+    arg_group.add_argument(
+        "--gpu-procs",
+        help="show the compute processes on GPUs per container with their GPU "
+             "memory usage, processes on GPUs not reserved for their "
+             "container are marked as squatters",
+        action="store_true",
+    )
+
+    arg_group.add_argument(
+        "--gpu-idle",
+        help="show containers holding GPUs that were idle (utilization <= "
+             "%d %%) for at least DURATION (e.g., 30m, 12h, 2d, default: "
+             "%s), based on the GPU history (see gpu-sample)" % (
+                 NV_GPU_IDLE_UTILIZATION,
+                 format_duration(NV_GPU_IDLE_DURATION)),
+        nargs="?",
+        const=NV_GPU_IDLE_DURATION,
+        type=_duration,
+        metavar="DURATION",
+    )
+
+    arg_group.add_argument(
+        "--gpu-health",
+        help="show the health of the GPUs (clock throttling, ECC errors, "
+             "retired pages, persistence mode, PCIe link) and their problems",
+        action="store_true",
+    )
+
+    sub_parser.add_argument(
+        "--json",
+        help="print --gpu-procs, --gpu-idle and --gpu-health in JSON format",
+        action="store_true",
+    )
+
 
 def exec_cmd_ps(args):
-    if not args.gpu_used and not args.gpu_free and not args.gpu_used_mine:
+    if not (
+            args.gpu_used or args.gpu_free or args.gpu_used_mine
+            or args.gpu_queue or args.gpu_procs
+            or args.gpu_idle is not None or args.gpu_health):
         exit_exec_cmd(init_cmd(args), dry_run=args.dry_run)
 
     if args.gpu_used:
         gpus_used = nvidia_get_gpus_used_by_containers(args.executor_path)
         if gpus_used:
             print("\t".join(("GPU", "Container", "ContainerName", "User")))
-        for i, l in sorted(gpus_used.items()):
-            for container, container_name, user, _ in sorted(l):
+        for i, l in sorted(
+                gpus_used.items(), key=lambda item: gpu_sort_key(item[0])):
+            for container, container_name, user, _, _, _ in sorted(l):
                 print("\t".join((str(i), container, container_name, user)))
     elif args.gpu_used_mine:
-        available_gpus, own_gpus = nvidia_get_available_gpus(args.executor_path)
-        for gpu in own_gpus:
+        own_gpus = nvidia_get_gpus_used_by_containers(
+            args.executor_path, owner_uid=uid)
+        for gpu in sorted(own_gpus, key=gpu_sort_key):
             print(gpu)
     elif args.gpu_free:
         available_gpus, own_gpus = nvidia_get_available_gpus(args.executor_path)
         for gpu in available_gpus:
             print(gpu)
+    elif args.gpu_queue:
+        queue = read_gpu_queue()
+        if queue:
+            print("\t".join(("Position", "User", "GPUs", "Waiting")))
+        now = time.time()
+        for pos, entry in enumerate(queue, 1):
+            print("\t".join((
+                str(pos),
+                entry['user'] + (' (you)' if entry['uid'] == uid else ''),
+                entry['nv_gpu'] or str(entry['count']),
+                '%ds' % (now - entry['time']),
+            )))
+    elif args.gpu_procs:
+        rows = gpu_processes_by_container(args.executor_path)
+        if args.json:
+            print(json.dumps(rows, indent=2))
+            return
+        if rows:
+            print("\t".join((
+                "GPU", "Container", "ContainerName", "User", "PIDs",
+                "MemoryMiB", "Squatter")))
+        for row in rows:
+            print("\t".join((
+                str(row['gpu']),
+                row['container'] or '-',
+                row['name'] or '-',
+                row['user'],
+                ','.join(str(pid) for pid in row['pids']),
+                '%d' % row['mem_used'] if row['mem_used'] is not None
+                else '-',
+                'yes' if row['squatter'] else 'no',
+            )))
+    elif args.gpu_idle is not None:
+        gpus_used = nvidia_get_gpus_used_by_containers(args.executor_path)
+        idle = gpu_idle_times(gpus_used, args.gpu_idle)
+        idle_gpus_used = {
+            gpu: l for gpu, l in gpus_used.items() if gpu in idle}
+        rows = [
+            {
+                'gpu': gpu,
+                'container': container,
+                'name': container_name,
+                'user': user,
+                'uid': container_uid,
+                'idle_seconds': int(idle[gpu][0]),
+                'mem_used': idle[gpu][1],
+            }
+            for gpu, l in sorted(idle_gpus_used.items())
+            for (container, container_name, user, container_uid,
+                 _, _) in sorted(l)
+        ]
+        if args.json:
+            print(json.dumps(rows, indent=2))
+            return
+        if rows:
+            print("\t".join((
+                "GPU", "Container", "ContainerName", "User", "IdleFor",
+                "MemoryMiB")))
+        for row in rows:
+            print("\t".join((
+                str(row['gpu']), row['container'], row['name'], row['user'],
+                format_duration(row['idle_seconds']), str(row['mem_used']),
+            )))
+    elif args.gpu_health:
+        rows = []
+        for gpu, health in sorted(nvidia_get_gpu_health().items()):
+            row = health._asdict()
+            row['problems'] = gpu_health_problems(health)
+            rows.append(row)
+        if args.json:
+            print(json.dumps(rows, indent=2))
+            return
+        if rows:
+            print("\t".join((
+                "GPU", "Throttling", "ECCErrors", "RetiredPages",
+                "Persistence", "PCIe", "Problems")))
+        for row in rows:
+            print("\t".join((
+                str(row['index']),
+                _fmt_optional(row['throttle_reasons'], ','.join) or 'none',
+                _fmt_optional(row['ecc_errors']),
+                _fmt_optional(row['retired_pages']) + (
+                    ' (pending)' if row['retired_pages_pending'] else ''),
+                _fmt_optional(
+                    row['persistence_mode'], lambda v: 'on' if v else 'off'),
+                'gen%s/%s x%s/%s' % tuple(_fmt_optional(row[k]) for k in (
+                    'pcie_gen', 'pcie_gen_max', 'pcie_width',
+                    'pcie_width_max')),
+                '; '.join(row['problems']) or 'ok',
+            )))
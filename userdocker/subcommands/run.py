@@ -3,7 +3,7 @@
 import argparse
 import logging
 import os
-import re
+from collections import OrderedDict
 
 from .. import __version__
 from ..config import ALLOWED_IMAGE_REGEXPS
@@ -12,12 +12,20 @@ from ..config import CAPS_ADD
 from ..config import CAPS_DROP
 from ..config import ENV_VARS
 from ..config import ENV_VARS_EXT
+from ..config import EXECUTORS
 from ..config import NV_ALLOW_OWN_GPU_REUSE
 from ..config import NV_ALLOWED_GPUS
 from ..config import NV_DEFAULT_GPU_COUNT_RESERVATION
+from ..config import NV_GPU_CPU_AFFINITY
+from ..config import NV_GPU_MIG
+from ..config import NV_GPU_WAIT_TIMEOUT_MAX
 from ..config import NV_MAX_GPU_COUNT_RESERVATION
+from ..config import MOUNT_PROBE_TIMEOUT
 from ..config import PROBE_USED_MOUNTS
 from ..config import RUN_PULL
+from ..config import RUN_SHM_SIZE
+from ..config import RUN_TMPFS
+from ..config import RUN_ULIMITS
 from ..config import USER_IN_CONTAINER
 from ..config import VOLUME_MOUNTS_ALWAYS
 from ..config import VOLUME_MOUNTS_AVAILABLE
@@ -26,12 +34,83 @@ from ..config import gid
 from ..config import uid
 from ..config import user_name
 from ..helpers.cmd import init_cmd
+from ..helpers.container import LABEL_CPUSET
+from ..helpers.container import LABEL_LIMIT_PREFIX
+from ..helpers.container import LABEL_NV_GPU
+from ..helpers.container import LABEL_NV_GPU_MEM
+from ..helpers.container import LABEL_NV_GPU_RESERVATION
+from ..helpers.container import LABEL_UID
+from ..helpers.container import LABEL_USER
+from ..helpers.container import LABEL_VERSION
+from ..helpers.container import image_available_locally
+from ..helpers.exceptions import GPUsUnavailableException
+from ..helpers.exceptions import ParallelTimeoutError
 from ..helpers.exceptions import UserDockerException
 from ..helpers.execute import exec_cmd
 from ..helpers.execute import exit_exec_cmd
+from ..helpers.gpu_affinity import format_cpulist
+from ..helpers.gpu_affinity import nvidia_gpu_cpuset
+from ..helpers.gpu_queue import gpu_queue
+from ..helpers.gpu_queue import gpu_queue_waiting_for
+from ..helpers.gpu_quota import check_gpu_quota
+from ..helpers.gpu_reservation import gpu_reservation
+from ..helpers.gpu_reservation import release_gpu_reservation
+from ..helpers.gpu_reservation import read_gpu_reservations
+from ..helpers.gpu_topology import nvidia_select_gpus
+from ..helpers.limits import RUN_LIMIT_OPTIONS
+from ..helpers.limits import check_user_run_limits
+from ..helpers.limits import format_run_limit
+from ..helpers.limits import managed_run_limits
+from ..helpers.limits import parse_run_limit
+from ..helpers.limits import parse_shm_size
+from ..helpers.limits import parse_tmpfs
+from ..helpers.limits import parse_ulimit
+from ..helpers.limits import passed_through
+from ..helpers.limits import resolve_run_limits
+from ..helpers.limits import resolve_shm_size
+from ..helpers.limits import resolve_tmpfs
+from ..helpers.limits import resolve_ulimits
+from ..helpers.limits import run_limit_args
+from ..helpers.limits import run_limit_help
+from ..helpers.limits import shm_size_help
+from ..helpers.limits import tmpfs_help
+from ..helpers.limits import ulimit_help
 from ..helpers.logger import logger
-from ..helpers.nvidia import nvidia_get_available_gpus
+from ..helpers.nvidia import nvidia_get_gpu_status
+from ..helpers.nvidia import nvidia_gpu_allowed
+from ..helpers.nvidia import nvidia_invalidate_gpus_used_by_containers
+from ..helpers.nvidia import nvidia_parse_gpu
+from ..helpers.parallel import run_parallel
+from ..helpers.policy import RunPolicy
 from ..helpers.parser import init_subcommand_parser
+from ..helpers.units import MIB
+from ..helpers.units import format_size
+from ..helpers.units import parse_size
+
+
+def _gpu_mem_size(s):
+    """Parses a GPU memory size (like 6G) into MiB (rounded up)."""
+    try:
+        size = parse_size(s)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    if size <= 0:
+        raise argparse.ArgumentTypeError('size must be positive: %r' % s)
+    return -(-size // MIB)
+
+
+def _argument_type(parse):
+    """Turns the ValueErrors of parse into argparse errors."""
+    def parse_arg(s):
+        try:
+            return parse(s)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
+    return parse_arg
+
+
+def _run_limit_type(option):
+    return _argument_type(lambda s: parse_run_limit(option, s))
 
 
 def parser_run(parser):
@@ -60,6 +139,88 @@ def parser_run(parser):
             default=[],
         )
 
+    for option in managed_run_limits():
+        sub_parser.add_argument(
+            *RUN_LIMIT_OPTIONS[option][0],
+            help=run_limit_help(option),
+            type=_run_limit_type(option),
+            metavar='SIZE' if option.startswith('memory') else 'N',
+            dest='limit_' + option.replace('-', '_')
+        )
+    sub_parser.set_defaults(**{
+        'limit_' + option.replace('-', '_'): None
+        for option in RUN_LIMIT_OPTIONS
+    })
+
+    if RUN_SHM_SIZE is not None and not passed_through('--shm-size'):
+        sub_parser.add_argument(
+            "--shm-size",
+            help=shm_size_help(),
+            type=_argument_type(parse_shm_size),
+            metavar="SIZE",
+        )
+    if RUN_ULIMITS and not passed_through('--ulimit'):
+        sub_parser.add_argument(
+            "--ulimit",
+            help=ulimit_help(),
+            type=_argument_type(parse_ulimit),
+            action="append",
+            dest="ulimits",
+            metavar="NAME=SOFT[:HARD]",
+        )
+    if RUN_TMPFS and not passed_through('--tmpfs'):
+        sub_parser.add_argument(
+            "--tmpfs",
+            help=tmpfs_help(),
+            type=_argument_type(parse_tmpfs),
+            action="append",
+            metavar="PATH[:size=SIZE]",
+        )
+    sub_parser.set_defaults(shm_size=None, ulimits=[], tmpfs=[])
+
+    if NV_GPU_WAIT_TIMEOUT_MAX > 0 and 'nvidia-docker' in EXECUTORS:
+        # not a single option with an optional value, as that would swallow
+        # the image in: --wait-for-gpu image
+        sub_parser.add_argument(
+            "--wait-for-gpu",
+            help="if no GPUs are available, wait in a (fair) queue for them "
+                 "to become available (nvidia-docker only, for up to %d "
+                 "seconds). See ps --gpu-queue." % NV_GPU_WAIT_TIMEOUT_MAX,
+            action="store_const",
+            const=-1,
+        )
+        sub_parser.add_argument(
+            "--wait-for-gpu-timeout",
+            help="like --wait-for-gpu, but only wait for up to TIMEOUT "
+                 "seconds",
+            type=float,
+            metavar="TIMEOUT",
+            dest="wait_for_gpu",
+        )
+    sub_parser.set_defaults(wait_for_gpu=None)
+
+    if 'nvidia-docker' in EXECUTORS:
+        sub_parser.add_argument(
+            "--gpu-mem",
+            help="GPU memory the container will use per GPU (e.g., 6G). Only "
+                 "GPUs with that much free memory are selected. If GPUs are "
+                 "shared between containers, they're packed by it "
+                 "(nvidia-docker only).",
+            type=_gpu_mem_size,
+            metavar="SIZE",
+        )
+    sub_parser.set_defaults(gpu_mem=None)
+
+    if NV_GPU_MIG and 'nvidia-docker' in EXECUTORS:
+        sub_parser.add_argument(
+            "--gpu-profile",
+            help="instead of whole GPUs, acquire a MIG instance with the given "
+                 "profile (e.g., 1g or 1g.5gb). See ps --gpu-free for "
+                 "available instances (nvidia-docker only).",
+            metavar="PROFILE",
+        )
+    sub_parser.set_defaults(gpu_profile=None)
+
     sub_parser.add_argument(
         "--entrypoint",
         help="Overwrite the default ENTRYPOINT of the image",
@@ -95,6 +256,8 @@ def parser_run(parser):
 def prepare_nvidia_docker_run(args):
     # mainly handles GPU arbitration via ENV var for nvidia-docker
     # note that these are ENV vars for the command, not the container
+    # returns the token of the GPU reservation (None for dry runs) and the
+    # CPUSet to pin the container to (None if not pinned)
 
     if os.getenv('NV_HOST'):
         raise UserDockerException('ERROR: NV_HOST env var not supported yet')
@@ -105,20 +268,79 @@ def prepare_nvidia_docker_run(args):
             "ERROR: No GPUs available due to admin setting."
         )
 
+    # GPU selection is serialized with concurrent launches, the selected GPUs
+    # stay reserved (for others) until the container is running
+    if args.wait_for_gpu is None:
+        with gpu_reservation(args.executor_path, args.dry_run) as reserve:
+            return _nvidia_reserve(args, reserve, queued=False)
+
+    timeout = args.wait_for_gpu
+    if timeout < 0 or timeout > NV_GPU_WAIT_TIMEOUT_MAX:
+        timeout = NV_GPU_WAIT_TIMEOUT_MAX
+    nv_gpu = os.getenv('NV_GPU', '')
+    if nv_gpu:
+        count = len(nv_gpu.split(','))
+    elif args.gpu_profile:
+        # shown in ps --gpu-queue
+        count = 1
+        nv_gpu = 'MIG %s' % args.gpu_profile
+    else:
+        count = NV_DEFAULT_GPU_COUNT_RESERVATION
+    with gpu_queue(count, nv_gpu, timeout) as wait_turn:
+        retry = False
+        while True:
+            wait_turn()
+            try:
+                with gpu_reservation(
+                        args.executor_path, args.dry_run) as reserve:
+                    return _nvidia_reserve(args, reserve, quiet=retry)
+            except GPUsUnavailableException as e:
+                logger.debug('GPUs not available yet: %s', e)
+            retry = True
+
+
+def _nvidia_reserve(args, reserve, quiet=False, queued=True):
+    # selects and reserves GPUs (and the CPUs to pin the container to)
+    gpus = _nvidia_select_gpus(args, quiet=quiet)
+    waiting = [] if queued else gpu_queue_waiting_for(gpus)
+    if waiting:
+        # don't overtake the queue
+        msg = (
+            'ERROR: %d run(s) are waiting for these GPUs in the queue.\nUse:\n'
+            '"sudo userdocker ps --gpu-queue" to see the queue.' % (
+                len(waiting),)
+        )
+        if NV_GPU_WAIT_TIMEOUT_MAX > 0:
+            msg += '\nUse "--wait-for-gpu" to wait in the queue as well.'
+        raise GPUsUnavailableException(msg)
+    cpuset = None
+    if NV_GPU_CPU_AFFINITY and not passed_through(
+            '--cpuset-cpus', '--cpuset-mems'):
+        cpuset = nvidia_gpu_cpuset(
+            args.executor_path, gpus, read_gpu_reservations())
+    token = reserve(
+        gpus, args.gpu_mem,
+        cpuset.cpus if cpuset and cpuset.exclusive else None)
+    return token, cpuset
+
+
+def _nvidia_select_gpus(args, quiet=False):
     nv_gpus = os.getenv('NV_GPU', '')
+    if nv_gpus and args.gpu_profile:
+        raise UserDockerException(
+            "ERROR: NV_GPU and --gpu-profile can't be combined"
+        )
     if nv_gpus:
         # the user has set NV_GPU, just check if it's ok
-        nv_gpus = [g.strip() for g in nv_gpus.split(',')]
         try:
-            nv_gpus = [int(gpu) for gpu in nv_gpus]
+            nv_gpus = [nvidia_parse_gpu(gpu) for gpu in nv_gpus.split(',')]
         except ValueError as e:
             raise UserDockerException(
-                "ERROR: Can't parse NV_GPU, use index notation: %s" % e
+                "ERROR: Can't parse NV_GPU, use index notation%s: %s" % (
+                    ' or MIG UUIDs' if NV_GPU_MIG else '', e)
             )
 
-        if not (
-                NV_ALLOWED_GPUS == 'ALL'
-                or all(gpu in NV_ALLOWED_GPUS for gpu in nv_gpus)):
+        if not all(nvidia_gpu_allowed(gpu) for gpu in nv_gpus):
             raise UserDockerException(
                 "ERROR: Access to at least one specified NV_GPU denied by "
                 "admin. Available GPUs: %r" % (NV_ALLOWED_GPUS,)
@@ -132,13 +354,15 @@ def prepare_nvidia_docker_run(args):
             )
 
         # check if available
-        gpus_available, own_gpus = nvidia_get_available_gpus(args.executor_path)
+        gpus_available, own_gpus, gpus_used = nvidia_get_gpu_status(
+            args.executor_path, args.gpu_mem)
+        check_gpu_quota(gpus_used, nv_gpus)
         if NV_ALLOW_OWN_GPU_REUSE:
             gpus_available.extend(own_gpus)
         for g in nv_gpus:
             if g not in gpus_available:
                 msg = (
-                    'ERROR: GPU %d is currently not available!\nUse:\n'
+                    'ERROR: GPU %s is currently not available!\nUse:\n'
                     '"sudo userdocker ps --gpu-free" to find available GPUs.\n'
                     '"sudo userdocker ps --gpu-used" and "nvidia-smi" to see '
                     'status.' % g
@@ -146,95 +370,121 @@ def prepare_nvidia_docker_run(args):
                 if NV_ALLOW_OWN_GPU_REUSE and own_gpus:
                     msg += '\n"sudo userdocker ps --gpu-used-mine to show own' \
                            '(reusable) GPUs.'
-                raise UserDockerException(msg)
+                if NV_GPU_WAIT_TIMEOUT_MAX > 0:
+                    msg += '\nUse "--wait-for-gpu" to wait for the GPU to ' \
+                           'become available.'
+                raise GPUsUnavailableException(msg)
+        return nv_gpus
     else:
         # NV_GPU wasn't set, use admin defaults, tell user
-        gpu_default = NV_DEFAULT_GPU_COUNT_RESERVATION
-        logger.info(
-            "NV_GPU environment variable not set, trying to acquire admin "
-            "default of %d GPUs" % gpu_default
-        )
-        gpus_available, own_gpus = nvidia_get_available_gpus(args.executor_path)
-        gpus = gpus_available[:gpu_default]
+        if args.gpu_profile:
+            gpu_default = 1
+            logger.log(
+                logging.DEBUG if quiet else logging.INFO,
+                "NV_GPU environment variable not set, trying to acquire a "
+                "MIG instance with profile %s" % args.gpu_profile
+            )
+        else:
+            gpu_default = NV_DEFAULT_GPU_COUNT_RESERVATION
+            logger.log(
+                logging.DEBUG if quiet else logging.INFO,
+                "NV_GPU environment variable not set, trying to acquire admin "
+                "default of %d GPUs" % gpu_default
+            )
+        gpus_available, own_gpus, gpus_used = nvidia_get_gpu_status(
+            args.executor_path, args.gpu_mem, args.gpu_profile)
+        if args.gpu_profile:
+            # MIG instances are already in order of preference
+            gpus = gpus_available[:1]
+        else:
+            # MIG instances are only used if explicitly requested
+            gpus = nvidia_select_gpus(
+                [g for g in gpus_available if isinstance(g, int)],
+                gpu_default)
         if len(gpus) < gpu_default:
+            what = 'GPU(s)'
+            if args.gpu_profile:
+                what = 'MIG instance(s) with profile %s' % args.gpu_profile
             msg = (
-                'Could not find %d available GPU(s)!\nUse:\n'
+                'Could not find %d available %s!\nUse:\n'
                 '"sudo userdocker ps --gpu-used" and "nvidia-smi" to see '
-                'status.' % gpu_default
+                'status.' % (gpu_default, what)
             )
             if NV_ALLOW_OWN_GPU_REUSE and own_gpus:
                 msg += '\n You can set NV_GPU to reuse a GPU you have already' \
                        ' reserved.'
-            raise UserDockerException(msg)
+            if NV_GPU_WAIT_TIMEOUT_MAX > 0:
+                msg += '\nUse "--wait-for-gpu" to wait for GPUs to become ' \
+                       'available.'
+            raise GPUsUnavailableException(msg)
+        check_gpu_quota(gpus_used, gpus)
         gpu_env = ",".join([str(g) for g in gpus])
         logger.info("Setting NV_GPU=%s" % gpu_env)
         os.environ['NV_GPU'] = gpu_env
+        return gpus
 
 
-def exec_cmd_run(args):
-    cmd = init_cmd(args)
-
-    # check port mappings
-    for pm in getattr(args, 'port_mappings', []):
-        for pm_pattern in ALLOWED_PORT_MAPPINGS:
-            if re.match(pm_pattern, pm):
-                cmd += ['-p', pm]
-                break
-        else:
+def _probe_mount(host_path):
+    if not os.path.exists(host_path):
+        return False
+    if PROBE_USED_MOUNTS and os.path.isdir(host_path):
+        try:
+            # reading the first entry is enough to trigger an automount
+            if hasattr(os, 'scandir'):
+                it = os.scandir(host_path)
+                next(it, None)
+                if hasattr(it, 'close'):
+                    it.close()
+            else:
+                os.listdir(host_path)
+        except OSError as e:
             raise UserDockerException(
-                "ERROR: given port mapping not allowed: %s" % pm
+                "ERROR: mount can't be probed: %s: %s" % (host_path, e)
             )
+    return True
 
 
-    # check mounts
-    mounts = []
-    mounts_available = \
-        VOLUME_MOUNTS_ALWAYS + VOLUME_MOUNTS_DEFAULT + VOLUME_MOUNTS_AVAILABLE
-
-    mounts += VOLUME_MOUNTS_ALWAYS
-
-    if not args.no_default_mounts:
-        mounts += VOLUME_MOUNTS_DEFAULT
-
-    for user_mount in getattr(args, 'volumes', []):
-        if user_mount in mounts:
-            continue
-        if user_mount in mounts_available:
-            mounts += [user_mount]
-            continue
-
-        # literal matches didn't work, check if the user appended a 'ro' flag
-        if len(user_mount.split(':')) == 3:
-            host_path, container_path, flag = user_mount.split(':')
-            if flag == 'ro':
-                st = ':'.join([host_path, container_path])
-                if st in mounts:
-                    # upgrade mount to include ro flag
-                    idx = mounts.index(st)
-                    mounts[idx] = user_mount
-                    continue
-                if st in mounts_available:
-                    mounts += [user_mount]
-                    continue
-
-        # allow potential unspecified container_path mounts
-        host_path = user_mount.split(':')[0] + ':'
-        if host_path in mounts_available:
-            mounts += [user_mount]
-            continue
+def check_mounts(mount_host_paths):
+    """Checks (and probes) all mount host paths in parallel.
 
+    As network mounts can hang, each mount needs to respond within
+    MOUNT_PROBE_TIMEOUT seconds.
+    """
+    mount_host_paths = list(OrderedDict.fromkeys(mount_host_paths))
+    try:
+        found = run_parallel(
+            [(_probe_mount, (ms,)) for ms in mount_host_paths],
+            timeout=MOUNT_PROBE_TIMEOUT,
+        )
+    except ParallelTimeoutError as e:
         raise UserDockerException(
-            "ERROR: given mount not allowed: %s" % user_mount
+            "ERROR: mount(s) didn't respond within %s seconds: %s" % (
+                MOUNT_PROBE_TIMEOUT,
+                ', '.join(mount_host_paths[i] for i in e.pending))
         )
-
-    mount_host_paths = [m.split(':')[0] for m in mounts]
-    for ms in mount_host_paths:
-        if not os.path.exists(ms):
+    for ms, ms_found in zip(mount_host_paths, found):
+        if not ms_found:
             raise UserDockerException(
                 "ERROR: mount can't be found: %s" % ms
             )
-        if PROBE_USED_MOUNTS and os.path.isdir(ms):
-            os.listdir(ms)
+
+
+def exec_cmd_run(args):
+    cmd = init_cmd(args)
+
+    policy = RunPolicy.from_config()
+
+    # check port mappings
+    for pm in getattr(args, 'port_mappings', []):
+        policy.check_port_mapping(pm)
+        cmd += ['-p', pm]
+
+    # check mounts
+    mounts = policy.resolve_mounts(
+        getattr(args, 'volumes', []),
+        default_mounts=not args.no_default_mounts,
+    )
+    check_mounts([m.split(':')[0] for m in mounts])
 
     for mount in mounts:
         if ':' not in mount:
@@ -243,55 +493,31 @@ def exec_cmd_run(args):
             )
         cmd += ["-v", mount]
 
-
-    if args.executor == 'nvidia-docker':
-        prepare_nvidia_docker_run(args)
-
-    env_vars = ENV_VARS + ENV_VARS_EXT.get(args.executor, [])
-    env_vars += [
-        "USERDOCKER=%s" % __version__,
-        "USERDOCKER_USER=%s" % user_name,
-        "USERDOCKER_UID=%d" % uid,
-    ]
-    if args.executor == 'nvidia-docker':
-        # remember which GPU was assigned to the container for ps --gpu-used
-        env_vars += [
-            "USERDOCKER_NV_GPU=%s" % os.environ['NV_GPU']
-        ]
-    for env_var in env_vars:
-        cmd += ['-e', env_var]
-
-
-    if USER_IN_CONTAINER:
-        cmd += ["-u", "%d:%d" % (uid, gid)]
-
-    for cap_drop in CAPS_DROP:
-        cmd += ["--cap-drop=%s" % cap_drop]
-    for cap_add in CAPS_ADD:
-        cmd += ["--cap-add=%s" % cap_add]
-
-    if args.workdir:
-        cmd += ["-w", args.workdir]
-    if args.entrypoint:
-        cmd += ["--entrypoint", args.entrypoint]
-
-    # additional injection protection, deactivated for now due to nvidia-docker
-    # unability to handle this
-    # cmd.append("--")
-
+    # resource limits (checked before GPUs are reserved)
+    limits = resolve_run_limits({
+        option: getattr(args, 'limit_' + option.replace('-', '_'))
+        for option in RUN_LIMIT_OPTIONS
+    })
+    check_user_run_limits(args.executor_path, limits)
+    cmd += run_limit_args(limits)
+
+    shm_size = resolve_shm_size(args.shm_size)
+    if shm_size is not None:
+        cmd += ['--shm-size=%s' % format_size(shm_size)]
+    if not passed_through('--ulimit'):
+        for name, (soft, hard) in resolve_ulimits(args.ulimits).items():
+            cmd += ['--ulimit=%s=%d:%d' % (name, soft, hard)]
+    if not passed_through('--tmpfs'):
+        for path, size in resolve_tmpfs(args.tmpfs).items():
+            cmd += ['--tmpfs=%s:size=%s' % (path, format_size(size))]
+
+    # image (checked and pulled before GPUs are reserved)
     img = args.image
     if ":" not in img and "@" not in img:
         # user didn't explicitly set a tag or digest, append ":latest"
         img += ":latest"
 
-    if ALLOWED_IMAGE_REGEXPS:
-        for air in ALLOWED_IMAGE_REGEXPS:
-            if re.match(air, img):
-                break
-        else:
-            raise UserDockerException(
-                "ERROR: image %s not in allowed image regexps: %s" % (
-                    img, ALLOWED_IMAGE_REGEXPS))
+    policy.check_image(img)
 
     # pull image?
     if RUN_PULL == "default":
@@ -306,12 +532,7 @@ def exec_cmd_run(args):
         )
     elif RUN_PULL == "never":
         # check if image is available locally
-        tmp = exec_cmd(
-            [args.executor_path, 'images', '-q', img],
-            return_status=False,
-            loglvl=logging.DEBUG,
-        )
-        if not tmp:
+        if not image_available_locally(args.executor_path, img):
             raise UserDockerException(
                 "ERROR: you can only use locally available images, but %s could"
                 " not be found locally" % img
@@ -321,7 +542,99 @@ def exec_cmd_run(args):
             "ERROR: RUN_PULL config variable not expected range, contact admin"
         )
 
-    cmd.append(img)
-    cmd.extend(args.image_args)
-
-    exit_exec_cmd(cmd, dry_run=args.dry_run)
+    nv_gpu_reservation = cpuset = None
+    if args.executor == 'nvidia-docker':
+        nv_gpu_reservation, cpuset = prepare_nvidia_docker_run(args)
+    else:
+        if args.wait_for_gpu is not None:
+            logger.warning('--wait-for-gpu is ignored for executor %s',
+                           args.executor)
+        if args.gpu_mem is not None:
+            logger.warning('--gpu-mem is ignored for executor %s',
+                           args.executor)
+        if args.gpu_profile is not None:
+            logger.warning('--gpu-profile is ignored for executor %s',
+                           args.executor)
+
+    # the GPU reservation is released if anything fails from here on or once
+    # docker run returned (then the container is listed if still running)
+    try:
+        if cpuset:
+            logger.info(
+                'Pinning container to CPUs %s (NUMA nodes %s)',
+                format_cpulist(cpuset.cpus), format_cpulist(cpuset.mems))
+            cmd += ['--cpuset-cpus=%s' % format_cpulist(cpuset.cpus)]
+            if cpuset.mems:
+                cmd += ['--cpuset-mems=%s' % format_cpulist(cpuset.mems)]
+
+        env_vars = ENV_VARS + ENV_VARS_EXT.get(args.executor, [])
+        env_vars += [
+            "USERDOCKER=%s" % __version__,
+            "USERDOCKER_USER=%s" % user_name,
+            "USERDOCKER_UID=%d" % uid,
+        ]
+        if args.executor == 'nvidia-docker':
+            # remember which GPU was assigned to the container for ps --gpu-used
+            env_vars += [
+                "USERDOCKER_NV_GPU=%s" % os.environ['NV_GPU']
+            ]
+        for env_var in env_vars:
+            cmd += ['-e', env_var]
+
+        # labels allow efficient server-side filtering of userdocker containers
+        labels = [
+            "%s=%s" % (LABEL_VERSION, __version__),
+            "%s=%s" % (LABEL_USER, user_name),
+            "%s=%d" % (LABEL_UID, uid),
+        ]
+        if args.executor == 'nvidia-docker':
+            labels += [
+                "%s=%s" % (LABEL_NV_GPU, os.environ['NV_GPU'])
+            ]
+        if args.executor == 'nvidia-docker' and args.gpu_mem is not None:
+            labels += [
+                "%s=%d" % (LABEL_NV_GPU_MEM, args.gpu_mem)
+            ]
+        if nv_gpu_reservation:
+            labels += [
+                "%s=%s" % (LABEL_NV_GPU_RESERVATION, nv_gpu_reservation)
+            ]
+        labels += [
+            "%s%s=%s" % (
+                LABEL_LIMIT_PREFIX, option, format_run_limit(option, v))
+            for option, v in limits.items()
+        ]
+        if cpuset and cpuset.exclusive:
+            labels += [
+                "%s=%s" % (LABEL_CPUSET, format_cpulist(cpuset.cpus))
+            ]
+        for label in labels:
+            cmd += ['--label', label]
+
+        if USER_IN_CONTAINER:
+            cmd += ["-u", "%d:%d" % (uid, gid)]
+
+        for cap_drop in CAPS_DROP:
+            cmd += ["--cap-drop=%s" % cap_drop]
+        for cap_add in CAPS_ADD:
+            cmd += ["--cap-add=%s" % cap_add]
+
+        if args.workdir:
+            cmd += ["-w", args.workdir]
+        if args.entrypoint:
+            cmd += ["--entrypoint", args.entrypoint]
+
+        # additional injection protection, deactivated for now due to
+        # nvidia-docker unability to handle this
+        # cmd.append("--")
+
+        cmd.append(img)
+        cmd.extend(args.image_args)
+
+        if not args.dry_run:
+            # the shared GPU usage state is outdated once the container runs
+            nvidia_invalidate_gpus_used_by_containers()
+        exit_exec_cmd(cmd, dry_run=args.dry_run)
+    finally:
+        if nv_gpu_reservation:
+            release_gpu_reservation(nv_gpu_reservation)
@@ -11,7 +11,7 @@ from .helpers.cmd import init_cmd
 from .helpers.exceptions import UserDockerException
 from .helpers.execute import exit_exec_cmd
 from .parser import parse_args
-from .subcommands import specific_command_executors
+from .subcommands import get_specific_command_executor
 
 
 if not os.getenv('SUDO_UID'):
@@ -20,9 +20,9 @@ if not os.getenv('SUDO_UID'):
 
 
 def prepare_and_exec_cmd(args):
-    scmd = args.subcommand
-    if scmd in specific_command_executors:
-        specific_command_executors[scmd](args)
+    specific_command_executor = get_specific_command_executor(args.subcommand)
+    if specific_command_executor:
+        specific_command_executor(args)
     else:
         exit_exec_cmd(init_cmd(args), dry_run=args.dry_run)
 